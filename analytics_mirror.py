@@ -0,0 +1,394 @@
+"""Optional DuckDB mirror of the tables behind the aggregate endpoints.
+
+    python analytics_mirror.py sync [--interval SECONDS]
+
+copies the new clients, employees, accounts, withdrawals, transfers and loans
+of MySQL (every shard when sharding is on) into the DuckDB file
+``ANALYTICS_DB_PATH``, by id watermark per table and shard. Loans are also
+updated in place (accrual, delinquency), so the loans the change feed reports
+as updated, and those of every accrual run it reports, are read again. The
+archived months of ``archive.py`` are imported
+once, so the mirror keeps the whole history in one place.
+
+Auto-increment ids become visible at commit, so the watermarks only move past
+settled ids (see ``changefeed.settled_high_water``): a sync stops before the
+first row whose transaction is still open and copies it, with the rows after
+it, once it is committed.
+
+With ``ANALYTICS_BACKEND=duckdb`` the summary, average and date-range
+endpoints run their MySQL query on the mirror (see ``fetch_all``) and report
+the time of its last sync in the ``X-Data-As-Of`` and ``X-Staleness-Seconds``
+headers. They keep using MySQL when duckdb is not installed, the file does not
+exist, a sync holds its write lock, or the last sync is older than
+``ANALYTICS_MAX_STALENESS_SECONDS``.
+
+    python analytics_mirror.py bench [--repeat N]
+
+calls each of those endpoints with the busiest client, employee and accounts
+of the mirror, once on MySQL and once on DuckDB, and prints the median time of
+both and which backend answered.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+from datetime import timedelta
+
+from mysql.connector import Error
+
+import archive
+import changefeed
+import sharding
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+ANALYTICS_BACKEND = os.getenv("ANALYTICS_BACKEND", "mysql")
+ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "analytics/financial.duckdb")
+ANALYTICS_MAX_STALENESS_SECONDS = float(os.getenv("ANALYTICS_MAX_STALENESS_SECONDS", "900"))
+
+SYNC_BATCH_SIZE = 50000
+LOCK_RETRY_SECONDS = 30
+
+# name: (id column, MySQL select, DuckDB columns, split across the shards)
+MIRROR_TABLES = {
+    "clients": ("id_client", "SELECT id_client, name, last_name FROM clients", """
+        id_client BIGINT PRIMARY KEY, name VARCHAR, last_name VARCHAR
+    """, False),
+    "employees": ("employee_id", "SELECT employee_id, name, position FROM employees", """
+        employee_id BIGINT PRIMARY KEY, name VARCHAR, position VARCHAR
+    """, False),
+    "accounts": ("account_id", "SELECT account_id, id_client, account_number FROM accounts", """
+        account_id BIGINT PRIMARY KEY, id_client BIGINT, account_number VARCHAR
+    """, True),
+    "withdrawals": ("withdrawal_id", """
+        SELECT withdrawal_id, account_id, amount, withdrawal_date, withdrawal_method FROM withdrawals
+    """, """
+        withdrawal_id BIGINT PRIMARY KEY, account_id BIGINT, amount DECIMAL(15, 2),
+        withdrawal_date TIMESTAMP, withdrawal_method VARCHAR
+    """, True),
+    "transfers": ("transfer_id", """
+        SELECT transfer_id, from_account_id, to_account_id, amount, transfer_date, transfer_method, status FROM transfers
+    """, """
+        transfer_id BIGINT PRIMARY KEY, from_account_id BIGINT, to_account_id BIGINT, amount DECIMAL(15, 2),
+        transfer_date TIMESTAMP, transfer_method VARCHAR, status VARCHAR
+    """, True),
+    "loans": ("loan_id", """
+        SELECT loan_id, ID_client AS id_client, employee_id, amount, interest_rate,
+            disbursement_date, due_date, balance, status
+        FROM loans
+    """, """
+        loan_id BIGINT PRIMARY KEY, id_client BIGINT, employee_id BIGINT, amount DECIMAL(15, 2),
+        interest_rate DECIMAL(5, 2), disbursement_date DATE, due_date DATE, balance DECIMAL(15, 2), status VARCHAR
+    """, False),
+}
+
+CREATE_STATE_QUERY = "CREATE TABLE IF NOT EXISTS mirror_state (name VARCHAR PRIMARY KEY, value DOUBLE)"
+
+
+def _state(connection, name):
+    row = connection.execute("SELECT value FROM mirror_state WHERE name = ?", [name]).fetchone()
+    return row[0] if row else None
+
+
+def _set_state(connection, name, value):
+    connection.execute("INSERT OR REPLACE INTO mirror_state VALUES (?, ?)", [name, value])
+
+
+def _upsert(connection, table, rows):
+    if rows:
+        placeholders = ", ".join(["?"] * len(rows[0]))
+        connection.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", [list(row) for row in rows])
+
+
+def _sync_table(mysql_connection, mysql_cursor, connection, table, shard):
+    id_column, select_query, _, _ = MIRROR_TABLES[table]
+    state_name = f"{table}@{shard}"
+    watermark = int(_state(connection, state_name) or 0)
+    copied = 0
+    while True:
+        high_water = changefeed.settled_high_water(mysql_connection, table, id_column, watermark, SYNC_BATCH_SIZE)
+        if high_water == watermark:
+            break
+        mysql_cursor.execute(f"{select_query} WHERE {id_column} > %s AND {id_column} <= %s", (watermark, high_water))
+        rows = mysql_cursor.fetchall()
+        _upsert(connection, table, rows)
+        copied += len(rows)
+        watermark = high_water
+        _set_state(connection, state_name, watermark)
+    return copied
+
+
+def _sync_updated_loans(mysql_connection, mysql_cursor, connection):
+    watermark = int(_state(connection, "loans_outbox") or 0)
+    _, select_query, _, _ = MIRROR_TABLES["loans"]
+    updated = 0
+    while True:
+        high_water = changefeed.settled_high_water(mysql_connection, "change_outbox", "event_id", watermark, SYNC_BATCH_SIZE)
+        if high_water == watermark:
+            break
+        mysql_cursor.execute("""
+        SELECT DISTINCT row_id
+        FROM change_outbox
+        WHERE table_name = 'loans' AND operation = 'update' AND event_id > %s AND event_id <= %s
+        """, (watermark, high_water))
+        loan_ids = [row[0] for row in mysql_cursor.fetchall()]
+        if loan_ids:
+            mysql_cursor.execute(f"{select_query} WHERE loan_id IN ({', '.join(['%s'] * len(loan_ids))})", tuple(loan_ids))
+            rows = mysql_cursor.fetchall()
+            _upsert(connection, "loans", rows)
+            updated += len(rows)
+        # An accrual run is one event for every loan it accrued.
+        mysql_cursor.execute("""
+        SELECT row_id
+        FROM change_outbox
+        WHERE table_name = 'loan_accruals' AND event_id > %s AND event_id <= %s
+        """, (watermark, high_water))
+        run_ids = [row[0] for row in mysql_cursor.fetchall()]
+        run_dates = []
+        if run_ids:
+            mysql_cursor.execute(f"SELECT run_date FROM loan_accrual_runs WHERE run_id IN ({', '.join(['%s'] * len(run_ids))})",
+                                 tuple(run_ids))
+            run_dates = [row[0] for row in mysql_cursor.fetchall()]
+        for run_date in run_dates:
+            mysql_cursor.execute(f"{select_query} WHERE last_accrued_date = %s", (run_date,))
+            rows = mysql_cursor.fetchall()
+            _upsert(connection, "loans", rows)
+            updated += len(rows)
+        watermark = high_water
+        _set_state(connection, "loans_outbox", watermark)
+    return updated
+
+
+def _import_archive(connection):
+    imported = 0
+    for table in archive.DATE_COLUMNS:
+        columns = [row[0] for row in connection.execute(f"DESCRIBE {table}").fetchall()]
+        for month in archive.archived_months(table):
+            state_name = f"archive:{table}:{month:%Y-%m}"
+            if _state(connection, state_name):
+                continue
+            month_end = (month + timedelta(days=32)).replace(day=1) - timedelta(days=1)
+            rows = archive.read_rows(table, month, month_end)
+            _upsert(connection, table, [tuple(row.get(column) for column in columns) for row in rows])
+            _set_state(connection, state_name, 1)
+            imported += len(rows)
+    return imported
+
+
+def _open_for_write():
+    os.makedirs(os.path.dirname(ANALYTICS_DB_PATH) or ".", exist_ok=True)
+    deadline = time.monotonic() + LOCK_RETRY_SECONDS
+    while True:
+        try:
+            return duckdb.connect(ANALYTICS_DB_PATH)
+        except duckdb.Error:
+            # Readers open the file for the length of one query.
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def sync():
+    started_at = time.time()
+    connection = _open_for_write()
+    try:
+        connection.execute(CREATE_STATE_QUERY)
+        for table, (_, _, columns, _) in MIRROR_TABLES.items():
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+
+        counts = {}
+        mysql_connections = sharding.shard_connections()
+        try:
+            for shard, mysql_connection in enumerate(mysql_connections):
+                mysql_cursor = mysql_connection.cursor()
+                try:
+                    for table, (_, _, _, sharded) in MIRROR_TABLES.items():
+                        if sharded or shard == 0:
+                            counts[table] = counts.get(table, 0) + _sync_table(
+                                mysql_connection, mysql_cursor, connection, table, shard
+                            )
+                    if shard == 0:
+                        counts["updated_loans"] = _sync_updated_loans(mysql_connection, mysql_cursor, connection)
+                finally:
+                    mysql_cursor.close()
+        finally:
+            for mysql_connection in mysql_connections:
+                mysql_connection.close()
+
+        counts["archived_rows"] = _import_archive(connection)
+        _set_state(connection, "synced_at", started_at)
+        connection.execute("CHECKPOINT")
+        return counts
+    finally:
+        connection.close()
+
+
+def fetch_all(query, params=()):
+    """``(rows, synced_at)`` of the MySQL ``query`` on the mirror, or None when MySQL has to answer.
+
+    The endpoints pass the query they run on MySQL, written in the SQL both
+    databases read alike (``CONCAT``, ``GROUP_CONCAT``, every selected column
+    in the ``GROUP BY``); only its ``%s`` placeholders are rewritten.
+    """
+    if ANALYTICS_BACKEND != "duckdb" or duckdb is None or not os.path.exists(ANALYTICS_DB_PATH):
+        return None
+    try:
+        connection = duckdb.connect(ANALYTICS_DB_PATH, read_only=True)
+    except duckdb.Error:
+        return None
+    try:
+        synced_at = _state(connection, "synced_at")
+        if synced_at is None or time.time() - synced_at > ANALYTICS_MAX_STALENESS_SECONDS:
+            return None
+        result = connection.execute(query.replace("%s", "?"), list(params))
+        names = [column[0] for column in result.description]
+        return [dict(zip(names, row)) for row in result.fetchall()], synced_at
+    except duckdb.Error as e:
+        print(f"Analytics mirror query failed, using MySQL: {e}")
+        return None
+    finally:
+        connection.close()
+
+
+# The busiest client, employee and accounts, and the span of the data, as bench arguments.
+BENCH_SAMPLE_QUERIES = {
+    "client": """
+        SELECT CONCAT(c.name, ' ', c.last_name), CAST(MAX(w.withdrawal_date) AS DATE)
+        FROM clients c
+        JOIN accounts a ON c.id_client = a.id_client
+        JOIN withdrawals w ON a.account_id = w.account_id
+        GROUP BY c.id_client, c.name, c.last_name
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """,
+    "employee": """
+        SELECT e.name FROM employees e JOIN loans l ON e.employee_id = l.employee_id
+        GROUP BY e.employee_id, e.name
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """,
+    "from_account": """
+        SELECT a.account_number FROM accounts a JOIN transfers t ON a.account_id = t.from_account_id
+        GROUP BY a.account_id, a.account_number
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """,
+    "to_account": """
+        SELECT a.account_number FROM accounts a JOIN transfers t ON a.account_id = t.to_account_id
+        GROUP BY a.account_id, a.account_number
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """,
+    "dates": """
+        SELECT CAST(LEAST((SELECT MIN(withdrawal_date) FROM withdrawals), (SELECT MIN(transfer_date) FROM transfers)) AS DATE),
+            CAST(GREATEST((SELECT MAX(withdrawal_date) FROM withdrawals), (SELECT MAX(transfer_date) FROM transfers)) AS DATE)
+    """,
+}
+
+
+def _bench_samples():
+    connection = duckdb.connect(ANALYTICS_DB_PATH, read_only=True)
+    try:
+        synced_at = _state(connection, "synced_at")
+        rows = {name: connection.execute(query).fetchone() for name, query in BENCH_SAMPLE_QUERIES.items()}
+    finally:
+        connection.close()
+    if synced_at is None or any(row is None or row[0] is None for row in rows.values()):
+        raise SystemExit(f"{ANALYTICS_DB_PATH} has no clients with withdrawals, loans or transfers, run sync first")
+    client, withdrawal_date = rows["client"]
+    start_date, end_date = rows["dates"]
+    return synced_at, [
+        ("get_loans_summary_by_client", {"client_full_name": client}),
+        ("get_loans_summary_by_employee", {"employee_full_name": rows["employee"][0]}),
+        ("get_average_withdrawals_by_client", {"client_full_name": client}),
+        ("get_count_and_amounts_withdrawals_by_client_and_date", {
+            "client_full_name": client, "withdrawal_date": withdrawal_date,
+        }),
+        ("transfers_by_account_and_date_range", {
+            "start_date": start_date, "end_date": end_date, "from_account_number": rows["from_account"][0],
+        }),
+        ("transfers_summary_to_specific_account", {
+            "to_account_number": rows["to_account"][0], "start_date": start_date, "end_date": end_date,
+        }),
+        ("get_employees_loans_summary_by_name", {"employee_name": rows["employee"][0]}),
+        ("withdrawals_summary_by_client", {"client_full_name": client, "start_date": start_date, "end_date": end_date}),
+    ]
+
+
+async def _time_endpoint(handler, kwargs, repeat):
+    from fastapi import HTTPException, Response
+
+    timings = []
+    backend = "mysql"
+    for _ in range(repeat):
+        response = Response()
+        started = time.perf_counter()
+        try:
+            await handler(response=response, **kwargs)
+        except HTTPException as e:
+            backend = f"HTTP {e.status_code}"
+        timings.append((time.perf_counter() - started) * 1000)
+        backend = response.headers.get("X-Analytics-Backend", backend)
+    return statistics.median(timings), backend
+
+
+def bench(repeat):
+    """Median time of each mirrored endpoint on MySQL and on DuckDB, in ms."""
+    # routes imports this module, which is __main__ when run as a script.
+    import routes
+
+    mirror = routes.analytics_mirror
+    synced_at, endpoints = _bench_samples()
+    print(f"Mirror last synced {time.time() - synced_at:.0f}s ago, median of {repeat} calls")
+    saved = mirror.ANALYTICS_BACKEND, mirror.ANALYTICS_MAX_STALENESS_SECONDS
+    # The bench compares the backends, so a stale mirror still answers.
+    mirror.ANALYTICS_MAX_STALENESS_SECONDS = float("inf")
+    results = {}
+    try:
+        for name, kwargs in endpoints:
+            handler = getattr(routes, name)
+            for backend in ("mysql", "duckdb"):
+                mirror.ANALYTICS_BACKEND = backend
+                results[name, backend] = asyncio.run(_time_endpoint(handler, kwargs, repeat))
+            (mysql_ms, mysql_answer), (duckdb_ms, duckdb_answer) = results[name, "mysql"], results[name, "duckdb"]
+            print(f"{name}: mysql {mysql_ms:.1f} ms ({mysql_answer}), duckdb {duckdb_ms:.1f} ms ({duckdb_answer}), "
+                  f"x{mysql_ms / duckdb_ms if duckdb_ms else float('inf'):.1f}")
+    finally:
+        mirror.ANALYTICS_BACKEND, mirror.ANALYTICS_MAX_STALENESS_SECONDS = saved
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="DuckDB analytics mirror")
+    parser.add_argument("command", choices=["sync", "bench"])
+    parser.add_argument("--interval", type=float, default=0, help="keep syncing every N seconds (0: sync once)")
+    parser.add_argument("--repeat", type=int, default=5, help="bench: calls of each endpoint per backend")
+    args = parser.parse_args()
+    if duckdb is None:
+        raise SystemExit("pip install duckdb to use the analytics mirror")
+    if args.command == "bench":
+        if not os.path.exists(ANALYTICS_DB_PATH):
+            raise SystemExit(f"{ANALYTICS_DB_PATH} does not exist, run sync first")
+        bench(max(args.repeat, 1))
+        return
+
+    while True:
+        started = time.perf_counter()
+        try:
+            counts = sync()
+            print(f"Mirror synced in {time.perf_counter() - started:.1f}s: {counts}")
+        except Error as e:
+            print(f"Mirror sync failed: {e}")
+            if not args.interval:
+                raise SystemExit(1)
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
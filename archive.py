@@ -0,0 +1,226 @@
+"""Compressed columnar archive of closed transfer and withdrawal partitions.
+
+Each archived month is one gzip-compressed JSON file holding one array per
+column, stored as ``<ARCHIVE_DIR>/<table>/<YYYY-MM>.json.gz``, or one file per
+shard (``<YYYY-MM>.shard<N>.json.gz``) when sharding is on. Files are written
+once and only rewritten by ``sharding.py migrate``, which runs with the app
+stopped, so readers keep the most recent ones cached, up to
+``ARCHIVE_CACHE_ROWS`` decoded rows in all.
+"""
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from decimal import Decimal
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")
+ARCHIVE_CACHE_ROWS = int(os.getenv("ARCHIVE_CACHE_ROWS", "200000"))
+
+DATE_COLUMNS = {
+    "transfers": "transfer_date",
+    "withdrawals": "withdrawal_date",
+}
+
+
+def _month_start(value):
+    return value.replace(day=1)
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def _archive_path(table, month, shard=None):
+    suffix = f".shard{shard}" if shard is not None else ""
+    return os.path.join(ARCHIVE_DIR, table, f"{month:%Y-%m}{suffix}.json.gz")
+
+
+def _month_paths(table, month):
+    directory = os.path.join(ARCHIVE_DIR, table)
+    prefix = f"{month:%Y-%m}."
+    return sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.startswith(prefix) and filename.endswith(".json.gz")
+    )
+
+
+def _column_type(values):
+    for value in values:
+        if value is None:
+            continue
+        # datetime is a subclass of date.
+        if isinstance(value, datetime):
+            return "datetime"
+        if isinstance(value, date):
+            return "date"
+        if isinstance(value, Decimal):
+            return "decimal"
+        if isinstance(value, (int, float)):
+            return "number"
+        return "str"
+    return "str"
+
+
+def _encode(value):
+    if value is None or isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def _decode_date(value):
+    # Older files typed the DATETIME columns as "date".
+    return datetime.fromisoformat(value) if len(value) > 10 else date.fromisoformat(value)
+
+
+_DECODERS = {
+    "date": _decode_date,
+    "datetime": datetime.fromisoformat,
+    "decimal": Decimal,
+}
+
+
+def _write_columns(path, table, month, row_count, column_values):
+    document = {
+        "table": table,
+        "month": f"{month:%Y-%m}",
+        "row_count": row_count,
+        "types": {column: _column_type(values) for column, values in column_values.items()},
+        "columns": {column: [_encode(value) for value in values] for column, values in column_values.items()},
+    }
+    temporary_path = path + ".tmp"
+    with gzip.open(temporary_path, "wt", encoding="utf-8") as archive_file:
+        json.dump(document, archive_file)
+    os.replace(temporary_path, path)
+
+
+def write_month(table, month, columns, rows, shard=None):
+    path = _archive_path(table, month, shard)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    column_values = {column: [row[i] for row in rows] for i, column in enumerate(columns)}
+    _write_columns(path, table, month, len(rows), column_values)
+    return path
+
+
+def _read_month(path):
+    with gzip.open(path, "rt", encoding="utf-8") as archive_file:
+        document = json.load(archive_file)
+    columns = {}
+    for column, values in document["columns"].items():
+        decoder = _DECODERS.get(document["types"][column])
+        if decoder:
+            values = [decoder(value) if value is not None else None for value in values]
+        columns[column] = values
+    return document["row_count"], columns
+
+
+class _MonthCache:
+    """Decoded months, least recently read evicted first, bounded by their total rows."""
+
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._months = OrderedDict()
+        self._rows = 0
+
+    def load(self, path):
+        with self._lock:
+            month = self._months.get(path)
+            if month is not None:
+                self._months.move_to_end(path)
+                return month
+        month = _read_month(path)
+        row_count = month[0]
+        if row_count > self.max_rows:
+            return month
+        with self._lock:
+            if path not in self._months:
+                self._months[path] = month
+                self._rows += row_count
+                while self._rows > self.max_rows:
+                    _, (evicted_count, _) = self._months.popitem(last=False)
+                    self._rows -= evicted_count
+        return month
+
+
+_month_cache = _MonthCache(ARCHIVE_CACHE_ROWS)
+
+
+def archived_months(table):
+    directory = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(directory):
+        return []
+    months = []
+    for filename in os.listdir(directory):
+        if filename.endswith(".json.gz"):
+            year, month = filename[:len("YYYY-MM")].split("-")
+            months.append(date(int(year), int(month), 1))
+    return sorted(set(months))
+
+
+def read_rows(table, start_date, end_date, column=None, values=None):
+    """Archived rows of ``table`` dated between both dates, optionally with ``column`` in ``values``."""
+    date_column = DATE_COLUMNS[table]
+    start_date, end_date = _as_date(start_date), _as_date(end_date)
+    months = [
+        month for month in archived_months(table)
+        if _month_start(start_date) <= month <= _month_start(end_date)
+    ]
+    rows = []
+    for path in [path for month in months for path in _month_paths(table, month)]:
+        row_count, columns = _month_cache.load(path)
+        dates = columns[date_column]
+        filter_values = columns[column] if column is not None else None
+        names = list(columns)
+        for i in range(row_count):
+            if not start_date <= _as_date(dates[i]) <= end_date:
+                continue
+            if filter_values is not None and filter_values[i] not in values:
+                continue
+            rows.append({name: columns[name][i] for name in names})
+    return rows
+
+
+def replace_values(table, columns, mapping):
+    """Rewrite the archived files of ``table`` with the values of ``columns`` found in ``mapping`` replaced."""
+    directory = os.path.join(ARCHIVE_DIR, table)
+    if not os.path.isdir(directory):
+        return []
+    rewritten = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith(".json.gz"):
+            continue
+        path = os.path.join(directory, filename)
+        row_count, column_values = _read_month(path)
+        if not any(value in mapping for column in columns for value in column_values[column]):
+            continue
+        for column in columns:
+            column_values[column] = [mapping.get(value, value) for value in column_values[column]]
+        year, month = filename[:len("YYYY-MM")].split("-")
+        _write_columns(path, table, date(int(year), int(month), 1), row_count, column_values)
+        rewritten.append(path)
+    return rewritten
+
+
+def month_batches(table):
+    """Every archived row of ``table``, one list per file, oldest month first.
+
+    The files are read past the cache, which a full scan would only empty of
+    the months the date-range readers keep there.
+    """
+    for month in archived_months(table):
+        for path in _month_paths(table, month):
+            row_count, columns = _read_month(path)
+            names = list(columns)
+            yield [{name: columns[name][i] for name in names} for i in range(row_count)]
+
+
+def covers(table, start_date, end_date):
+    start_date, end_date = _as_date(start_date), _as_date(end_date)
+    return any(
+        _month_start(start_date) <= month <= _month_start(end_date)
+        for month in archived_months(table)
+    )
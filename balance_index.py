@@ -0,0 +1,353 @@
+"""In-process sorted index of account balances.
+
+Keys are ``(balance in cents, account_id)`` tuples kept in a list of sorted chunks, so
+inserts and removals only shift one small chunk, while threshold counts and
+range listings are answered with binary searches over the chunk maxima.
+
+Each worker process owns its own index: it is loaded at startup and updated
+right away by the withdrawal, transfer and account bulk handlers of that
+worker. ``refresh`` brings in what the other workers committed: it re-reads the
+ledger balance of every account with entries, and the accounts created, past
+the ids settled at the previous load or refresh (see
+``changefeed.settled_high_water``). ``check_consistency`` compares the index
+against the ledger balances in the database.
+
+``python balance_index.py --bench 10000000`` builds the index from that many
+synthetic accounts, without a database, and prints its estimated memory and
+the time taken by the load, by balance updates and by the threshold queries.
+"""
+import argparse
+import random
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+
+import changefeed
+import ledger
+from money import Money, floor_cents, to_cents
+
+CHUNK_SIZE = 1000
+SETTLED_BATCH_SIZE = 100000
+
+ACCOUNTS_QUERY = """
+SELECT a.account_id, a.account_number, a.balance,
+    c.id_client, c.name AS client_name, c.last_name AS client_last_name
+FROM accounts a
+LEFT JOIN clients c ON a.id_client = c.id_client
+"""
+
+_ABOVE_ALL_IDS = float("inf")
+
+
+def _account(row):
+    client_full_name = f"{row['client_name']} {row['client_last_name']}" if row["client_name"] else "No client"
+    return row["account_number"], row["id_client"], client_full_name
+
+
+def _settled(connection, table, id_column, after_id):
+    while True:
+        high_water = changefeed.settled_high_water(connection, table, id_column, after_id, SETTLED_BATCH_SIZE)
+        if high_water == after_id:
+            return high_water
+        after_id = high_water
+
+
+def _high_waters(connection, previous=None):
+    """``(account_id, entry_id)`` up to which the accounts and the ledger entries are settled."""
+    if previous is None:
+        cursor = connection.cursor()
+        try:
+            # The entries up to the last compaction are settled.
+            cursor.execute("SELECT COALESCE(MAX(last_entry_id), 0) FROM balance_snapshots")
+            previous = (0, cursor.fetchone()[0])
+        finally:
+            cursor.close()
+    account_id, entry_id = previous
+    return (
+        _settled(connection, "accounts", "account_id", account_id),
+        _settled(connection, "ledger_entries", "entry_id", entry_id)
+    )
+
+
+class BalanceIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._maxes = []
+        self._balances = {}
+        self._accounts = {}
+        self._high_waters = []
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._balances)
+
+    def load(self, *connections):
+        """Rebuild the index from the given databases (one connection per shard)."""
+        rows = []
+        balances = {}
+        high_waters = []
+        for connection in connections:
+            # Taken before the rows: a refresh reads again whatever settles
+            # after them, so nothing committed meanwhile is missed.
+            high_waters.append(_high_waters(connection))
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute(ACCOUNTS_QUERY)
+                rows.extend(cursor.fetchall())
+                balances.update(ledger.current_balances(cursor))
+            finally:
+                cursor.close()
+        self._build(rows, balances, high_waters)
+
+    def _build(self, rows, balances, high_waters):
+        accounts = {}
+        account_balances = {}
+        for row in rows:
+            accounts[row["account_id"]] = _account(row)
+            account_balances[row["account_id"]] = balances.get(row["account_id"], to_cents(row["balance"]))
+
+        keys = sorted((balance, account_id) for account_id, balance in account_balances.items())
+        chunks = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        with self._lock:
+            self._accounts = accounts
+            self._balances = account_balances
+            self._chunks = chunks
+            self._maxes = [chunk[-1] for chunk in chunks]
+            self._high_waters = high_waters
+            self.loaded = True
+
+    def refresh(self, *connections):
+        """Apply the accounts and ledger entries settled since the last load or refresh.
+
+        Takes the same connections as ``load``; returns the number of accounts
+        read again.
+        """
+        with self._lock:
+            previous_high_waters = list(self._high_waters)
+        refreshed = 0
+        for shard, connection in enumerate(connections):
+            previous = previous_high_waters[shard]
+            account_high_water, entry_high_water = _high_waters(connection, previous)
+            if (account_high_water, entry_high_water) == previous:
+                continue
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute(
+                    ACCOUNTS_QUERY + " WHERE a.account_id > %s AND a.account_id <= %s",
+                    (previous[0], account_high_water)
+                )
+                rows = cursor.fetchall()
+                cursor.execute("""
+                SELECT DISTINCT account_id
+                FROM ledger_entries
+                WHERE entry_id > %s AND entry_id <= %s AND account_id IS NOT NULL
+                """, (previous[1], entry_high_water))
+                account_ids = {row["account_id"] for row in cursor.fetchall()}
+                account_ids.update(row["account_id"] for row in rows)
+                balances = ledger.current_balances(cursor, account_ids)
+            finally:
+                cursor.close()
+
+            with self._lock:
+                for row in rows:
+                    self._accounts[row["account_id"]] = _account(row)
+                    balances.setdefault(row["account_id"], to_cents(row["balance"]))
+                for account_id, balance in balances.items():
+                    if account_id in self._accounts:
+                        self._set_balance(account_id, balance)
+                if shard < len(self._high_waters):
+                    self._high_waters[shard] = (account_high_water, entry_high_water)
+            refreshed += len(account_ids)
+        return refreshed
+
+    def _insert(self, key):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        i = bisect_left(self._maxes, key)
+        if i == len(self._chunks):
+            i -= 1
+        chunk = self._chunks[i]
+        insort(chunk, key)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def _remove(self, key):
+        i = bisect_left(self._maxes, key)
+        chunk = self._chunks[i]
+        del chunk[bisect_left(chunk, key)]
+        if chunk:
+            self._maxes[i] = chunk[-1]
+        else:
+            del self._chunks[i]
+            del self._maxes[i]
+
+    def add_accounts(self, accounts):
+        """Index new accounts given as ``(account_id, account_number, id_client, client_full_name, cents)``."""
+        with self._lock:
+            for account_id, account_number, id_client, client_full_name, balance in accounts:
+                self._accounts[account_id] = (account_number, id_client, client_full_name)
+                self._set_balance(account_id, balance)
+
+    def update_balances(self, balances):
+        with self._lock:
+            for account_id, balance in balances.items():
+                if account_id in self._accounts:
+                    self._set_balance(account_id, balance)
+
+    def _set_balance(self, account_id, balance):
+        previous = self._balances.get(account_id)
+        if previous is not None:
+            self._remove((previous, account_id))
+        self._balances[account_id] = balance
+        self._insert((balance, account_id))
+
+    def _locate_above(self, threshold):
+        # balance > threshold is balance > floor(threshold) in whole cents.
+        probe = (floor_cents(threshold), _ABOVE_ALL_IDS)
+        i = bisect_right(self._maxes, probe)
+        if i == len(self._chunks):
+            return i, 0
+        return i, bisect_right(self._chunks[i], probe)
+
+    def count_above(self, threshold):
+        with self._lock:
+            i, position = self._locate_above(threshold)
+            return sum(len(chunk) for chunk in self._chunks[i:]) - position
+
+    def accounts_above(self, threshold, limit=None):
+        with self._lock:
+            i, position = self._locate_above(threshold)
+            results = []
+            for chunk in self._chunks[i:]:
+                for balance, account_id in chunk[position:]:
+                    if limit is not None and len(results) >= limit:
+                        return results
+                    account_number, id_client, client_full_name = self._accounts[account_id]
+                    results.append({
+                        "account_id": account_id,
+                        "account_number": account_number,
+                        "balance": Money(balance),
+                        "client_id": id_client,
+                        "client_full_name": client_full_name
+                    })
+                position = 0
+            return results
+
+    def memory_bytes(self):
+        """Estimated memory footprint of the index, in bytes."""
+        with self._lock:
+            return (
+                sys.getsizeof(self._accounts) + sum(
+                    sys.getsizeof(account) + sum(sys.getsizeof(value) for value in account)
+                    for account in self._accounts.values()
+                )
+                + sys.getsizeof(self._balances)
+                + sys.getsizeof(self._chunks) + sum(
+                    sys.getsizeof(chunk) + sum(sys.getsizeof(key) for key in chunk) for chunk in self._chunks
+                )
+                + sys.getsizeof(self._maxes)
+            )
+
+    def check_consistency(self, *connections, repair=False):
+        """Compare the index against the databases and optionally fix the drift."""
+        database = {}
+        for connection in connections:
+            cursor = connection.cursor(dictionary=True)
+            try:
+                cursor.execute("SELECT account_id, balance FROM accounts")
+                shard = {row["account_id"]: to_cents(row["balance"]) for row in cursor.fetchall()}
+                shard.update(ledger.current_balances(cursor))
+                database.update(shard)
+            finally:
+                cursor.close()
+
+        with self._lock:
+            indexed = dict(self._balances)
+        missing = sorted(set(database) - set(indexed))
+        unknown = sorted(set(indexed) - set(database))
+        mismatched = sorted(
+            account_id for account_id in set(database) & set(indexed)
+            if database[account_id] != indexed[account_id]
+        )
+        if repair and (missing or unknown or mismatched):
+            self.load(*connections)
+        return {
+            "indexed_accounts": len(indexed),
+            "database_accounts": len(database),
+            "missing_accounts": missing,
+            "unknown_accounts": unknown,
+            "mismatched_balances": mismatched,
+            "consistent": not (missing or unknown or mismatched),
+            "repaired": repair and bool(missing or unknown or mismatched)
+        }
+
+
+balance_index = BalanceIndex()
+
+
+def _synthetic_rows(accounts, generator):
+    for account_id in range(1, accounts + 1):
+        yield {
+            "account_id": account_id,
+            "account_number": f"{account_id:010d}",
+            "balance": generator.randint(0, 10 ** 6),
+            "id_client": account_id // 2 + 1,
+            "client_name": f"Name{account_id % 50000}",
+            "client_last_name": f"Last{account_id % 70000}",
+        }
+
+
+def _percentile_ms(seconds, fraction):
+    seconds = sorted(seconds)
+    return seconds[min(len(seconds) - 1, int(len(seconds) * fraction))] * 1000
+
+
+def bench(accounts, updates, queries, seed=1):
+    generator = random.Random(seed)
+    index = BalanceIndex()
+    started = time.perf_counter()
+    index._build(_synthetic_rows(accounts, generator), {}, [])
+    print(f"load: {accounts} accounts in {time.perf_counter() - started:.2f}s")
+    print(f"memory: ~{index.memory_bytes() / 2 ** 20:.0f} MiB estimated")
+
+    # Applied in batches like the bulk handlers and the refresh do.
+    batch_seconds = []
+    for _ in range(0, updates, 1000):
+        balances = {generator.randint(1, accounts): generator.randint(0, 10 ** 8) for _ in range(1000)}
+        started = time.perf_counter()
+        index.update_balances(balances)
+        batch_seconds.append(time.perf_counter() - started)
+    print(f"refresh: {len(batch_seconds) * 1000} balance updates in batches of 1000, "
+          f"{sum(batch_seconds) / len(batch_seconds) * 1000:.2f} ms per batch, p99 {_percentile_ms(batch_seconds, 0.99):.2f} ms")
+
+    for name, query in (
+        ("count_above", lambda threshold: index.count_above(threshold)),
+        ("accounts_above limit 100", lambda threshold: index.accounts_above(threshold, 100)),
+    ):
+        query_seconds = []
+        for _ in range(queries):
+            threshold = generator.randint(0, 10 ** 6)
+            started = time.perf_counter()
+            query(threshold)
+            query_seconds.append(time.perf_counter() - started)
+        print(f"{name}: {sum(query_seconds) / len(query_seconds) * 1000:.3f} ms avg, "
+              f"p99 {_percentile_ms(query_seconds, 0.99):.3f} ms over {queries} thresholds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Balance index benchmark on synthetic accounts")
+    parser.add_argument("--bench", type=int, required=True, metavar="ACCOUNTS", help="synthetic accounts to index")
+    parser.add_argument("--updates", type=int, default=100000, help="balance updates applied after the load")
+    parser.add_argument("--queries", type=int, default=1000, help="thresholds queried per query type")
+    args = parser.parse_args()
+    bench(args.bench, args.updates, args.queries)
+
+
+if __name__ == "__main__":
+    main()
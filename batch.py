@@ -0,0 +1,116 @@
+"""Composite execution of several GET sub-requests in one call.
+
+Every sub-request is matched against the API routes, its query and path
+parameters are validated like FastAPI does for a real request, and its
+endpoint runs on a worker thread with an event loop of its own: the handlers
+block on their queries, so each sub-request holds its own pooled connection
+and at most ``DB_POOL_SIZE`` of them run at once. They run in the context of
+the batch request, so the query guard and the profiler follow them, and their
+result is validated against the ``response_model`` of the route like the
+response of a real request. Endpoints that need the ``Response`` of their
+request can not run in a batch.
+"""
+import asyncio
+import inspect
+import json
+
+from fastapi import HTTPException, Response
+from fastapi.dependencies.utils import request_params_to_args
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute, serialize_response
+from pydantic import ValidationError
+from starlette.routing import Match
+
+from conexion import DB_POOL_SIZE
+from threadpool import run_in_threadpool
+from streaming import JSONArrayResponse
+
+MAX_BATCH_SIZE = 50
+
+# Endpoints that must run on the server event loop.
+NOT_BATCHABLE = {"/batch", "/changes"}
+
+
+def _resolve(routes, path):
+    scope = {"type": "http", "method": "GET", "path": path}
+    for route in routes:
+        if not isinstance(route, APIRoute) or route.path_format in NOT_BATCHABLE:
+            continue
+        match, child_scope = route.matches(scope)
+        if match == Match.FULL:
+            return route, child_scope.get("path_params", {})
+    return None, None
+
+
+def _needs_response(route):
+    # A sub-request has no response of its own to set a status or headers on.
+    return any(
+        parameter.annotation is Response and parameter.default is inspect.Parameter.empty
+        for parameter in inspect.signature(route.endpoint).parameters.values()
+    )
+
+
+def _error_details(errors):
+    details = []
+    for error in errors:
+        if isinstance(error, list):
+            details.extend(_error_details(error))
+        else:
+            details.append({"loc": list(error.loc_tuple()), "msg": str(error.exc)})
+    return details
+
+
+async def _run_endpoint(route, values):
+    # Runs on the event loop of a worker thread. off_event_loop endpoints are
+    # unwrapped: they would hand the work to yet another thread.
+    endpoint = inspect.unwrap(route.endpoint)
+    if inspect.iscoroutinefunction(endpoint):
+        result = await endpoint(**values)
+    else:
+        result = endpoint(**values)
+    if isinstance(result, JSONArrayResponse):
+        result = json.loads(result.collect())
+    return await serialize_response(
+        field=route.response_field,
+        response_content=result,
+        include=route.response_model_include,
+        exclude=route.response_model_exclude,
+        by_alias=route.response_model_by_alias,
+        exclude_unset=route.response_model_exclude_unset,
+        exclude_defaults=route.response_model_exclude_defaults,
+        exclude_none=route.response_model_exclude_none,
+    )
+
+
+async def _execute_one(routes, sub_request, semaphore):
+    route, path_params = _resolve(routes, sub_request.path)
+    if route is None:
+        return {"id": sub_request.id, "status": 404, "body": {"detail": f"No GET endpoint for '{sub_request.path}'"}}
+    if _needs_response(route):
+        return {"id": sub_request.id, "status": 400, "body": {"detail": f"'{sub_request.path}' can not run in a batch"}}
+
+    path_values, path_errors = request_params_to_args(route.dependant.path_params, path_params)
+    query_values, query_errors = request_params_to_args(route.dependant.query_params, sub_request.params)
+    errors = path_errors + query_errors
+    if errors:
+        return {"id": sub_request.id, "status": 422, "body": {"detail": _error_details(errors)}}
+
+    async with semaphore:
+        try:
+            values = {**path_values, **query_values}
+            result = await run_in_threadpool(lambda: asyncio.run(_run_endpoint(route, values)))
+        except HTTPException as e:
+            return {"id": sub_request.id, "status": e.status_code, "body": {"detail": e.detail}}
+        except ValidationError as e:
+            # The endpoint returned what its response_model does not accept.
+            return {"id": sub_request.id, "status": 500, "body": {"detail": _error_details(e.raw_errors)}}
+        except Exception as e:
+            return {"id": sub_request.id, "status": 500, "body": {"detail": f"An error occurred: {str(e)}"}}
+    return {"id": sub_request.id, "status": 200, "body": jsonable_encoder(result)}
+
+
+async def execute(routes, sub_requests):
+    semaphore = asyncio.Semaphore(DB_POOL_SIZE)
+    return await asyncio.gather(*(
+        _execute_one(routes, sub_request, semaphore) for sub_request in sub_requests
+    ))
@@ -0,0 +1,265 @@
+"""Transactional outbox and change feed for transfers, withdrawals, loans and loan accrual runs.
+
+The bulk POST handlers insert one ``change_outbox`` row per created or updated
+row in the same transaction as the change itself. Consumers read the outbox in
+``event_id`` order from an opaque watermark, so they only receive what changed
+since their last call.
+
+Auto-increment ids are assigned at insert time but become visible at commit
+time, so an event can appear behind one that was already served. The feed
+only moves past ids that are settled (see ``settled_high_water``): it stops
+before the first event whose transaction is still open, however long that
+transaction takes, and serves it on a later call once it is committed.
+
+With sharding on every shard has its own outbox and the watermark holds one
+event id per shard. A transfer row read on the sender's shard has no
+``to_account_number`` when the receiver is on another shard; its
+``to_account_id`` is there for the caller to look it up.
+"""
+import asyncio
+import base64
+import binascii
+
+POLL_INTERVAL_SECONDS = 1.0
+
+CREATE_OUTBOX_QUERY = """
+CREATE TABLE IF NOT EXISTS change_outbox (
+    event_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    table_name VARCHAR(32) NOT NULL,
+    row_id BIGINT NOT NULL,
+    operation VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6),
+    KEY idx_outbox_table_event (table_name, event_id)
+)
+"""
+
+ROW_QUERIES = {
+    "transfers": """
+    SELECT t.transfer_id AS row_id, t.transfer_id, t.amount, t.transfer_date, t.transfer_method, t.status,
+        fa.account_number AS from_account_number, t.to_account_id, ta.account_number AS to_account_number
+    FROM transfers t
+    JOIN accounts fa ON t.from_account_id = fa.account_id
+    LEFT JOIN accounts ta ON t.to_account_id = ta.account_id
+    WHERE t.transfer_id IN ({ids})
+    """,
+    "withdrawals": """
+    SELECT w.withdrawal_id AS row_id, w.withdrawal_id, w.account_id, w.amount, w.withdrawal_date,
+        w.withdrawal_method, a.account_number
+    FROM withdrawals w
+    JOIN accounts a ON w.account_id = a.account_id
+    WHERE w.withdrawal_id IN ({ids})
+    """,
+    "loans": """
+    SELECT l.loan_id AS row_id, l.loan_id,
+        CONCAT(c.name, ' ', c.last_name) AS client_full_name, e.name AS employee_full_name,
+        l.amount, l.interest_rate, l.disbursement_date, l.due_date, l.balance, l.status
+    FROM loans l
+    JOIN clients c ON l.ID_client = c.id_client
+    JOIN employees e ON l.employee_id = e.employee_id
+    WHERE l.loan_id IN ({ids})
+    """,
+    # One event per nightly accrual run instead of one per accrued loan.
+    "loan_accruals": """
+    SELECT run_id AS row_id, run_id, run_date, accrued_loans, delinquent_loans, completed_at
+    FROM loan_accrual_runs
+    WHERE run_id IN ({ids})
+    """,
+}
+
+FEED_TABLES = tuple(ROW_QUERIES)
+
+_new_events = None
+
+
+class InvalidWatermark(ValueError):
+    pass
+
+
+def create_outbox_table(cursor):
+    cursor.execute(CREATE_OUTBOX_QUERY)
+
+
+def record_changes(cursor, table, row_ids, operation="insert"):
+    cursor.executemany(
+        "INSERT INTO change_outbox (table_name, row_id, operation) VALUES (%s, %s, %s)",
+        [(table, row_id, operation) for row_id in row_ids]
+    )
+
+
+def record_changes_from_query(cursor, table, row_id_query, params, operation="update"):
+    cursor.execute(
+        f"INSERT INTO change_outbox (table_name, row_id, operation) SELECT %s, row_id, %s FROM ({row_id_query}) changed",
+        (table, operation, *params)
+    )
+
+
+def encode_watermark(event_ids):
+    # v1 for a single outbox, v2 with one event id per shard.
+    if len(event_ids) == 1:
+        payload = f"v1:{event_ids[0]}"
+    else:
+        payload = "v2:" + ",".join(str(event_id) for event_id in event_ids)
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+
+def decode_watermark(watermark, shard_count=1):
+    """The event id to resume from on each of ``shard_count`` outboxes."""
+    if not watermark:
+        return [0] * shard_count
+    try:
+        decoded = base64.urlsafe_b64decode(watermark + "=" * (-len(watermark) % 4)).decode()
+        version, event_ids = decoded.split(":")
+        if version == "v1":
+            # Issued before sharding was turned on: the ids of every shard
+            # continue above it.
+            return [int(event_ids)] * shard_count
+        if version != "v2":
+            raise ValueError(version)
+        event_ids = [int(event_id) for event_id in event_ids.split(",")]
+        if len(event_ids) != shard_count:
+            raise ValueError(event_ids)
+        return event_ids
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidWatermark(f"Invalid watermark '{watermark}'")
+
+
+def _event():
+    global _new_events
+    if _new_events is None:
+        _new_events = asyncio.Event()
+    return _new_events
+
+
+def notify():
+    # Wakes the long-polling consumers of this worker; other workers find the
+    # events on their next poll.
+    global _new_events
+    _event().set()
+    _new_events = asyncio.Event()
+
+
+async def wait_for_events(timeout):
+    try:
+        await asyncio.wait_for(_event().wait(), min(timeout, POLL_INTERVAL_SECONDS))
+    except asyncio.TimeoutError:
+        pass
+
+
+def settled_high_water(connection, table, id_column, after_id, limit):
+    """Highest id after ``after_id`` up to which every row of ``table`` is settled.
+
+    Settled means committed, or rolled back for good: no open transaction can
+    still add a row with a lower id. Looks at most ``limit`` ids ahead and
+    returns ``after_id`` when the next id is still uncommitted. Ends the
+    current transaction of ``connection``.
+    """
+    cursor = connection.cursor()
+    try:
+        connection.rollback()
+        # The dirty read also sees the rows of transactions that are still open.
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        cursor.execute(
+            f"SELECT {id_column} FROM {table} WHERE {id_column} > %s ORDER BY {id_column} LIMIT %s",
+            (after_id, limit)
+        )
+        pending = [row[0] for row in cursor.fetchall()]
+        connection.rollback()
+        if not pending:
+            return after_id
+
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        cursor.execute(
+            f"SELECT {id_column} FROM {table} WHERE {id_column} > %s AND {id_column} <= %s",
+            (after_id, pending[-1])
+        )
+        committed = {row[0] for row in cursor.fetchall()}
+        connection.rollback()
+    finally:
+        cursor.close()
+
+    high_water = after_id
+    for row_id in pending:
+        if row_id not in committed:
+            # Still open, or rolled back since the first read: it disappears
+            # from the dirty read once its transaction ends either way.
+            break
+        high_water = row_id
+    return high_water
+
+
+def _settled_events(connection, tables, after_event_id, limit):
+    # (event_id, change) of the settled events after after_event_id, and the
+    # id the outbox is settled up to.
+    high_water = settled_high_water(connection, "change_outbox", "event_id", after_event_id, limit)
+    if high_water == after_event_id:
+        return [], after_event_id
+
+    cursor = connection.cursor(dictionary=True)
+    try:
+        placeholders = ", ".join(["%s"] * len(tables))
+        cursor.execute(f"""
+        SELECT event_id, table_name, row_id, operation
+        FROM change_outbox
+        WHERE event_id > %s AND event_id <= %s AND table_name IN ({placeholders})
+        ORDER BY event_id
+        """, (after_event_id, high_water, *tables))
+        events = cursor.fetchall()
+
+        rows_by_table = {}
+        for table in {event["table_name"] for event in events}:
+            row_ids = list({event["row_id"] for event in events if event["table_name"] == table})
+            cursor.execute(ROW_QUERIES[table].format(ids=", ".join(["%s"] * len(row_ids))), tuple(row_ids))
+            rows_by_table[table] = {row.pop("row_id"): row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+
+    return [
+        (event["event_id"], {
+            "table": event["table_name"],
+            "operation": event["operation"],
+            "id": event["row_id"],
+            "row": rows_by_table[event["table_name"]].get(event["row_id"])
+        })
+        for event in events
+    ], high_water
+
+
+def fetch_changes(connections, tables, after_event_ids, limit):
+    """The changes after ``after_event_ids``, the watermarks to resume from, and whether more are settled.
+
+    Each outbox (one per shard) is read from its own connection and event id;
+    at most ``limit`` changes are returned, in event id order.
+    """
+    events = []
+    high_waters = []
+    for shard, (connection, after_event_id) in enumerate(zip(connections, after_event_ids)):
+        shard_events, high_water = _settled_events(connection, tables, after_event_id, limit)
+        events.extend((event_id, shard, change) for event_id, change in shard_events)
+        high_waters.append(high_water)
+    events.sort(key=lambda event: event[0])
+
+    # The watermark of an outbox moves past the events of the other tables as
+    # well, unless some of its events were left for the next call.
+    watermarks = list(high_waters)
+    for shard, after_event_id in enumerate(after_event_ids):
+        if any(event_shard == shard for _, event_shard, _ in events[limit:]):
+            watermarks[shard] = max((event_id for event_id, event_shard, _ in events[:limit] if event_shard == shard),
+                                    default=after_event_id)
+    has_more = len(events) > limit or any(
+        settled_high_water(connection, "change_outbox", "event_id", watermark, 1) > watermark
+        for connection, watermark in zip(connections, watermarks)
+    )
+    return [change for _, _, change in events[:limit]], watermarks, has_more
+
+if __name__ == "__main__":
+    from conexion import get_db_connection
+
+    connection = get_db_connection()
+    if not connection:
+        raise SystemExit("Database connection failed")
+    cursor = connection.cursor()
+    create_outbox_table(cursor)
+    connection.commit()
+    cursor.close()
+    connection.close()
+    print("change_outbox table ready")
@@ -0,0 +1,492 @@
+"""In-process search index over client names, emails and identification numbers.
+
+Every client is split into tokens: the words of its name and last name, the
+words of the local part of its email, the whole email, and its identification
+number without separators. Text is lowercased and stripped of accents, so
+"Peña" is found by "pena".
+
+A query matches a client when each of its terms matches one of the client's
+tokens, either as a prefix or, for name words, by trigram similarity (typos
+such as "gonzales" for "gonzalez"). The vocabulary is kept in sorted chunks as
+in ``balance_index`` so prefix lookups are binary searches, name words have a
+trigram index for the fuzzy matches, and each token points to the ids of its
+clients. Results are ranked by how well each term matched: exact token, then
+prefix, then fuzzy.
+
+Postings are kept sorted by id, so the clients of the most selective term are
+walked in rank order (best score first, then lowest id, as results are
+ordered) and each one is checked against the other terms on its own tokens.
+The walk stops as soon as ``limit`` results can no longer be beaten, so a
+common name costs about ``limit`` clients rather than all of its postings.
+When the other terms are expected to reject so many of those clients that the
+walk would cost more than scanning their postings, or do so during the walk,
+the postings are intersected instead.
+
+    python client_search.py --bench 1000000
+
+builds an index of that many synthetic clients, without a database, and
+prints its size and the time of common-name, prefix, typo and rare queries.
+
+Each worker process owns its own index: it is loaded at startup and kept up to
+date by ``create_clients_bulk`` of that worker. ``refresh`` brings in the
+clients the other workers created, past the id settled at the previous load
+or refresh (see ``changefeed.settled_high_water``).
+"""
+import argparse
+import heapq
+import random
+import re
+import sys
+import threading
+import time
+import unicodedata
+from array import array
+from bisect import bisect_left, insort
+
+import changefeed
+
+CHUNK_SIZE = 1000
+LOAD_BATCH_SIZE = 50000
+
+CLIENTS_QUERY = "SELECT id_client, name, last_name, email, identification_number FROM clients"
+
+# Tokens a single term may expand to; one-letter prefixes only see the first ones.
+MAX_EXPANSIONS = 50
+FUZZY_MIN_LENGTH = 3
+FUZZY_THRESHOLD = 0.4
+
+EXACT_SCORE = 3.0
+PREFIX_SCORE = 1.0
+
+# Checking one client's tokens costs about as much as scanning this many posting entries.
+CANDIDATE_COST = 150
+# Clients walked before the share matching the other terms is trusted to predict the rest of the walk.
+WALK_PROBE = 50
+
+_WORD = re.compile(r"[0-9a-z]+")
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKD", text or "")
+    return "".join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+
+def _trigrams(token):
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def client_tokens(name, last_name, email, identification_number):
+    """``{token: fuzzy}`` of one client; only name words are matched fuzzily."""
+    tokens = {word: True for word in _WORD.findall(normalize(f"{name} {last_name}"))}
+    email = normalize(email).strip()
+    if email:
+        for word in _WORD.findall(email.split("@")[0]):
+            tokens.setdefault(word, False)
+        tokens.setdefault(email, False)
+    identification = "".join(_WORD.findall(normalize(identification_number)))
+    if identification:
+        tokens.setdefault(identification, False)
+    return tokens
+
+
+def _settled(connection, after_id):
+    while True:
+        high_water = changefeed.settled_high_water(connection, "clients", "id_client", after_id, LOAD_BATCH_SIZE)
+        if high_water == after_id:
+            return high_water
+        after_id = high_water
+
+
+def query_terms(q):
+    terms = []
+    for part in normalize(q).split():
+        # An email is looked up whole, anything else by its words.
+        terms.extend([part] if "@" in part else _WORD.findall(part))
+    return terms
+
+
+class ClientSearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._token_ids = {}
+        self._tokens = []
+        self._postings = []
+        self._trigrams = {}
+        self._fuzzy_tokens = set()
+        self._chunks = []
+        self._maxes = []
+        self._high_water = 0
+        self.loaded = False
+
+    def __len__(self):
+        return len(self._clients)
+
+    def load(self, connection):
+        """Rebuild the index from the clients table (clients are on every shard, one connection is enough)."""
+        # Taken before the rows: a refresh reads again whatever settles after
+        # it, so nothing committed meanwhile is missed.
+        high_water = _settled(connection, 0)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(CLIENTS_QUERY)
+            self._build(iter(lambda: cursor.fetchmany(LOAD_BATCH_SIZE), []), high_water)
+        finally:
+            cursor.close()
+
+    def _build(self, batches, high_water):
+        fresh = ClientSearchIndex()
+        tokens = set()
+        for rows in batches:
+            for row in rows:
+                tokens.update(fresh._add_client(row, insert_sorted=False))
+        # Rows come in primary key order in practice, but nothing guarantees it.
+        for i, posting in enumerate(fresh._postings):
+            if any(posting[j] > posting[j + 1] for j in range(len(posting) - 1)):
+                fresh._postings[i] = array("q", sorted(posting))
+
+        keys = sorted(tokens)
+        fresh._chunks = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        fresh._maxes = [chunk[-1] for chunk in fresh._chunks]
+        with self._lock:
+            self._clients = fresh._clients
+            self._token_ids = fresh._token_ids
+            self._tokens = fresh._tokens
+            self._postings = fresh._postings
+            self._trigrams = fresh._trigrams
+            self._fuzzy_tokens = fresh._fuzzy_tokens
+            self._chunks = fresh._chunks
+            self._maxes = fresh._maxes
+            self._high_water = high_water
+            self.loaded = True
+
+    def refresh(self, connection):
+        """Index the clients settled since the last load or refresh; returns how many were read."""
+        with self._lock:
+            after_id = self._high_water
+        refreshed = 0
+        cursor = connection.cursor()
+        try:
+            while True:
+                high_water = changefeed.settled_high_water(connection, "clients", "id_client", after_id, LOAD_BATCH_SIZE)
+                if high_water == after_id:
+                    break
+                cursor.execute(f"{CLIENTS_QUERY} WHERE id_client > %s AND id_client <= %s", (after_id, high_water))
+                rows = cursor.fetchall()
+                # The clients this worker created are indexed already and skipped.
+                self.add_clients(rows)
+                refreshed += len(rows)
+                after_id = high_water
+                with self._lock:
+                    self._high_water = max(self._high_water, high_water)
+        finally:
+            cursor.close()
+        return refreshed
+
+    def add_clients(self, clients):
+        """Index new clients given as ``(id_client, name, last_name, email, identification_number)``."""
+        with self._lock:
+            for client in clients:
+                self._add_client(client, insert_sorted=True)
+
+    def _add_client(self, client, insert_sorted):
+        id_client, name, last_name, email, identification_number = client
+        if id_client in self._clients:
+            return []
+        self._clients[id_client] = (name, last_name, email, identification_number)
+        new_tokens = []
+        for token, fuzzy in client_tokens(name, last_name, email, identification_number).items():
+            token_id = self._token_ids.get(token)
+            if token_id is None:
+                token_id = len(self._tokens)
+                self._token_ids[token] = token_id
+                self._tokens.append(token)
+                self._postings.append(array("q"))
+                new_tokens.append(token)
+                if insert_sorted:
+                    self._insert(token)
+            if fuzzy and token_id not in self._fuzzy_tokens:
+                self._fuzzy_tokens.add(token_id)
+                for trigram in _trigrams(token):
+                    self._trigrams.setdefault(trigram, array("q")).append(token_id)
+            posting = self._postings[token_id]
+            if insert_sorted and posting and id_client < posting[-1]:
+                # A refresh brings in clients older than the ones this worker created.
+                posting.insert(bisect_left(posting, id_client), id_client)
+            else:
+                posting.append(id_client)
+        return new_tokens
+
+    def _insert(self, token):
+        if not self._chunks:
+            self._chunks.append([token])
+            self._maxes.append(token)
+            return
+        i = bisect_left(self._maxes, token)
+        if i == len(self._chunks):
+            i -= 1
+        chunk = self._chunks[i]
+        insort(chunk, token)
+        self._maxes[i] = chunk[-1]
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def _prefix_matches(self, term):
+        matches = {}
+        i = bisect_left(self._maxes, term)
+        while i < len(self._chunks) and len(matches) < MAX_EXPANSIONS:
+            chunk = self._chunks[i]
+            for token in chunk[bisect_left(chunk, term):]:
+                if not token.startswith(term) or len(matches) >= MAX_EXPANSIONS:
+                    return matches
+                score = EXACT_SCORE if token == term else PREFIX_SCORE + len(term) / len(token)
+                matches[self._token_ids[token]] = score
+            i += 1
+        return matches
+
+    def _fuzzy_matches(self, term):
+        if len(term) < FUZZY_MIN_LENGTH or not term.isalpha():
+            return {}
+        term_trigrams = _trigrams(term)
+        shared = {}
+        for trigram in term_trigrams:
+            for token_id in self._trigrams.get(trigram, ()):
+                shared[token_id] = shared.get(token_id, 0) + 1
+        matches = {}
+        for token_id, count in shared.items():
+            # Similarity of the trigram sets: shared / union.
+            similarity = count / (len(term_trigrams) + len(_trigrams(self._tokens[token_id])) - count)
+            if similarity >= FUZZY_THRESHOLD:
+                matches[token_id] = similarity
+        return dict(heapq.nlargest(MAX_EXPANSIONS, matches.items(), key=lambda item: item[1]))
+
+    def _term_matches(self, term):
+        matches = self._fuzzy_matches(term)
+        matches.update(self._prefix_matches(term))
+        return matches
+
+    def _ranked_ids(self, matches):
+        """Ids of the clients of one term by decreasing score, then increasing id, with that score."""
+        by_score = {}
+        for token_id, score in matches.items():
+            by_score.setdefault(score, []).append(self._postings[token_id])
+        seen = set()
+        for score in sorted(by_score, reverse=True):
+            previous = None
+            for id_client in heapq.merge(*by_score[score]):
+                if id_client != previous and id_client not in seen:
+                    yield id_client, score
+                previous = id_client
+            # A client is ranked by the best of its tokens.
+            seen.update(id_client for posting in by_score[score] for id_client in posting)
+
+    @staticmethod
+    def _other_scores(tokens, other_terms):
+        total = 0
+        for matches in other_terms:
+            term_score = max((matches[token] for token in tokens if token in matches), default=0)
+            if not term_score:
+                return None
+            total += term_score
+        return total
+
+    def _walk(self, term_matches, limit, budget):
+        """Scores of the best clients, walking the first term in rank order.
+
+        None once more than ``budget`` clients are walked, or as soon as the
+        share of them matching the other terms says that many would be.
+        """
+        other_terms = [
+            {self._tokens[token_id]: score for token_id, score in matches.items()} for matches in term_matches[1:]
+        ]
+        best_others = sum(max(matches.values()) for matches in other_terms)
+        scores = {}
+        # The ``limit`` best results so far as (score, -id), the last of them first.
+        top = []
+        walked = 0
+        for id_client, score in self._ranked_ids(term_matches[0]):
+            if len(top) == limit:
+                # No client left scores more than this, and ties go to the lower id.
+                last_score, last_id = top[0][0], -top[0][1]
+                bound = score + best_others
+                if last_score > bound or (last_score == bound and last_id < id_client):
+                    break
+            walked += 1
+            if walked > budget or (walked > WALK_PROBE and len(scores) * budget < limit * walked):
+                return None
+            others = self._other_scores(client_tokens(*self._clients[id_client]), other_terms) if other_terms else 0
+            if others is None:
+                continue
+            scores[id_client] = score + others
+            if len(top) < limit:
+                heapq.heappush(top, (score + others, -id_client))
+            elif (score + others, -id_client) > top[0]:
+                heapq.heapreplace(top, (score + others, -id_client))
+        return scores
+
+    def _intersect(self, term_matches):
+        """Scores of every client matching all the terms, from their postings."""
+        scores = None
+        for matches in term_matches:
+            term_scores = {}
+            for token_id, score in matches.items():
+                for id_client in self._postings[token_id]:
+                    if (scores is None or id_client in scores) and score > term_scores.get(id_client, 0):
+                        term_scores[id_client] = score
+            scores = {
+                id_client: score + (scores[id_client] if scores is not None else 0)
+                for id_client, score in term_scores.items()
+            }
+            if not scores:
+                break
+        return scores
+
+    def search(self, q, limit=10, early_stop=True):
+        terms = query_terms(q)
+        if not terms:
+            return []
+        with self._lock:
+            term_matches = [self._term_matches(term) for term in terms]
+            if not all(term_matches):
+                return []
+            # Start from the term with the fewest clients and narrow down.
+            costs = sorted(
+                (sum(len(self._postings[token_id]) for token_id in matches), i) for i, matches in enumerate(term_matches)
+            )
+            term_matches = [term_matches[i] for _, i in costs]
+            scores = None
+            if early_stop and len(costs) == 1:
+                # A single term checks no tokens, so its walk never costs more than its postings.
+                scores = self._walk(term_matches, limit, costs[0][0])
+            elif early_stop:
+                # About one walked client in this many matches the other terms, if they are independent.
+                expected_walk = limit
+                for cost, _ in costs[1:]:
+                    expected_walk *= len(self._clients) / max(min(cost, len(self._clients)), 1)
+                budget = sum(cost for cost, _ in costs[1:]) // CANDIDATE_COST
+                if expected_walk <= budget:
+                    scores = self._walk(term_matches, limit, budget)
+            if scores is None:
+                scores = self._intersect(term_matches)
+
+            best = heapq.nsmallest(limit, scores.items(), key=lambda item: (-item[1], item[0]))
+            results = []
+            for id_client, score in best:
+                name, last_name, email, identification_number = self._clients[id_client]
+                results.append({
+                    "id_client": id_client,
+                    "name": name,
+                    "last_name": last_name,
+                    "email": email,
+                    "identification_number": identification_number,
+                    "score": round(score, 3)
+                })
+            return results
+
+    def stats(self):
+        """Sizes of the index and an estimate of its memory footprint in bytes."""
+        with self._lock:
+            clients_bytes = sys.getsizeof(self._clients) + sum(
+                sys.getsizeof(record) + sum(sys.getsizeof(value) for value in record)
+                for record in self._clients.values()
+            )
+            vocabulary_bytes = (
+                sys.getsizeof(self._token_ids) + sys.getsizeof(self._tokens)
+                + sum(sys.getsizeof(token) for token in self._tokens)
+                + sys.getsizeof(self._chunks) + sum(sys.getsizeof(chunk) for chunk in self._chunks)
+            )
+            postings_bytes = sys.getsizeof(self._postings) + sum(sys.getsizeof(posting) for posting in self._postings)
+            trigram_bytes = sys.getsizeof(self._trigrams) + sum(
+                sys.getsizeof(trigram) + sys.getsizeof(token_ids) for trigram, token_ids in self._trigrams.items()
+            )
+            return {
+                "loaded": self.loaded,
+                "clients": len(self._clients),
+                "tokens": len(self._tokens),
+                "trigrams": len(self._trigrams),
+                "postings": sum(len(posting) for posting in self._postings),
+                "memory_bytes": {
+                    "clients": clients_bytes,
+                    "vocabulary": vocabulary_bytes,
+                    "postings": postings_bytes,
+                    "trigrams": trigram_bytes,
+                    "total": clients_bytes + vocabulary_bytes + postings_bytes + trigram_bytes
+                }
+            }
+
+
+client_search = ClientSearchIndex()
+
+
+BENCH_FIRST_NAMES = [
+    "maria", "jose", "juan", "ana", "luis", "carlos", "carmen", "jorge", "laura", "pedro", "sofia", "miguel",
+    "lucia", "javier", "elena", "diego", "marta", "pablo", "isabel", "andres", "paula", "fernando", "rosa", "raul",
+]
+BENCH_LAST_NAMES = [
+    "garcia", "rodriguez", "gonzalez", "fernandez", "lopez", "martinez", "sanchez", "perez", "gomez", "martin",
+    "jimenez", "ruiz", "hernandez", "diaz", "moreno", "alvarez", "munoz", "romero", "alonso", "gutierrez",
+    "navarro", "torres", "dominguez", "vazquez", "ramos", "gil", "ramirez", "serrano", "blanco", "molina",
+]
+
+
+def _synthetic_clients(count, generator):
+    # Names follow a Zipf-like law, so the first ones are very common.
+    first_weights = [1 / (rank + 1) for rank in range(len(BENCH_FIRST_NAMES))]
+    last_weights = [1 / (rank + 1) for rank in range(len(BENCH_LAST_NAMES))]
+    for start in range(1, count + 1, LOAD_BATCH_SIZE):
+        ids = range(start, min(start + LOAD_BATCH_SIZE, count + 1))
+        first_names = generator.choices(BENCH_FIRST_NAMES, first_weights, k=len(ids))
+        last_names = generator.choices(BENCH_LAST_NAMES, last_weights, k=len(ids))
+        yield [
+            (id_client, first.capitalize(), last.capitalize(), f"{first}.{last}{id_client}@example.com", f"{id_client:010d}")
+            for id_client, first, last in zip(ids, first_names, last_names)
+        ]
+
+
+def _percentile_ms(timings, fraction):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * fraction))] * 1000
+
+
+def bench(clients, queries, seed=1):
+    generator = random.Random(seed)
+    index = ClientSearchIndex()
+    started = time.perf_counter()
+    index._build(_synthetic_clients(clients, generator), 0)
+    stats = index.stats()
+    print(f"load: {clients} clients, {stats['tokens']} tokens in {time.perf_counter() - started:.1f}s, "
+          f"~{stats['memory_bytes']['total'] / 2 ** 20:.0f} MiB estimated")
+
+    kinds = {
+        "common name": lambda: BENCH_FIRST_NAMES[generator.randrange(3)],
+        "common full name": lambda: f"{BENCH_FIRST_NAMES[generator.randrange(3)]} {BENCH_LAST_NAMES[generator.randrange(3)]}",
+        "rare full name": lambda: f"{BENCH_FIRST_NAMES[-1 - generator.randrange(3)]} {BENCH_LAST_NAMES[-1 - generator.randrange(3)]}",
+        "prefix": lambda: BENCH_FIRST_NAMES[generator.randrange(len(BENCH_FIRST_NAMES))][:3],
+        "typo": lambda: BENCH_LAST_NAMES[generator.randrange(3)].replace("z", "s").replace("c", "k"),
+        "identification": lambda: f"{generator.randint(1, clients):010d}",
+    }
+    for kind, make_query in kinds.items():
+        timings = {True: [], False: []}
+        for _ in range(queries):
+            q = make_query()
+            for early_stop in (True, False):
+                started = time.perf_counter()
+                index.search(q, 10, early_stop=early_stop)
+                timings[early_stop].append(time.perf_counter() - started)
+        print(f"{kind}: p50 {_percentile_ms(timings[True], 0.5):.2f} ms, p95 {_percentile_ms(timings[True], 0.95):.2f} ms "
+              f"(scanning every posting: p50 {_percentile_ms(timings[False], 0.5):.2f} ms, "
+              f"p95 {_percentile_ms(timings[False], 0.95):.2f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Client search benchmark on synthetic clients")
+    parser.add_argument("--bench", type=int, required=True, metavar="CLIENTS", help="synthetic clients to index")
+    parser.add_argument("--queries", type=int, default=200, help="queries of each kind")
+    args = parser.parse_args()
+    bench(args.bench, args.queries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+"""Negotiated compression of the API responses.
+
+``CompressionMiddleware`` compresses JSON and text responses with the best
+encoding the client accepts: zstd, then br, then gzip. ``zstandard`` and
+``brotli`` are optional packages; without them only gzip is offered.
+
+Bodies shorter than ``COMPRESSION_MIN_SIZE`` bytes are sent as they are. A
+streamed response is compressed chunk by chunk and every chunk is flushed, so
+the client can decode the rows received so far while the rest is still being
+read from the database. Chunks of at
+least ``COMPRESSION_THREADPOOL_MIN_SIZE`` bytes are compressed on a worker
+thread, and the event loop keeps serving other requests meanwhile. The
+levels come from ``COMPRESSION_LEVELS`` (JSON ``{encoding: level}`` merged
+over ``DEFAULT_COMPRESSION_LEVELS``).
+
+    python compression.py --url http://127.0.0.1:8000 /transfers /loans   # bytes and latency per encoding
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import statistics
+import time
+import zlib
+from urllib.parse import urlsplit
+
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+COMPRESSION_LEVELS = dict(DEFAULT_COMPRESSION_LEVELS, **json.loads(os.getenv("COMPRESSION_LEVELS") or "{}"))
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSION_THREADPOOL_MIN_SIZE = int(os.getenv("COMPRESSION_THREADPOOL_MIN_SIZE", "65536"))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+
+class _GzipCompressor:
+    def __init__(self, level):
+        # wbits 31: deflate with a gzip header and trailer.
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data, final):
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class _BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data, final):
+        return self._compressor.process(data) + (self._compressor.finish() if final else self._compressor.flush())
+
+
+class _ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data, final):
+        flush = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self._compressor.compress(data) + self._compressor.flush(flush)
+
+
+# In order of preference.
+COMPRESSORS = {
+    encoding: compressor
+    for encoding, compressor, module in (
+        ("zstd", _ZstdCompressor, zstandard),
+        ("br", _BrotliCompressor, brotli),
+        ("gzip", _GzipCompressor, zlib),
+    )
+    if module is not None
+}
+
+
+def negotiate(accept_encoding):
+    """Encoding to answer an ``Accept-Encoding`` header with, or None for an uncompressed body."""
+    weights = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding] = q
+
+    best, best_q = None, 0.0
+    for encoding in COMPRESSORS:
+        q = weights.get(encoding, weights.get("*", 0.0))
+        # Ties go to the preferred encoding.
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class _CompressingSend:
+    def __init__(self, send, encoding, level, minimum_size):
+        self._send = send
+        self._encoding = encoding
+        self._level = level
+        self._minimum_size = minimum_size
+        self._start = None
+        self._pending = []
+        self._compressor = None
+
+    def _compressible(self, start, headers, size):
+        if start["status"] in (204, 304) or "content-encoding" in headers:
+            return False
+        if not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            return False
+        return size >= self._minimum_size
+
+    async def _compress(self, body, final):
+        if len(body) >= COMPRESSION_THREADPOOL_MIN_SIZE:
+            return await run_in_threadpool(self._compressor.compress, body, final)
+        return self._compressor.compress(body, final)
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            self._start = message
+            return
+        if message["type"] != "http.response.body" or (self._start is None and self._compressor is None):
+            await self._send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self._start is not None:
+            # The start is held until the body is known to reach the minimum
+            # size or to end; the http middlewares send every body in chunks.
+            self._pending.append(body)
+            size = sum(len(chunk) for chunk in self._pending)
+            if more_body and size < self._minimum_size:
+                return
+            start, self._start = self._start, None
+            body, self._pending = b"".join(self._pending), None
+            headers = MutableHeaders(raw=start["headers"])
+            if not self._compressible(start, headers, size):
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body, "more_body": more_body})
+                return
+            self._compressor = COMPRESSORS[self._encoding](self._level)
+            headers["Content-Encoding"] = self._encoding
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                body = await self._compress(body, True)
+                headers["Content-Length"] = str(len(body))
+                await self._send(start)
+                await self._send({"type": "http.response.body", "body": body, "more_body": False})
+                return
+            if "content-length" in headers:
+                del headers["Content-Length"]
+            await self._send(start)
+
+        if more_body and not body:
+            return
+        await self._send({"type": "http.response.body", "body": await self._compress(body, not more_body),
+                          "more_body": more_body})
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE, levels=None):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = dict(COMPRESSION_LEVELS, **(levels or {}))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await self.app(scope, receive, _CompressingSend(send, encoding, self.levels[encoding], self.minimum_size))
+
+
+def _decompress(encoding, data):
+    if encoding == "gzip":
+        return gzip.decompress(data)
+    if encoding == "br":
+        return brotli.decompress(data)
+    if encoding == "zstd":
+        # Streamed frames do not carry their size, so not ZstdDecompressor().decompress.
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def benchmark(url, path, iterations):
+    """Body bytes, time to first byte and end-to-end time (decoding included) of ``path`` per encoding."""
+    parts = urlsplit(url)
+    results = {}
+    for encoding in ("identity", *COMPRESSORS):
+        sizes, first_bytes, totals = [], [], []
+        for _ in range(iterations):
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+            try:
+                started = time.perf_counter()
+                connection.request("GET", path, headers={"Accept-Encoding": encoding})
+                response = connection.getresponse()
+                first_bytes.append(time.perf_counter() - started)
+                data = response.read()
+                _decompress(response.getheader("Content-Encoding", "identity"), data)
+                totals.append(time.perf_counter() - started)
+                sizes.append(len(data))
+            finally:
+                connection.close()
+        results[encoding] = {
+            "bytes": int(statistics.mean(sizes)),
+            "first_byte_ms": statistics.mean(first_bytes) * 1000,
+            "mean_ms": statistics.mean(totals) * 1000,
+            "p95_ms": sorted(totals)[int(len(totals) * 0.95)] * 1000,
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes on the wire and latency per response encoding")
+    parser.add_argument("paths", nargs="*", default=["/transfers", "/withdrawals", "/loans", "/clients_by_employee"])
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="base URL of a running API")
+    parser.add_argument("--iterations", type=int, default=5, help="requests per path and encoding")
+    args = parser.parse_args()
+
+    for path in args.paths:
+        results = benchmark(args.url, path, args.iterations)
+        identity_bytes = results["identity"]["bytes"] or 1
+        for encoding, result in results.items():
+            print(f"{path:<22} {encoding:<9} {result['bytes']:>11} bytes ({result['bytes'] / identity_bytes:6.1%})"
+                  f"  first byte {result['first_byte_ms']:8.1f} ms  mean {result['mean_ms']:8.1f} ms"
+                  f"  p95 {result['p95_ms']:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 import os
+import threading
+import time
 import mysql.connector
-from mysql.connector import Error
+from mysql.connector import Error, pooling
+from mysql.connector.errors import PoolError
 from dotenv import load_dotenv
+from profiling import current_profile
+from query_guard import current_guard
+from prepared_statements import PREPARED_STATEMENT_CACHE_SIZE, wrap_connection
 
 load_dotenv()
 
@@ -12,10 +18,57 @@ DB_CONFIG = {
     'database': os.getenv('DB_NAME'),
 }
 
-def get_db_connection():
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+
+_pools = {}
+_pool_lock = threading.Lock()
+
+def get_connection_pool(name="financial", config=None):
+    with _pool_lock:
+        if name not in _pools:
+            # Resetting the session would drop the prepared statements of its connection.
+            _pools[name] = pooling.MySQLConnectionPool(pool_name=name, pool_size=DB_POOL_SIZE,
+                                                       pool_reset_session=not PREPARED_STATEMENT_CACHE_SIZE,
+                                                       **(config or DB_CONFIG))
+        return _pools[name]
+
+def _open_connection(name, config):
+    # Pooled connections go back to the pool on close(). When every pooled
+    # connection is busy a dedicated one is opened instead of failing.
     try:
-        connection = mysql.connector.connect(**DB_CONFIG)
-        return connection
+        return wrap_connection(get_connection_pool(name, config).get_connection())
+    except PoolError:
+        pass
     except Error as e:
         print(f"Error conectando a MySQL: {e}")
         return None
+    try:
+        connection = mysql.connector.connect(**config)
+        return wrap_connection(connection)
+    except Error as e:
+        print(f"Error conectando a MySQL: {e}")
+        return None
+
+def open_connection(name="financial", config=None):
+    config = config or DB_CONFIG
+    profile = current_profile()
+    guard = current_guard()
+    if profile is None and guard is None:
+        return _open_connection(name, config)
+    started = time.perf_counter()
+    connection = _open_connection(name, config)
+    if profile is not None:
+        profile.add("connect", started)
+    if connection and guard is not None:
+        try:
+            connection = guard.wrap_connection(connection, config)
+        except Error as e:
+            print(f"Error conectando a MySQL: {e}")
+            connection.close()
+            return None
+    if connection and profile is not None:
+        connection = profile.wrap_connection(connection)
+    return connection
+
+def get_db_connection():
+    return open_connection()
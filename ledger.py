@@ -0,0 +1,411 @@
+"""Append-only double-entry ledger with periodic balance snapshots.
+
+The balance of an account is its latest snapshot plus every ledger entry the
+snapshot does not cover. A snapshot covers the entries with
+``entry_date <= snapshot_date`` and ``entry_id <= last_entry_id``, so entries
+appended with a back-dated date are still picked up until the next compaction.
+
+Run ``python ledger.py --init`` once to create the tables and seed opening
+snapshots from ``accounts.balance``, and ``python ledger.py`` periodically to
+compact entries into new snapshots.
+
+``python ledger.py --bench 16 --account-number <number>`` measures the
+contention on one account: every thread runs the withdrawal transaction of
+the bulk handler (lock, balance, insert, ledger entries) on that account for
+``--seconds`` and rolls it back, then the throughput, the time spent waiting
+for the account lock and InnoDB's row lock counters are printed.
+"""
+import argparse
+import threading
+import time
+from datetime import date, timedelta
+
+from conexion import get_db_connection
+from money import to_cents, to_decimal
+
+OPENING_SNAPSHOT_DATE = date(1970, 1, 1)
+
+CREATE_TABLE_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS ledger_entries (
+        entry_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        account_id INT NULL,
+        amount DECIMAL(15, 2) NOT NULL,
+        entry_date DATE NOT NULL,
+        entry_type VARCHAR(20) NOT NULL,
+        reference_id BIGINT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        KEY idx_ledger_account_date (account_id, entry_date),
+        KEY idx_ledger_reference (entry_type, reference_id),
+        KEY idx_ledger_created (created_at)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS balance_snapshots (
+        snapshot_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        account_id INT NOT NULL,
+        snapshot_date DATE NOT NULL,
+        last_entry_id BIGINT NOT NULL,
+        balance DECIMAL(15, 2) NOT NULL,
+        KEY idx_snapshots_account_date (account_id, snapshot_date)
+    )
+    """,
+]
+
+INSERT_ENTRY_QUERY = """
+INSERT INTO ledger_entries (account_id, amount, entry_date, entry_type, reference_id)
+VALUES (%s, %s, %s, %s, %s)
+"""
+
+INSERT_SNAPSHOT_QUERY = """
+INSERT INTO balance_snapshots (account_id, snapshot_date, last_entry_id, balance)
+VALUES (%s, %s, %s, %s)
+"""
+
+# Latest snapshot of every account plus the entries it does not cover yet.
+CURRENT_BALANCES_QUERY = """
+SELECT s.account_id, s.balance + COALESCE(SUM(e.amount), 0) AS balance
+FROM balance_snapshots s
+JOIN (
+    SELECT account_id, MAX(snapshot_id) AS snapshot_id
+    FROM balance_snapshots
+    {where}
+    GROUP BY account_id
+) latest ON latest.snapshot_id = s.snapshot_id
+LEFT JOIN ledger_entries e ON e.account_id = s.account_id
+    AND (e.entry_date > s.snapshot_date OR e.entry_id > s.last_entry_id)
+GROUP BY s.account_id, s.balance
+"""
+
+# Every account with its ledger balance, for queries that filter or list by
+# balance; ``accounts.balance`` is only refreshed by ``compact``.
+ACCOUNT_BALANCES_QUERY = """
+SELECT a.account_id, a.id_client, a.account_number, COALESCE(b.balance, a.balance) AS balance
+FROM accounts a
+LEFT JOIN ({current}) b ON b.account_id = a.account_id
+""".format(current=CURRENT_BALANCES_QUERY.format(where=""))
+
+LOCK_ACCOUNTS_QUERY = """
+SELECT account_id
+FROM accounts
+WHERE account_id IN ({placeholders})
+ORDER BY account_id
+FOR UPDATE
+"""
+
+LOCK_CHUNK_SIZE = 1000
+
+
+def create_ledger_tables(cursor):
+    for query in CREATE_TABLE_QUERIES:
+        cursor.execute(query)
+    # Ledgers created before the velocity limits were warmed from arrival times.
+    cursor.execute("""
+    SELECT COUNT(*) FROM information_schema.STATISTICS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'ledger_entries' AND INDEX_NAME = 'idx_ledger_created'
+    """)
+    if not cursor.fetchone()[0]:
+        cursor.execute("ALTER TABLE ledger_entries ADD KEY idx_ledger_created (created_at)")
+
+
+def seed_snapshots(cursor):
+    # Opening snapshot for every account that is not on the ledger yet.
+    cursor.execute("""
+    INSERT INTO balance_snapshots (account_id, snapshot_date, last_entry_id, balance)
+    SELECT a.account_id, %s, 0, a.balance
+    FROM accounts a
+    LEFT JOIN balance_snapshots s ON s.account_id = a.account_id
+    WHERE s.snapshot_id IS NULL
+    """, (OPENING_SNAPSHOT_DATE,))
+    return cursor.rowcount
+
+
+def open_accounts(cursor, opening_balances):
+    cursor.executemany(INSERT_SNAPSHOT_QUERY, [
+        (account_id, OPENING_SNAPSHOT_DATE, 0, balance)
+        for account_id, balance in opening_balances
+    ])
+
+
+def append_withdrawal_entries(cursor, withdrawals):
+    # The counter entry has no account: the money leaves the bank as cash.
+    entries = []
+    for withdrawal_id, account_id, amount, withdrawal_date in withdrawals:
+        entries.append((account_id, -amount, withdrawal_date, "withdrawal", withdrawal_id))
+        entries.append((None, amount, withdrawal_date, "withdrawal", withdrawal_id))
+    cursor.executemany(INSERT_ENTRY_QUERY, entries)
+
+
+def transfer_entries(transfers):
+    entries = []
+    for transfer_id, from_account_id, to_account_id, amount, transfer_date in transfers:
+        entries.append((from_account_id, -amount, transfer_date, "transfer", transfer_id))
+        entries.append((to_account_id, amount, transfer_date, "transfer", transfer_id))
+    return entries
+
+
+def append_entries(cursor, entries):
+    cursor.executemany(INSERT_ENTRY_QUERY, entries)
+
+
+def append_transfer_entries(cursor, transfers):
+    append_entries(cursor, transfer_entries(transfers))
+
+
+def lock_accounts(cursor, account_ids):
+    """Lock the account rows until the transaction ends, in id order so concurrent batches do not deadlock.
+
+    Run it before the first plain SELECT of the transaction: the balances read
+    after it then include every batch that held the locks before.
+    """
+    account_ids = sorted(set(account_ids))
+    for i in range(0, len(account_ids), LOCK_CHUNK_SIZE):
+        chunk = account_ids[i:i + LOCK_CHUNK_SIZE]
+        cursor.execute(LOCK_ACCOUNTS_QUERY.format(placeholders=", ".join(["%s"] * len(chunk))), tuple(chunk))
+        cursor.fetchall()
+
+
+def _row_value(row, key, index):
+    return row[key] if isinstance(row, dict) else row[index]
+
+
+def current_balances(cursor, account_ids=None):
+    """``{account_id: balance in cents}`` from the latest snapshots and the entries after them."""
+    params = ()
+    where = ""
+    if account_ids is not None:
+        account_ids = list(account_ids)
+        if not account_ids:
+            return {}
+        where = "WHERE account_id IN ({})".format(", ".join(["%s"] * len(account_ids)))
+        params = tuple(account_ids)
+    cursor.execute(CURRENT_BALANCES_QUERY.format(where=where), params)
+    return {
+        _row_value(row, "account_id", 0): to_cents(_row_value(row, "balance", 1))
+        for row in cursor.fetchall()
+    }
+
+
+def balance_as_of(cursor, account_id, as_of_date):
+    cursor.execute("""
+    SELECT snapshot_date, last_entry_id, balance
+    FROM balance_snapshots
+    WHERE account_id = %s AND snapshot_date <= %s
+    ORDER BY snapshot_date DESC, snapshot_id DESC
+    LIMIT 1
+    """, (account_id, as_of_date))
+    snapshot = cursor.fetchone()
+    if not snapshot:
+        return None
+    snapshot_date = _row_value(snapshot, "snapshot_date", 0)
+    last_entry_id = _row_value(snapshot, "last_entry_id", 1)
+    snapshot_balance = _row_value(snapshot, "balance", 2)
+
+    cursor.execute("""
+    SELECT COALESCE(SUM(amount), 0) AS total
+    FROM ledger_entries
+    WHERE account_id = %s AND entry_date <= %s
+        AND (entry_date > %s OR entry_id > %s)
+    """, (account_id, as_of_date, snapshot_date, last_entry_id))
+    total = _row_value(cursor.fetchone(), "total", 0)
+    return to_cents(snapshot_balance) + to_cents(total)
+
+
+def compact(connection, cutoff_date):
+    """Roll the entries up to ``cutoff_date`` into new snapshots.
+
+    Also refreshes the ``accounts.balance`` column of every account that
+    received entries since the previous compaction. The API does not read
+    that column for balances, it goes through ``current_balances`` or
+    ``ACCOUNT_BALANCES_QUERY``.
+    """
+    cursor = connection.cursor()
+    try:
+        # Record locks only: the locking read below must not lock the gap
+        # after the last entry, or every new entry would wait for the compaction.
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        cursor.execute("SELECT COALESCE(MAX(entry_id), 0) FROM ledger_entries")
+        high_water = cursor.fetchone()[0]
+        cursor.execute("SELECT COALESCE(MAX(last_entry_id), 0) FROM balance_snapshots")
+        previous_high_water = cursor.fetchone()[0]
+        # An entry with a lower id than high_water may still be uncommitted.
+        # The locking read waits for its transaction, so every entry the new
+        # snapshots claim to cover is committed and included.
+        cursor.execute("""
+        SELECT COUNT(*) FROM ledger_entries
+        WHERE entry_id > %s AND entry_id <= %s
+        LOCK IN SHARE MODE
+        """, (previous_high_water, high_water))
+        cursor.fetchone()
+
+        cursor.execute("""
+        INSERT INTO balance_snapshots (account_id, snapshot_date, last_entry_id, balance)
+        SELECT s.account_id, %s, %s, s.balance + SUM(e.amount)
+        FROM balance_snapshots s
+        JOIN (
+            SELECT account_id, MAX(snapshot_id) AS snapshot_id
+            FROM balance_snapshots
+            GROUP BY account_id
+        ) latest ON latest.snapshot_id = s.snapshot_id
+        JOIN ledger_entries e ON e.account_id = s.account_id
+            AND e.entry_id <= %s AND e.entry_date <= %s
+            AND (e.entry_date > s.snapshot_date OR e.entry_id > s.last_entry_id)
+        WHERE s.snapshot_date <= %s
+        GROUP BY s.account_id, s.balance
+        """, (cutoff_date, high_water, high_water, cutoff_date, cutoff_date))
+        snapshot_count = cursor.rowcount
+
+        cursor.execute("""
+        UPDATE accounts a
+        JOIN ({current}) b ON b.account_id = a.account_id
+        SET a.balance = b.balance
+        """.format(current=CURRENT_BALANCES_QUERY.format(
+            where="WHERE account_id IN (SELECT account_id FROM ledger_entries WHERE entry_id > %s)"
+        )), (previous_high_water,))
+        connection.commit()
+        return snapshot_count
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+BENCH_AMOUNT_CENTS = 1
+
+
+def _row_lock_status(cursor):
+    cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN ('Innodb_row_lock_waits', 'Innodb_row_lock_time')")
+    return {name: int(value) for name, value in cursor.fetchall()}
+
+
+def _bench_withdrawals(connect, account_id, seconds, barrier, timings):
+    connection = connect()
+    if not connection:
+        barrier.abort()
+        return
+    cursor = connection.cursor()
+    amount = to_decimal(BENCH_AMOUNT_CENTS)
+    try:
+        barrier.wait()
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            lock_accounts(cursor, [account_id])
+            locked = time.perf_counter()
+            if current_balances(cursor, [account_id]).get(account_id, 0) >= BENCH_AMOUNT_CENTS:
+                cursor.execute(
+                    "INSERT INTO withdrawals (account_id, amount, withdrawal_date, withdrawal_method) VALUES (%s, %s, %s, %s)",
+                    (account_id, amount, date.today(), "bench")
+                )
+                append_withdrawal_entries(cursor, [(cursor.lastrowid, account_id, amount, date.today())])
+            # Rolled back, so the account keeps its balance whatever the run length.
+            connection.rollback()
+            timings.append((locked - started, time.perf_counter() - started))
+    finally:
+        connection.rollback()
+        cursor.close()
+        connection.close()
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def bench(connect, account_number, threads, seconds):
+    """Run ``threads`` concurrent withdrawal transactions on one account for ``seconds``."""
+    connection = connect()
+    if not connection:
+        raise SystemExit("Database connection failed")
+    cursor = connection.cursor()
+    try:
+        if account_number is None:
+            cursor.execute("SELECT account_id, account_number FROM accounts ORDER BY account_id LIMIT 1")
+        else:
+            cursor.execute("SELECT account_id, account_number FROM accounts WHERE account_number = %s", (account_number,))
+        row = cursor.fetchone()
+        if not row:
+            raise SystemExit("Account not found")
+        account_id, account_number = row
+        status_before = _row_lock_status(cursor)
+
+        barrier = threading.Barrier(threads)
+        timings = [[] for _ in range(threads)]
+        workers = [
+            threading.Thread(target=_bench_withdrawals, args=(connect, account_id, seconds, barrier, timings[i]))
+            for i in range(threads)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        status_after = _row_lock_status(cursor)
+    finally:
+        cursor.close()
+        connection.close()
+
+    lock_waits = sorted(lock_wait for thread_timings in timings for lock_wait, _ in thread_timings)
+    durations = sorted(duration for thread_timings in timings for _, duration in thread_timings)
+    if not durations:
+        raise SystemExit("No withdrawal completed")
+    print(f"Account {account_number}: {len(durations)} withdrawals on {threads} threads in {seconds:.1f}s, "
+          f"{len(durations) / seconds:.1f}/s")
+    print(f"Lock wait ms: avg {sum(lock_waits) / len(lock_waits) * 1000:.2f}, p50 {_percentile(lock_waits, 0.5) * 1000:.2f}, "
+          f"p99 {_percentile(lock_waits, 0.99) * 1000:.2f}, max {lock_waits[-1] * 1000:.2f}")
+    print(f"Transaction ms: avg {sum(durations) / len(durations) * 1000:.2f}, p50 {_percentile(durations, 0.5) * 1000:.2f}, "
+          f"p99 {_percentile(durations, 0.99) * 1000:.2f}")
+    print("InnoDB row lock waits: {} ({} ms waited, server wide)".format(
+        status_after["Innodb_row_lock_waits"] - status_before["Innodb_row_lock_waits"],
+        status_after["Innodb_row_lock_time"] - status_before["Innodb_row_lock_time"]
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ledger maintenance")
+    parser.add_argument("--init", action="store_true", help="create the ledger tables and seed opening snapshots")
+    parser.add_argument("--cutoff", type=date.fromisoformat, default=date.today() - timedelta(days=1),
+                        help="last entry date rolled into the new snapshots (default: yesterday)")
+    parser.add_argument("--bench", type=int, metavar="THREADS",
+                        help="threads withdrawing from one account at once, rolled back")
+    parser.add_argument("--account-number", help="account of --bench (default: the first one)")
+    parser.add_argument("--seconds", type=float, default=10, help="length of --bench")
+    args = parser.parse_args()
+
+    # The ledger of each account is on its shard; sharding imports this module.
+    import sharding
+
+    if args.bench:
+        if sharding.SHARDING_ENABLED and args.account_number is None:
+            raise SystemExit("--account-number is required with sharding")
+        shard = sharding.shard_for_account_number(args.account_number) if sharding.SHARDING_ENABLED else 0
+        bench(lambda: sharding.get_shard_connection(shard), args.account_number, args.bench, args.seconds)
+        return
+
+    if sharding.SHARDING_ENABLED:
+        connections = sharding.shard_connections()
+        shards = list(range(sharding.SHARD_COUNT))
+    else:
+        connection = get_db_connection()
+        if not connection:
+            raise SystemExit("Database connection failed")
+        connections, shards = [connection], [None]
+    try:
+        for shard, connection in zip(shards, connections):
+            where = f" on shard {shard}" if shard is not None else ""
+            if args.init:
+                cursor = connection.cursor()
+                create_ledger_tables(cursor)
+                seeded = seed_snapshots(cursor)
+                connection.commit()
+                cursor.close()
+                print(f"Ledger tables ready, {seeded} opening snapshots created{where}")
+            else:
+                created = compact(connection, args.cutoff)
+                print(f"Compaction up to {args.cutoff}: {created} snapshots created{where}")
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
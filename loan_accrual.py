@@ -0,0 +1,250 @@
+"""Nightly interest accrual and delinquency transitions for the loan book.
+
+    python loan_accrual.py [--date YYYY-MM-DD] [--workers N] [--chunk-size N] [--window-minutes N]
+
+The loans are split in ``loan_id`` ranges processed by a pool of worker
+processes. Each chunk is one transaction that records its checkpoint row,
+accrues the interest (``interest_rate`` is a yearly percentage) of the days
+since each outstanding loan was last accrued, or disbursed, marks the overdue active loans as delinquent and writes
+the change-feed events of the loans that became delinquent. Running the job
+again for the same date only processes the chunks that did not commit, which
+is how an interrupted or out-of-window run is resumed.
+
+Every loan records the date it was last accrued for (``last_accrued_date``),
+so a loan is accrued at most once per run date even when a rerun splits the
+loans in other chunks, and a night the job did not run is accrued by the next
+run. The interest is added to the balance in whole cents;
+the fraction of a cent is kept in ``accrual_carry`` and added to the next
+accrual, so small balances still earn their interest.
+
+Once every chunk of a run date is done, the run is recorded in
+``loan_accrual_runs`` with one ``loan_accruals`` change-feed event for all
+its loans.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import mysql.connector
+from mysql.connector import errorcode
+
+import changefeed
+from conexion import DB_CONFIG
+
+logger = logging.getLogger("loan_accrual")
+
+DELINQUENT_STATUS = "delinquent"
+OUTSTANDING_STATUSES = ("active", DELINQUENT_STATUS)
+DAYS_PER_YEAR = 365
+
+# Added to the loans table on the first run.
+LOAN_ACCRUAL_COLUMNS = {
+    "last_accrued_date": "DATE NULL",
+    # Interest of the last accrual; its part below a cent is carried to the next one.
+    "accrual_carry": "DECIMAL(20, 10) NOT NULL DEFAULT 0",
+}
+
+CREATE_RUNS_QUERY = """
+CREATE TABLE IF NOT EXISTS loan_accrual_runs (
+    run_id BIGINT AUTO_INCREMENT PRIMARY KEY,
+    run_date DATE NOT NULL UNIQUE,
+    accrued_loans INT NOT NULL,
+    delinquent_loans INT NOT NULL,
+    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+CREATE_CHECKPOINTS_QUERY = """
+CREATE TABLE IF NOT EXISTS loan_accrual_checkpoints (
+    run_date DATE NOT NULL,
+    chunk_start BIGINT NOT NULL,
+    chunk_end BIGINT NOT NULL,
+    accrued_loans INT NOT NULL DEFAULT 0,
+    delinquent_loans INT NOT NULL DEFAULT 0,
+    completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_date, chunk_start)
+)
+"""
+
+OUTSTANDING_LOANS = """
+loan_id BETWEEN %s AND %s AND status IN (%s, %s) AND balance > 0 AND disbursement_date <= %s
+AND (last_accrued_date IS NULL OR last_accrued_date < %s)
+"""
+
+NEWLY_DELINQUENT_LOANS = """
+loan_id BETWEEN %s AND %s AND status = 'active' AND balance > 0 AND due_date < %s
+"""
+
+
+def ensure_schema(cursor):
+    cursor.execute(CREATE_CHECKPOINTS_QUERY)
+    cursor.execute(CREATE_RUNS_QUERY)
+    cursor.execute("""
+    SELECT COLUMN_NAME FROM information_schema.COLUMNS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'loans'
+    """)
+    existing = {row[0].lower() for row in cursor.fetchall()}
+    missing = [name for name in LOAN_ACCRUAL_COLUMNS if name not in existing]
+    if missing:
+        cursor.execute("ALTER TABLE loans " + ", ".join(
+            f"ADD COLUMN {name} {LOAN_ACCRUAL_COLUMNS[name]}" for name in missing
+        ))
+
+
+def process_chunk(run_date, chunk_start, chunk_end):
+    started = time.perf_counter()
+    connection = mysql.connector.connect(**DB_CONFIG)
+    cursor = connection.cursor()
+    outstanding_params = (chunk_start, chunk_end, *OUTSTANDING_STATUSES, run_date, run_date)
+    delinquent_params = (chunk_start, chunk_end, run_date)
+    try:
+        try:
+            cursor.execute(
+                "INSERT INTO loan_accrual_checkpoints (run_date, chunk_start, chunk_end) VALUES (%s, %s, %s)",
+                (run_date, chunk_start, chunk_end)
+            )
+        except mysql.connector.IntegrityError as e:
+            if e.errno != errorcode.ER_DUP_ENTRY:
+                raise
+            connection.rollback()
+            return chunk_start, chunk_end, None, None, time.perf_counter() - started
+
+        # Assignments run left to right: the balance gets the whole cents of
+        # the carry just computed from the previous balance, over the days
+        # since the previous last_accrued_date.
+        cursor.execute(f"""
+        UPDATE loans
+        SET accrual_carry = MOD(accrual_carry, 0.01)
+                + balance * interest_rate / 100 * DATEDIFF(%s, COALESCE(last_accrued_date, disbursement_date)) / %s,
+            balance = balance + TRUNCATE(accrual_carry, 2),
+            last_accrued_date = %s
+        WHERE {OUTSTANDING_LOANS}
+        """, (run_date, DAYS_PER_YEAR, run_date, *outstanding_params))
+        accrued = cursor.rowcount
+
+        changefeed.record_changes_from_query(
+            cursor, "loans", f"SELECT loan_id AS row_id FROM loans WHERE {NEWLY_DELINQUENT_LOANS}", delinquent_params
+        )
+        cursor.execute(f"""
+        UPDATE loans
+        SET status = %s
+        WHERE {NEWLY_DELINQUENT_LOANS}
+        """, (DELINQUENT_STATUS, *delinquent_params))
+        delinquent = cursor.rowcount
+
+        cursor.execute("""
+        UPDATE loan_accrual_checkpoints
+        SET accrued_loans = %s, delinquent_loans = %s, completed_at = CURRENT_TIMESTAMP
+        WHERE run_date = %s AND chunk_start = %s
+        """, (accrued, delinquent, run_date, chunk_start))
+        connection.commit()
+        return chunk_start, chunk_end, accrued, delinquent, time.perf_counter() - started
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def pending_chunks(cursor, run_date, chunk_size):
+    cursor.execute("SELECT MIN(loan_id), MAX(loan_id) FROM loans")
+    first_id, last_id = cursor.fetchone()
+    if first_id is None:
+        return []
+    cursor.execute("SELECT chunk_start FROM loan_accrual_checkpoints WHERE run_date = %s", (run_date,))
+    completed = {row[0] for row in cursor.fetchall()}
+    return [
+        (chunk_start, min(chunk_start + chunk_size - 1, last_id))
+        for chunk_start in range(first_id, last_id + 1, chunk_size)
+        if chunk_start not in completed
+    ]
+
+
+def record_run(run_date):
+    """Record a finished run date and its change-feed event, once."""
+    connection = mysql.connector.connect(**DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("""
+        INSERT IGNORE INTO loan_accrual_runs (run_date, accrued_loans, delinquent_loans)
+        SELECT %s, COALESCE(SUM(accrued_loans), 0), COALESCE(SUM(delinquent_loans), 0)
+        FROM loan_accrual_checkpoints
+        WHERE run_date = %s
+        """, (run_date, run_date))
+        if cursor.rowcount:
+            changefeed.record_changes(cursor, "loan_accruals", [cursor.lastrowid])
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def run(run_date, workers, chunk_size, window_seconds):
+    connection = mysql.connector.connect(**DB_CONFIG)
+    cursor = connection.cursor()
+    try:
+        ensure_schema(cursor)
+        connection.commit()
+        chunks = pending_chunks(cursor, run_date, chunk_size)
+    finally:
+        cursor.close()
+        connection.close()
+    if not chunks:
+        logger.info("Run %s: nothing left to accrue", run_date)
+        record_run(run_date)
+        return True
+
+    logger.info("Run %s: %d chunks of up to %d loans on %d workers", run_date, len(chunks), chunk_size, workers)
+    started = time.perf_counter()
+    done = 0
+    total_accrued = 0
+    # Workers are spawned so they never share the parent's MySQL sockets.
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    try:
+        futures = [executor.submit(process_chunk, run_date, start, end) for start, end in chunks]
+        for future in as_completed(futures):
+            chunk_start, chunk_end, accrued, delinquent, seconds = future.result()
+            done += 1
+            if accrued is None:
+                logger.info("Chunk %d-%d already applied", chunk_start, chunk_end)
+            else:
+                total_accrued += accrued
+                logger.info("Chunk %d-%d: %d accrued, %d delinquent in %.2fs (%.0f loans/s)",
+                            chunk_start, chunk_end, accrued, delinquent, seconds, accrued / seconds if seconds else 0)
+            if window_seconds and time.perf_counter() - started > window_seconds and done < len(chunks):
+                logger.warning("Run %s: window exceeded after %d of %d chunks, rerun to resume", run_date, done, len(chunks))
+                executor.shutdown(wait=True, cancel_futures=True)
+                return False
+    finally:
+        executor.shutdown(wait=True)
+
+    record_run(run_date)
+    elapsed = time.perf_counter() - started
+    logger.info("Run %s: %d loans accrued in %.1fs (%.0f loans/s)",
+                run_date, total_accrued, elapsed, total_accrued / elapsed if elapsed else 0)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Nightly loan interest accrual")
+    parser.add_argument("--date", type=date.fromisoformat, default=date.today(), help="run date (default: today)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=50000, help="loan ids per chunk")
+    parser.add_argument("--window-minutes", type=float, default=0, help="stop scheduling chunks after this time (0: no limit)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    finished = run(args.date, args.workers, args.chunk_size, args.window_minutes * 60)
+    raise SystemExit(0 if finished else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,10 @@
+# First, so the time to ready includes importing the app.
+import warmup
 from fastapi import FastAPI
 from routes import router
+from profiling import ProfilingMiddleware
+from query_guard import QueryGuardMiddleware
+from compression import CompressionMiddleware
 
 tags_metadata = [
     {
@@ -19,7 +24,19 @@ tags_metadata = [
     "description": "Operations with employees"},
 
     {"name": "loans",
-    "description": "Operations with loans"}
+    "description": "Operations with loans"},
+
+    {"name": "changes",
+    "description": "Change feed of transfers, withdrawals and loans"},
+
+    {"name": "batch",
+    "description": "Several read requests in one call"},
+
+    {"name": "metrics",
+    "description": "Query timeout, cancellation and prepared statement counters"},
+
+    {"name": "health",
+    "description": "Liveness and readiness of the worker"}
 ]
 
 app = FastAPI(
@@ -28,6 +45,16 @@ app = FastAPI(
 )
 
 app.include_router(router)
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(QueryGuardMiddleware)
+# Outside the profiling and query guard middlewares, so it also compresses their responses.
+app.add_middleware(CompressionMiddleware)
+# Outermost, so the first request latencies include the compression.
+app.add_middleware(warmup.FirstRequestTimer)
+
+@app.on_event("startup")
+def warm_up():
+    warmup.start()
 
 if __name__ == "_main_":
     import uvicorn
@@ -1,6 +1,8 @@
 from pydantic import BaseModel
+from typing import Any, Dict, Optional
 from datetime import date
 from decimal import Decimal
+from money import Money
 
 class ClientCreate(BaseModel):
     name: str
@@ -24,19 +26,19 @@ class EmployeeResponse(EmployeeCreate):
 
 class AccountCreate(BaseModel):
     account_number: str
-    balance: float
+    balance: Money
     client_full_name: str
 
 class AccountResponse(BaseModel):
     account_id: int
     id_client: int
     account_number: str
-    balance: float
+    balance: Money
     client_full_name: str
 
 class WithdrawalCreate(BaseModel):
     account_number: str  
-    amount: float       
+    amount: Money       
     withdrawal_date: date  
     withdrawal_method: str  
 
@@ -48,7 +50,7 @@ class WithdrawalResponse(WithdrawalCreate):
 class TransferCreate(BaseModel):
     from_account_number: str 
     to_account_number: str   
-    amount: Decimal        
+    amount: Money        
     transfer_date: date   
     transfer_method: str       
     status: str = "pending"    
@@ -59,13 +61,22 @@ class TransferResponse(TransferCreate):
 class LoanCreate(BaseModel):
     client_full_name: str 
     employee_full_name: str
-    amount: Decimal
+    amount: Money
     interest_rate: Decimal
     disbursement_date: date 
     due_date: date 
-    balance: Decimal
+    balance: Money
     status: str = "active" 
 
 class LoanResponse(LoanCreate):
     loan_id: int
-    
\ No newline at end of file
+
+class BatchRequest(BaseModel):
+    id: Optional[str] = None
+    path: str
+    params: Dict[str, Any] = {}
+
+class BatchResponse(BaseModel):
+    id: Optional[str] = None
+    status: int
+    body: Any
@@ -0,0 +1,102 @@
+"""Money amounts as integer cents.
+
+Amounts arrive and leave as JSON numbers with at most two decimals and are
+stored in ``DECIMAL(15, 2)`` columns. In between they are integer cents: the
+models hold ``Money`` values, and the balance, velocity and transfer-graph
+code adds and compares plain ``int`` cents, so totals are exact and never go
+through ``float``. ``to_decimal`` turns cents back into the ``Decimal`` the
+connector sends to MySQL.
+"""
+from decimal import Decimal, DecimalException, ROUND_FLOOR
+from functools import total_ordering
+
+from pydantic.json import ENCODERS_BY_TYPE
+
+CENTS = 100
+# Largest amount a DECIMAL(15, 2) column holds, plus one cent.
+MAX_CENTS = 10 ** 15
+
+
+def _decimal(value):
+    # ValueError for anything that is not a finite amount, so pydantic answers 422.
+    try:
+        # A float goes through its shortest repr, so 0.1 is 10 cents.
+        amount = value if isinstance(value, Decimal) else Decimal(str(value))
+    except DecimalException:
+        raise ValueError(f"{value!r} is not a number")
+    if not amount.is_finite():
+        raise ValueError(f"{value} is not a finite amount")
+    # Far above any total of DECIMAL(15, 2) amounts; stops int() of a huge exponent.
+    if amount and amount.adjusted() >= 30:
+        raise ValueError(f"{value} is out of range")
+    return amount
+
+
+def to_cents(value):
+    """Exact cents of a ``Money``, ``Decimal``, ``int``, ``str`` or ``float`` amount."""
+    if isinstance(value, Money):
+        return value.cents
+    if isinstance(value, int):
+        return value * CENTS
+    cents = _decimal(value) * CENTS
+    if cents != cents.to_integral_value():
+        raise ValueError(f"{value} has more than two decimals")
+    return int(cents)
+
+
+def floor_cents(value):
+    """Cents of ``value`` rounded down, for thresholds that may have more decimals."""
+    return int((_decimal(value) * CENTS).to_integral_value(ROUND_FLOOR))
+
+
+def to_decimal(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+@total_ordering
+class Money:
+    __slots__ = ("cents",)
+
+    def __init__(self, cents):
+        self.cents = int(cents)
+
+    @classmethod
+    def __get_validators__(cls):
+        yield cls.validate
+
+    @classmethod
+    def validate(cls, value):
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, bool):
+            raise TypeError("amount must be a number")
+        cents = to_cents(value)
+        if abs(cents) >= MAX_CENTS:
+            raise ValueError(f"{value} does not fit in DECIMAL(15, 2)")
+        return cls(cents)
+
+    @classmethod
+    def __modify_schema__(cls, field_schema):
+        field_schema.update(type="number", example=10.5)
+
+    def to_decimal(self):
+        return to_decimal(self.cents)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.cents == other.cents
+
+    def __lt__(self, other):
+        return self.cents < other.cents
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+
+# One entry covers the models and the plain dicts every endpoint returns.
+ENCODERS_BY_TYPE[Money] = lambda money: money.cents / CENTS
@@ -0,0 +1,162 @@
+"""Monthly range partitioning of transfers and withdrawals, with archival.
+
+``python partitions.py init --first-month 2020-01`` converts both tables to
+``PARTITION BY RANGE (TO_DAYS(<date column>))`` with one partition per month
+(``pYYYYMM``) plus a catch-all ``p_future``. MySQL requires the partitioning
+column in every unique key and does not allow foreign keys on partitioned
+tables, so the primary key becomes ``(id, date)`` and any foreign keys on the
+tables must be dropped beforehand.
+
+``python partitions.py maintain`` is meant to run daily: it creates the
+partitions of the coming months and moves months older than ``--keep-months``
+into the compressed archive (see ``archive.py``) before dropping them.
+
+With sharding on, both commands run on every shard, and each shard archives
+its own file per month.
+"""
+import argparse
+from datetime import date
+
+import archive
+import sharding
+from conexion import get_db_connection
+
+ID_COLUMNS = {
+    "transfers": "transfer_id",
+    "withdrawals": "withdrawal_id",
+}
+
+FUTURE_PARTITION = "p_future"
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def _partition_month(name):
+    return date(int(name[1:5]), int(name[5:7]), 1)
+
+
+def _partition_definition(month):
+    return f"PARTITION {_partition_name(month)} VALUES LESS THAN (TO_DAYS('{_add_months(month, 1).isoformat()}'))"
+
+
+def _months(first_month, last_month):
+    month = first_month
+    while month <= last_month:
+        yield month
+        month = _add_months(month, 1)
+
+
+def monthly_partitions(cursor, table):
+    cursor.execute("""
+    SELECT PARTITION_NAME
+    FROM information_schema.PARTITIONS
+    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL
+    ORDER BY PARTITION_ORDINAL_POSITION
+    """, (table,))
+    return [
+        _partition_month(row[0]) for row in cursor.fetchall()
+        if row[0] != FUTURE_PARTITION
+    ]
+
+
+def partition_table(cursor, table, first_month, last_month):
+    date_column = archive.DATE_COLUMNS[table]
+    definitions = [_partition_definition(month) for month in _months(first_month, last_month)]
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY ({ID_COLUMNS[table]}, {date_column})")
+    cursor.execute(f"""
+    ALTER TABLE {table}
+    PARTITION BY RANGE (TO_DAYS({date_column})) (
+        {", ".join(definitions)}
+    )
+    """)
+
+
+def ensure_future_partitions(cursor, table, last_month):
+    existing = monthly_partitions(cursor, table)
+    first_missing = _add_months(existing[-1], 1) if existing else date.today().replace(day=1)
+    missing = list(_months(first_missing, last_month))
+    if not missing:
+        return []
+    definitions = [_partition_definition(month) for month in missing]
+    definitions.append(f"PARTITION {FUTURE_PARTITION} VALUES LESS THAN MAXVALUE")
+    cursor.execute(f"""
+    ALTER TABLE {table} REORGANIZE PARTITION {FUTURE_PARTITION} INTO (
+        {", ".join(definitions)}
+    )
+    """)
+    return missing
+
+
+def archive_partition(cursor, table, month, shard=None):
+    partition = _partition_name(month)
+    cursor.execute(f"SELECT * FROM {table} PARTITION ({partition})")
+    rows = cursor.fetchall()
+    columns = list(cursor.column_names)
+    path = archive.write_month(table, month, columns, rows, shard)
+    cursor.execute(f"ALTER TABLE {table} DROP PARTITION {partition}")
+    return path, len(rows)
+
+
+def archive_closed_partitions(cursor, table, keep_months, shard=None):
+    oldest_kept = _add_months(date.today().replace(day=1), -keep_months)
+    archived = []
+    for month in monthly_partitions(cursor, table):
+        if month >= oldest_kept:
+            break
+        archived.append((month,) + archive_partition(cursor, table, month, shard))
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfers and withdrawals partition maintenance")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    init_parser = subparsers.add_parser("init", help="partition the tables by month")
+    init_parser.add_argument("--first-month", required=True, type=lambda value: date.fromisoformat(value + "-01"),
+                             help="oldest month with data, as YYYY-MM")
+    init_parser.add_argument("--months-ahead", type=int, default=3)
+    maintain_parser = subparsers.add_parser("maintain", help="add future partitions and archive closed ones")
+    maintain_parser.add_argument("--months-ahead", type=int, default=3)
+    maintain_parser.add_argument("--keep-months", type=int, default=12,
+                                 help="months kept in MySQL, older ones are archived")
+    args = parser.parse_args()
+
+    if sharding.SHARDING_ENABLED:
+        connections = sharding.shard_connections()
+        shards = list(range(sharding.SHARD_COUNT))
+    else:
+        connection = get_db_connection()
+        if not connection:
+            raise SystemExit("Database connection failed")
+        connections, shards = [connection], [None]
+    last_month = _add_months(date.today().replace(day=1), args.months_ahead)
+    try:
+        for shard, connection in zip(shards, connections):
+            cursor = connection.cursor()
+            where = f" on shard {shard}" if shard is not None else ""
+            try:
+                for table in archive.DATE_COLUMNS:
+                    if args.command == "init":
+                        partition_table(cursor, table, args.first_month, last_month)
+                        print(f"{table}: partitioned from {args.first_month:%Y-%m} to {last_month:%Y-%m}{where}")
+                        continue
+                    for month in ensure_future_partitions(cursor, table, last_month):
+                        print(f"{table}: created partition {_partition_name(month)}{where}")
+                    for month, path, row_count in archive_closed_partitions(cursor, table, args.keep_months, shard):
+                        print(f"{table}: archived {row_count} rows of {month:%Y-%m} to {path}{where}")
+            finally:
+                cursor.close()
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+if __name__ == "__main__":
+    main()
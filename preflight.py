@@ -0,0 +1,198 @@
+"""Whole-payload validation of the bulk POST handlers before any write.
+
+Each check runs over one column of the payload at a time (amounts, dates,
+account numbers...) and rejects every offending row, so a batch reports all of
+its errors at once. The rows are then resolved with one ``IN`` query per
+chunk, and the overdraft check replays the accepted rows against a snapshot of
+the ledger balances of the batch's accounts, in integer cents. Nothing is
+written until the handler starts its inserts.
+
+Without sharding the accounts are resolved with ``FOR UPDATE`` on the
+handler's own connection, so they stay locked until it commits and a
+concurrent batch can not spend the same balance. With sharding the check runs
+on other connections; the handler locks the debited accounts again inside its
+write transaction (``ledger.lock_accounts``) and compares their balances with
+``starting_balances``.
+"""
+import ledger
+import sharding
+from velocity import velocity_limits
+
+CHUNK_SIZE = 1000
+
+# Locks in account_number order, the order of the sorted IN list.
+ACCOUNT_LOOKUP_QUERY = """
+SELECT account_number AS lookup_key, account_id AS lookup_id
+FROM accounts
+WHERE account_number IN ({placeholders})
+FOR UPDATE
+"""
+CLIENT_LOOKUP_QUERY = """
+SELECT CONCAT(name, ' ', last_name) AS lookup_key, id_client AS lookup_id
+FROM clients
+WHERE CONCAT(name, ' ', last_name) IN ({placeholders})
+"""
+EMPLOYEE_LOOKUP_QUERY = """
+SELECT name AS lookup_key, employee_id AS lookup_id
+FROM employees
+WHERE name IN ({placeholders})
+"""
+
+
+class PreflightResult:
+    def __init__(self, size):
+        self.size = size
+        self.errors = []
+        self.rejected = set()
+        self.account_ids = {}
+        self.balances = {}
+        self.starting_balances = {}
+        self.client_ids = {}
+        self.employee_ids = {}
+        self.velocity = None
+
+    def reject(self, indexes, field, message):
+        for index in indexes:
+            if index in self.rejected:
+                continue
+            self.rejected.add(index)
+            self.errors.append({"index": index, "field": field, "message": message})
+
+    def accepted(self):
+        return [index for index in range(self.size) if index not in self.rejected]
+
+
+def _chunks(values):
+    values = list(dict.fromkeys(values))
+    for i in range(0, len(values), CHUNK_SIZE):
+        yield values[i:i + CHUNK_SIZE]
+
+
+def _lookup(cursor, query, values):
+    found = {}
+    for chunk in _chunks(values):
+        cursor.execute(query.format(placeholders=", ".join(["%s"] * len(chunk))), tuple(chunk))
+        for row in cursor.fetchall():
+            key, value = (row["lookup_key"], row["lookup_id"]) if isinstance(row, dict) else row
+            found.setdefault(key, value)
+    return found
+
+
+def resolve_accounts(cursor, account_numbers):
+    if sharding.SHARDING_ENABLED:
+        return sharding.resolve_accounts(account_numbers)
+    return _lookup(cursor, ACCOUNT_LOOKUP_QUERY, sorted(set(account_numbers)))
+
+
+def warm_statements(cursor):
+    """Run the one-value lookups with a value that matches nothing, so the connection prepares them."""
+    for query in (ACCOUNT_LOOKUP_QUERY, CLIENT_LOOKUP_QUERY, EMPLOYEE_LOOKUP_QUERY):
+        _lookup(cursor, query, [""])
+
+
+def _current_balances(cursor, account_ids):
+    if sharding.SHARDING_ENABLED:
+        return sharding.current_balances(account_ids)
+    return ledger.current_balances(cursor, account_ids)
+
+
+def _duplicates(rows):
+    first_seen = {}
+    duplicates = []
+    for index, row in enumerate(rows):
+        if row in first_seen:
+            duplicates.append((index, first_seen[row]))
+        else:
+            first_seen[row] = index
+    return duplicates
+
+
+def _reject_duplicates(result, rows):
+    for index, first_index in _duplicates(rows):
+        result.reject([index], None, f"Duplicate of row {first_index}")
+
+
+def _reject_missing(result, values, found, field, label):
+    result.reject([i for i, value in enumerate(values) if value not in found], field, f"{label} not found")
+
+
+def check_transfers(cursor, transfers):
+    result = PreflightResult(len(transfers))
+    from_numbers = [transfer.from_account_number for transfer in transfers]
+    to_numbers = [transfer.to_account_number for transfer in transfers]
+    amounts = [transfer.amount.cents for transfer in transfers]
+
+    result.reject([i for i, amount in enumerate(amounts) if amount <= 0], "amount", "Amount must be positive")
+    result.reject([i for i, (from_number, to_number) in enumerate(zip(from_numbers, to_numbers)) if from_number == to_number],
+                  "to_account_number", "Transfer to the same account")
+    _reject_duplicates(result, [tuple(transfer.dict().values()) for transfer in transfers])
+
+    result.account_ids = resolve_accounts(cursor, from_numbers + to_numbers)
+    _reject_missing(result, from_numbers, result.account_ids, "from_account_number", "From account")
+    _reject_missing(result, to_numbers, result.account_ids, "to_account_number", "To account")
+
+    balances = _current_balances(cursor, set(result.account_ids.values()))
+    result.starting_balances = dict(balances)
+    for i in result.accepted():
+        from_id = result.account_ids[from_numbers[i]]
+        to_id = result.account_ids[to_numbers[i]]
+        if balances.get(from_id, 0) < amounts[i]:
+            result.reject([i], "amount", "Insufficient balance in the from account")
+            continue
+        balances[from_id] = balances.get(from_id, 0) - amounts[i]
+        balances[to_id] = balances.get(to_id, 0) + amounts[i]
+    result.balances = balances
+    return result
+
+
+def check_withdrawals(cursor, withdrawals):
+    result = PreflightResult(len(withdrawals))
+    account_numbers = [withdrawal.account_number for withdrawal in withdrawals]
+    amounts = [withdrawal.amount.cents for withdrawal in withdrawals]
+
+    result.reject([i for i, amount in enumerate(amounts) if amount <= 0], "amount", "Amount must be positive")
+    _reject_duplicates(result, [tuple(withdrawal.dict().values()) for withdrawal in withdrawals])
+
+    result.account_ids = resolve_accounts(cursor, account_numbers)
+    _reject_missing(result, account_numbers, result.account_ids, "account_number", "Account")
+
+    balances = _current_balances(cursor, set(result.account_ids.values()))
+    result.starting_balances = dict(balances)
+    velocity = velocity_limits.batch()
+    for i in result.accepted():
+        account_id = result.account_ids[account_numbers[i]]
+        if balances.get(account_id, 0) < amounts[i]:
+            result.reject([i], "amount", "Insufficient balance")
+            continue
+        limit_exceeded = velocity.try_add(account_id, withdrawals[i].withdrawal_method, amounts[i])
+        if limit_exceeded:
+            result.reject([i], "amount", limit_exceeded)
+            continue
+        balances[account_id] = balances.get(account_id, 0) - amounts[i]
+    result.balances = balances
+    result.velocity = velocity
+    return result
+
+
+def check_loans(cursor, loans):
+    result = PreflightResult(len(loans))
+    client_names = [loan.client_full_name for loan in loans]
+    employee_names = [loan.employee_full_name for loan in loans]
+    amounts = [loan.amount.cents for loan in loans]
+    balances = [loan.balance.cents for loan in loans]
+    interest_rates = [loan.interest_rate for loan in loans]
+    disbursement_dates = [loan.disbursement_date for loan in loans]
+    due_dates = [loan.due_date for loan in loans]
+
+    result.reject([i for i, amount in enumerate(amounts) if amount <= 0], "amount", "Amount must be positive")
+    result.reject([i for i, balance in enumerate(balances) if balance < 0], "balance", "Balance must not be negative")
+    result.reject([i for i, rate in enumerate(interest_rates) if rate < 0], "interest_rate", "Interest rate must not be negative")
+    result.reject([i for i, (disbursed, due) in enumerate(zip(disbursement_dates, due_dates)) if due < disbursed],
+                  "due_date", "Due date is before the disbursement date")
+    _reject_duplicates(result, [tuple(loan.dict().values()) for loan in loans])
+
+    result.client_ids = _lookup(cursor, CLIENT_LOOKUP_QUERY, client_names)
+    result.employee_ids = _lookup(cursor, EMPLOYEE_LOOKUP_QUERY, employee_names)
+    _reject_missing(result, client_names, result.client_ids, "client_full_name", "Client")
+    _reject_missing(result, employee_names, result.employee_ids, "employee_full_name", "Employee")
+    return result
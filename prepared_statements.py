@@ -0,0 +1,267 @@
+"""Server-side prepared statements cached per pooled connection.
+
+The connections of ``open_connection`` run every ``execute`` that has
+parameters as a server-side prepared statement. The first time a connection
+sees a statement text it is prepared and kept open; later executions only send
+the parameters, so MySQL does not parse the statement again. Each connection
+keeps up to ``PREPARED_STATEMENT_CACHE_SIZE`` statements (least recently used
+are closed first) for as long as it lives in the pool. For that the pool no
+longer resets the session on every checkout, and closing a connection rolls
+back the transaction the request left open instead.
+
+``executemany`` and statements without parameters keep the text protocol: the
+connector rewrites a bulk INSERT into a single multi-row statement, which is
+cheaper than one execution per row. Statements MySQL can not prepare are run
+as text and remembered.
+
+    python prepared_statements.py --iterations 2000   # text vs prepared latency and server time
+"""
+import argparse
+import os
+import statistics
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+import mysql.connector
+from mysql.connector import Error, FieldType, errorcode, pooling
+
+from query_guard import QueryMetrics
+
+PREPARED_STATEMENT_CACHE_SIZE = int(os.getenv("PREPARED_STATEMENT_CACHE_SIZE", "64"))
+
+metrics = QueryMetrics("prepared_statements", "reused_statements", "evicted_statements", "unpreparable_statements")
+
+_DECIMAL_TYPES = {FieldType.DECIMAL, FieldType.NEWDECIMAL}
+
+
+def _raw_connection(connection):
+    # The pool hands out a new wrapper on every checkout, the cache lives on the connection behind it.
+    if isinstance(connection, pooling.PooledMySQLConnection):
+        return connection._cnx
+    return connection
+
+
+class _StatementCache:
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self._statements = OrderedDict()
+        self._unpreparable = set()
+
+    def execute(self, connection, operation, params):
+        """Run ``operation`` on its prepared cursor; None when it has to run as text."""
+        if operation in self._unpreparable:
+            return None
+        entry = self._statements.get(operation)
+        if entry is not None:
+            cursor, prepared_operation = entry
+            self._statements.move_to_end(operation)
+            # The cursor only skips the prepare for the very string it prepared.
+            cursor.execute(prepared_operation, params)
+            metrics.increment("reused_statements")
+            return cursor
+
+        cursor = connection.cursor(prepared=True)
+        try:
+            cursor.execute(operation, params)
+        except Error as e:
+            cursor.close()
+            if e.errno == errorcode.ER_UNSUPPORTED_PS:
+                self._unpreparable.add(operation)
+                metrics.increment("unpreparable_statements")
+                return None
+            raise
+        self._statements[operation] = (cursor, operation)
+        metrics.increment("prepared_statements")
+        if len(self._statements) > PREPARED_STATEMENT_CACHE_SIZE:
+            _, (evicted, _) = self._statements.popitem(last=False)
+            try:
+                evicted.close()
+            except Error:
+                pass
+            metrics.increment("evicted_statements")
+        return cursor
+
+
+def _statement_cache(connection):
+    raw = _raw_connection(connection)
+    cache = getattr(raw, "_statement_cache", None)
+    if cache is None or cache.connection_id != raw.connection_id:
+        # A reconnect starts a new session without the prepared statements.
+        cache = raw._statement_cache = _StatementCache(raw.connection_id)
+    return cache
+
+
+class _PreparingCursor:
+    def __init__(self, connection, cache, dictionary):
+        self._connection = connection
+        self._cache = cache
+        self._dictionary = dictionary
+        self._text_cursor = connection.cursor(dictionary=dictionary)
+        self._cursor = self._text_cursor
+
+    def execute(self, operation, params=None):
+        if params:
+            cursor = self._cache.execute(_raw_connection(self._connection), operation, params)
+            if cursor is not None:
+                self._cursor = cursor
+                return None
+        self._cursor = self._text_cursor
+        return self._text_cursor.execute(operation, params)
+
+    def executemany(self, operation, seq_params):
+        self._cursor = self._text_cursor
+        return self._text_cursor.executemany(operation, seq_params)
+
+    def _convert(self, row):
+        if row is None or self._cursor is self._text_cursor:
+            return row
+        values = []
+        for value, column in zip(row, self._cursor.description):
+            # Older connectors return prepared text and decimal columns undecoded.
+            if isinstance(value, (bytes, bytearray)):
+                value = value.decode()
+            if isinstance(value, str) and column[1] in _DECIMAL_TYPES:
+                value = Decimal(value)
+            values.append(value)
+        return dict(zip(self._cursor.column_names, values)) if self._dictionary else tuple(values)
+
+    def fetchone(self):
+        return self._convert(self._cursor.fetchone())
+
+    def fetchmany(self, *args, **kwargs):
+        return [self._convert(row) for row in self._cursor.fetchmany(*args, **kwargs)]
+
+    def fetchall(self):
+        return [self._convert(row) for row in self._cursor.fetchall()]
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        # Prepared cursors stay open with their connection.
+        self._text_cursor.close()
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _PreparingConnection:
+    def __init__(self, connection):
+        self._connection = connection
+        self._cache = _statement_cache(connection)
+
+    def cursor(self, *args, **kwargs):
+        if args or set(kwargs) - {"dictionary"}:
+            return self._connection.cursor(*args, **kwargs)
+        return _PreparingCursor(self._connection, self._cache, kwargs.get("dictionary", False))
+
+    def close(self):
+        # Without the pool's session reset, a read-only request would hand its
+        # snapshot to the next one.
+        try:
+            if self._connection.in_transaction:
+                self._connection.rollback()
+        except Error as e:
+            print(f"Rollback before returning the connection failed: {e}")
+        self._connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def wrap_connection(connection):
+    if not PREPARED_STATEMENT_CACHE_SIZE:
+        return connection
+    return _PreparingConnection(connection)
+
+
+BENCHMARK_STATEMENTS = {
+    "account_by_number": (
+        "SELECT account_id, id_client, balance FROM accounts WHERE account_number = %s",
+        "SELECT account_number FROM accounts ORDER BY RAND() LIMIT 200",
+    ),
+    "loans_summary_by_client": (
+        """
+        SELECT c.id_client, c.name, c.last_name,
+            COUNT(l.loan_id) AS total_loans,
+            SUM(l.amount) AS total_amount
+        FROM clients c
+        LEFT JOIN loans l ON c.id_client = l.ID_client
+        WHERE CONCAT(c.name, ' ', c.last_name) = %s
+        GROUP BY c.id_client
+        """,
+        "SELECT CONCAT(name, ' ', last_name) FROM clients ORDER BY RAND() LIMIT 200",
+    ),
+}
+
+SERVER_TIME_QUERY = """
+SELECT COALESCE(SUM(SUM_TIMER_WAIT), 0)
+FROM performance_schema.events_statements_summary_by_thread_by_event_name
+WHERE THREAD_ID = %s
+"""
+
+
+def _server_time(monitor_cursor, thread_id):
+    if thread_id is None:
+        return None
+    monitor_cursor.execute(SERVER_TIME_QUERY, (thread_id,))
+    # Picoseconds.
+    return monitor_cursor.fetchone()[0] / 1e12
+
+
+def benchmark(config, iterations):
+    connection = mysql.connector.connect(**config)
+    monitor = mysql.connector.connect(**config)
+    try:
+        cursor = connection.cursor()
+        monitor_cursor = monitor.cursor()
+        try:
+            monitor_cursor.execute("SELECT PS_THREAD_ID(%s)", (connection.connection_id,))
+            thread_id = monitor_cursor.fetchone()[0]
+        except Error:
+            thread_id = None
+        preparing = _PreparingConnection(connection)
+
+        results = {}
+        for name, (statement, sample_query) in BENCHMARK_STATEMENTS.items():
+            cursor.execute(sample_query)
+            samples = cursor.fetchall()
+            if not samples:
+                continue
+            for mode, mode_cursor in (("text", cursor), ("prepared", preparing.cursor())):
+                latencies = []
+                server_before = _server_time(monitor_cursor, thread_id)
+                for i in range(iterations):
+                    started = time.perf_counter()
+                    mode_cursor.execute(statement, samples[i % len(samples)])
+                    mode_cursor.fetchall()
+                    latencies.append(time.perf_counter() - started)
+                server_after = _server_time(monitor_cursor, thread_id)
+                results[(name, mode)] = {
+                    "mean_ms": statistics.mean(latencies) * 1000,
+                    "p95_ms": sorted(latencies)[int(len(latencies) * 0.95)] * 1000,
+                    "server_ms": (server_after - server_before) / iterations * 1000 if thread_id is not None else None,
+                }
+                connection.rollback()
+        return results
+    finally:
+        monitor.close()
+        connection.close()
+
+
+def main():
+    from conexion import DB_CONFIG
+
+    parser = argparse.ArgumentParser(description="Text protocol vs server-side prepared statements")
+    parser.add_argument("--iterations", type=int, default=2000, help="executions per statement and mode")
+    args = parser.parse_args()
+
+    results = benchmark(DB_CONFIG, args.iterations)
+    for (name, mode), result in results.items():
+        server = f"{result['server_ms']:.3f} ms" if result["server_ms"] is not None else "n/a"
+        print(f"{name:<26} {mode:<9} mean {result['mean_ms']:.3f} ms  p95 {result['p95_ms']:.3f} ms  server {server}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""Opt-in profiling of single requests.
+
+A request is profiled when it carries ``X-Profile: inline`` or
+``X-Profile: file`` together with ``X-Profile-Token: <PROFILE_TOKEN>``, or
+when it is picked by ``PROFILE_SAMPLE_RATE`` (stored to a file). The profile
+holds a cProfile call profile and the time spent per phase:
+
+- connect, execute, fetch: measured around the pooled connection and its cursors
+- model_build: response model validation and encoding (``serialize_response``)
+- serialize: JSON rendering of the response body
+- other: everything else, mostly row conversion in the handler
+
+``file`` mode dumps the call profile as ``PROFILE_DIR/<timestamp>-<path>.prof``
+(pstats format, readable by snakeviz or flameprof to draw a flame graph) and
+returns its name in ``X-Profile-File``; ``inline`` mode returns the breakdown
+as JSON instead of the response body. Every profiled response carries a
+``Server-Timing`` header, so it is buffered until its body is complete,
+streamed bodies included. When profiling is off the only cost is one header
+lookup per request and one context variable read per connection and per
+threadpool call.
+
+The profile covers the work the request hands to worker threads through
+``threadpool.run_in_threadpool`` (``off_event_loop`` endpoints, streamed
+chunks, batch sub-requests), which wraps it with ``in_worker_thread``: before Python 3.12 each such call runs under its own profiler,
+merged into the request's; from 3.12 on cProfile sees every thread by itself.
+Profiled requests run one at a time, as only one cProfile profiler can be
+enabled at once. cProfile still traces the whole event loop thread, so
+unprofiled requests served concurrently with a profiled one show up in its
+call profile too.
+"""
+import asyncio
+import contextvars
+import cProfile
+import functools
+import hmac
+import os
+import pstats
+import random
+import re
+import sys
+import time
+from collections import defaultdict
+
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+TOP_FUNCTIONS = 25
+
+# From 3.12 on cProfile instruments every thread of the interpreter.
+_PROFILE_THREADS = sys.version_info < (3, 12)
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+_profiled_request = None
+
+
+class RequestProfile:
+    def __init__(self):
+        self.phases = defaultdict(float)
+        self.thread_profilers = []
+
+    def add(self, phase, started):
+        self.phases[phase] += time.perf_counter() - started
+
+    def wrap_connection(self, connection):
+        return _TimedConnection(connection, self)
+
+
+class _TimedCursor:
+    def __init__(self, cursor, profile):
+        self._cursor = cursor
+        self._profile = profile
+
+    def execute(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.execute(*args, **kwargs)
+        finally:
+            self._profile.add("execute", started)
+
+    def executemany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.executemany(*args, **kwargs)
+        finally:
+            self._profile.add("execute", started)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchone()
+        finally:
+            self._profile.add("fetch", started)
+
+    def fetchmany(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchmany(*args, **kwargs)
+        finally:
+            self._profile.add("fetch", started)
+
+    def fetchall(self):
+        started = time.perf_counter()
+        try:
+            return self._cursor.fetchall()
+        finally:
+            self._profile.add("fetch", started)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _TimedConnection:
+    def __init__(self, connection, profile):
+        self._connection = connection
+        self._profile = profile
+
+    def cursor(self, *args, **kwargs):
+        return _TimedCursor(self._connection.cursor(*args, **kwargs), self._profile)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def current_profile():
+    return _current_profile.get()
+
+
+def _run_profiled(profile, func, *args, **kwargs):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.disable()
+        profile.thread_profilers.append(profiler)
+
+
+def in_worker_thread(func):
+    """``func``, profiled on the worker thread that runs it when the current request is profiled."""
+    profile = _current_profile.get()
+    if profile is None or not _PROFILE_THREADS:
+        return func
+    return functools.partial(_run_profiled, profile, func)
+
+
+def _profiled_request_lock():
+    global _profiled_request
+    if _profiled_request is None:
+        _profiled_request = asyncio.Lock()
+    return _profiled_request
+
+
+def _requested_mode(headers):
+    mode = headers.get("x-profile")
+    if mode in ("inline", "file") and PROFILE_TOKEN:
+        token = headers.get("x-profile-token", "")
+        if hmac.compare_digest(token.encode(), PROFILE_TOKEN.encode()):
+            return mode
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        return "file"
+    return None
+
+
+def _cumulative(stats, filename_part, function_name):
+    return sum(
+        values[3] for (filename, _, function), values in stats.stats.items()
+        if function == function_name and filename_part in filename.replace("\\", "/")
+    )
+
+
+def _breakdown(profile, stats, total):
+    phases = {
+        "connect": profile.phases["connect"],
+        "execute": profile.phases["execute"],
+        "fetch": profile.phases["fetch"],
+        "model_build": _cumulative(stats, "fastapi/routing.py", "serialize_response"),
+        "serialize": _cumulative(stats, "starlette/responses.py", "render") + _cumulative(stats, "streaming.py", "_encode"),
+    }
+    phases["other"] = max(0.0, total - sum(phases.values()))
+    return {phase: round(seconds * 1000, 3) for phase, seconds in phases.items()}
+
+
+def _top_functions(stats):
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            "function": f"{filename}:{line}({function})",
+            "calls": values[1],
+            "own_ms": round(values[2] * 1000, 3),
+            "cumulative_ms": round(values[3] * 1000, 3),
+        }
+        for (filename, line, function), values in rows
+    ]
+
+
+def _save(stats, path):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", path).strip("_") or "root"
+    filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(time.time() * 1000) % 1000:03d}-{slug}.prof"
+    stats.dump_stats(os.path.join(PROFILE_DIR, filename))
+    return filename
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        mode = _requested_mode(Headers(scope=scope)) if scope["type"] == "http" else None
+        if mode is None:
+            await self.app(scope, receive, send)
+            return
+        async with _profiled_request_lock():
+            await self._profile(mode, scope, receive, send)
+
+    async def _profile(self, mode, scope, receive, send):
+        messages = []
+
+        async def buffer(message):
+            messages.append(message)
+
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            await self.app(scope, receive, buffer)
+        finally:
+            profiler.disable()
+            _current_profile.reset(token)
+        total = time.perf_counter() - started
+
+        stats = pstats.Stats(profiler)
+        for thread_profiler in profile.thread_profilers:
+            stats.add(thread_profiler)
+        phases = _breakdown(profile, stats, total)
+        server_timing = ", ".join(f"{phase};dur={duration}" for phase, duration in phases.items())
+        start = next(message for message in messages if message["type"] == "http.response.start")
+
+        if mode == "inline":
+            response = JSONResponse(
+                {
+                    "path": scope["path"],
+                    "status_code": start["status"],
+                    "total_ms": round(total * 1000, 3),
+                    "phases_ms": phases,
+                    "top_functions": _top_functions(stats),
+                },
+                headers={"Server-Timing": server_timing},
+            )
+            await response(scope, receive, send)
+            return
+        headers = MutableHeaders(raw=start["headers"])
+        headers["Server-Timing"] = server_timing
+        headers["X-Profile-File"] = _save(stats, scope["path"])
+        for message in messages:
+            await send(message)
@@ -0,0 +1,272 @@
+"""Statement timeouts and cancellation of abandoned requests.
+
+GET requests to a path listed in ``QUERY_TIMEOUTS`` (JSON ``{path: milliseconds}``
+merged over ``DEFAULT_QUERY_TIMEOUTS``), or to any other path when
+``QUERY_TIMEOUT_MS`` is set, are guarded: every connection they open runs with
+``max_execution_time`` set to the path's limit. MySQL then aborts their
+SELECT statements past the limit and the request answers 504.
+
+``QueryGuardMiddleware`` guards a request until the last byte of its response
+is sent, streamed bodies included. Meanwhile it waits for the client's
+``http.disconnect``. When it arrives, the statements still running on the
+request's connections are stopped with ``KILL QUERY`` from a separate
+connection, and any later statement of the request fails right away. The
+endpoint has to run off the event loop (``off_event_loop``) for the disconnect
+to be noticed while its queries run.
+
+The response start is held back until the first chunk of the body, so a limit
+exceeded before it still answers 504. Past that point the status is sent: a
+limit exceeded while a body streams aborts the response, and the client never
+gets a complete-looking array.
+
+The counters are per worker process and are served by ``/metrics/queries``.
+"""
+import asyncio
+import contextvars
+import functools
+import json
+import os
+import threading
+
+import mysql.connector
+from fastapi.responses import JSONResponse
+from mysql.connector import Error, errorcode
+from starlette.concurrency import run_in_threadpool
+
+import threadpool
+
+DEFAULT_QUERY_TIMEOUTS = {
+    "/transfers": 30000,
+    "/clients_by_employee": 30000,
+}
+QUERY_TIMEOUTS = dict(DEFAULT_QUERY_TIMEOUTS, **json.loads(os.getenv("QUERY_TIMEOUTS") or "{}"))
+QUERY_TIMEOUT_MS = int(os.getenv("QUERY_TIMEOUT_MS", "0"))
+
+_current_guard = contextvars.ContextVar("current_guard", default=None)
+
+
+class QueryMetrics:
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(names, 0)
+
+    def increment(self, name, count=1):
+        with self._lock:
+            self._counts[name] += count
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+metrics = QueryMetrics("guarded_requests", "timed_out_queries", "cancelled_requests", "killed_queries")
+
+
+class RequestGuard:
+    def __init__(self, timeout_ms):
+        self.timeout_ms = timeout_ms
+        self.cancelled = False
+        self.timed_out = False
+        self.completed = False
+        self._lock = threading.Lock()
+        self._connections = {}
+
+    def wrap_connection(self, connection, config):
+        cursor = connection.cursor()
+        try:
+            cursor.execute("SET SESSION max_execution_time = %s", (self.timeout_ms,))
+        finally:
+            cursor.close()
+        guarded = _GuardedConnection(connection, self)
+        with self._lock:
+            self._connections[id(guarded)] = (connection.connection_id, config)
+        return guarded
+
+    def _release(self, guarded):
+        # Held while the connection goes back to the pool, so a concurrent
+        # cancel never kills a statement of the request that reuses it.
+        with self._lock:
+            self._connections.pop(id(guarded), None)
+            # Pooled sessions are not reset on checkout any more.
+            try:
+                cursor = guarded._connection.cursor()
+                cursor.execute("SET SESSION max_execution_time = DEFAULT")
+                cursor.close()
+            except Error as e:
+                print(f"Resetting max_execution_time failed: {e}")
+            guarded._connection.close()
+
+    def cancel(self):
+        with self._lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            killed = 0
+            for connection_id, config in self._connections.values():
+                try:
+                    killer = mysql.connector.connect(**config)
+                    try:
+                        cursor = killer.cursor()
+                        cursor.execute("KILL QUERY %s", (connection_id,))
+                        cursor.close()
+                        killed += 1
+                    finally:
+                        killer.close()
+                except Error as e:
+                    print(f"KILL QUERY {connection_id} failed: {e}")
+        metrics.increment("cancelled_requests")
+        metrics.increment("killed_queries", killed)
+
+    def _record_error(self, error):
+        if error.errno == errorcode.ER_QUERY_TIMEOUT:
+            self.timed_out = True
+            metrics.increment("timed_out_queries")
+
+
+class _GuardedCursor:
+    def __init__(self, cursor, guard):
+        self._cursor = cursor
+        self._guard = guard
+
+    def _run(self, method, *args, **kwargs):
+        if self._guard.cancelled:
+            raise Error(msg="Request cancelled: the client disconnected", errno=errorcode.ER_QUERY_INTERRUPTED)
+        try:
+            return method(*args, **kwargs)
+        except Error as e:
+            self._guard._record_error(e)
+            raise
+
+    def execute(self, *args, **kwargs):
+        return self._run(self._cursor.execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self._run(self._cursor.executemany, *args, **kwargs)
+
+    def fetchone(self):
+        return self._run(self._cursor.fetchone)
+
+    def fetchmany(self, *args, **kwargs):
+        return self._run(self._cursor.fetchmany, *args, **kwargs)
+
+    def fetchall(self):
+        return self._run(self._cursor.fetchall)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _GuardedConnection:
+    def __init__(self, connection, guard):
+        self._connection = connection
+        self._guard = guard
+
+    def cursor(self, *args, **kwargs):
+        return _GuardedCursor(self._connection.cursor(*args, **kwargs), self._guard)
+
+    def close(self):
+        self._guard._release(self)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def current_guard():
+    return _current_guard.get()
+
+
+def timeout_for(path):
+    return QUERY_TIMEOUTS.get(path, QUERY_TIMEOUT_MS)
+
+
+def off_event_loop(endpoint):
+    """Run a blocking ``async def`` endpoint on a worker thread.
+
+    The event loop stays free to notice the client disconnecting while the
+    endpoint's queries run.
+    """
+    @functools.wraps(endpoint)
+    async def run(*args, **kwargs):
+        return await threadpool.run_in_threadpool(lambda: asyncio.run(endpoint(*args, **kwargs)))
+    return run
+
+
+async def _watch_disconnect(receive, guard):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            # The server also reports a disconnect once the response is sent.
+            if not guard.completed:
+                await run_in_threadpool(guard.cancel)
+            return
+
+
+def _timeout_response(guard, path):
+    return JSONResponse(
+        {"detail": f"Query exceeded the {guard.timeout_ms} ms limit of {path}"},
+        status_code=504
+    )
+
+
+class _GuardedSend:
+    def __init__(self, scope, receive, send, guard):
+        self._scope = scope
+        self._receive = receive
+        self._send = send
+        self._guard = guard
+        self._start = None
+        self.replaced = False
+        self.started = False
+
+    async def send_timeout(self):
+        self.replaced = self.started = True
+        self._guard.completed = True
+        await _timeout_response(self._guard, self._scope["path"])(self._scope, self._receive, self._send)
+
+    async def __call__(self, message):
+        if self.replaced:
+            return
+        if message["type"] == "http.response.start":
+            self._start = message
+            return
+        if message["type"] == "http.response.body":
+            if not self.started:
+                if self._guard.timed_out:
+                    await self.send_timeout()
+                    return
+                self.started = True
+                await self._send(self._start)
+            if not message.get("more_body", False):
+                self._guard.completed = True
+        await self._send(message)
+
+
+class QueryGuardMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        timeout_ms = timeout_for(scope.get("path", "")) if scope["type"] == "http" else 0
+        # Only GET requests: the watcher reads the request stream, which a handler
+        # reading a body would need for itself.
+        if not timeout_ms or scope["method"] != "GET":
+            await self.app(scope, receive, send)
+            return
+
+        guard = RequestGuard(timeout_ms)
+        metrics.increment("guarded_requests")
+        token = _current_guard.set(guard)
+        watcher = asyncio.ensure_future(_watch_disconnect(receive, guard))
+        guarded_send = _GuardedSend(scope, receive, send, guard)
+        try:
+            await self.app(scope, receive, guarded_send)
+        except Exception:
+            if not guard.timed_out or guarded_send.started:
+                raise
+            await guarded_send.send_timeout()
+        finally:
+            watcher.cancel()
+            _current_guard.reset(token)
@@ -0,0 +1,414 @@
+"""Query-plan regression check for every SQL statement issued by the handlers.
+
+Runs every endpoint of ``routes.py`` against a scratch MySQL database filled
+with a synthetic dataset, records the statements each handler executes and
+compares their ``EXPLAIN FORMAT=JSON`` plans with ``query_plans.json``: index
+used and access type per table, estimated rows, temporary tables and
+filesorts. Any difference is printed as a diff and the exit status is 1.
+
+    python query_plans.py --database financial_plans --load    # create and fill the scratch database
+    python query_plans.py --database financial_plans           # compare against query_plans.json
+    python query_plans.py --database financial_plans --update  # accept the current plans
+    python query_plans.py --database financial_plans --analyze # also print EXPLAIN ANALYZE of regressions
+
+The scratch database gets the table definitions of ``DB_NAME`` (``CREATE TABLE
+... LIKE``) and is truncated by ``--load``, never point it at real data.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+from datetime import date, timedelta
+from decimal import Decimal
+
+import mysql.connector
+from fastapi import HTTPException, Response
+from fastapi.routing import APIRoute
+
+import changefeed
+import ledger
+import routes
+import sharding
+from conexion import DB_CONFIG
+from models import AccountCreate, ClientCreate, EmployeeCreate, LoanCreate, TransferCreate, WithdrawalCreate
+from streaming import JSONArrayResponse
+
+EXPECTATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "query_plans.json")
+
+BASE_TABLES = ["clients", "employees", "accounts", "withdrawals", "transfers", "loans"]
+
+# Estimated rows may grow this much before it counts as a regression.
+ROWS_TOLERANCE = 2.0
+ROWS_SLACK = 10
+
+FIRST_DATE = date(2024, 1, 1)
+
+NOT_COVERED = {
+    "run_batch": "only dispatches to the other endpoints",
+    "check_balance_index_consistency": "full scans by design",
+    "get_query_metrics": "in-memory counters, no SQL",
+    "get_statement_metrics": "in-memory counters, no SQL",
+    "get_client_search_stats": "in-memory index, no SQL",
+    "health_live": "no SQL",
+    "health_ready": "in-memory warm-up state, no SQL",
+}
+
+
+def _client_name(i):
+    return f"Name{i} Last{i}"
+
+
+def _account_number(i):
+    return f"ACC{i:08d}"
+
+
+def _employee_name(i):
+    return f"Employee{i}"
+
+
+def scenarios(scale):
+    """Handler calls with arguments that hit the synthetic dataset."""
+    some = max(1, scale // 2)
+    day = FIRST_DATE + timedelta(days=10)
+    return [
+        ("list_clients", {}),
+        ("get_clients_multi", {"client_ids": list(range(1, 51))}),
+        ("search_clients", {"q": _client_name(some), "limit": 10}),
+        ("list_employees", {}),
+        ("get_employees_multi", {"employee_ids": list(range(1, 11))}),
+        ("list_accounts", {}),
+        ("get_accounts_multi", {"account_numbers": [_account_number(i) for i in range(1, 201)]}),
+        ("get_account_balance_as_of", {"account_number": _account_number(some), "as_of_date": None}),
+        ("get_account_balance_as_of", {"account_number": _account_number(some), "as_of_date": day}),
+        ("list_withdrawals", {}),
+        ("list_transfers", {}),
+        ("list_loans", {}),
+        ("get_loans_summary_by_client", {"client_full_name": _client_name(some)}),
+        ("get_loans_summary_by_employee", {"employee_full_name": _employee_name(1)}),
+        ("get_average_withdrawals_by_client", {"client_full_name": _client_name(some)}),
+        ("get_count_and_amounts_withdrawals_by_client_and_date", {"client_full_name": _client_name(some), "withdrawal_date": day}),
+        ("get_clients_with_employees", {"employee_name": None}),
+        ("get_clients_with_employees", {"employee_name": _employee_name(1)}),
+        ("get_clients_loan_status", {"client_full_name": _client_name(some)}),
+        ("get_accounts_above_balance", {"min_balance": 5000.0, "limit": None}),
+        ("count_accounts_above_balance", {"min_balance": 5000.0}),
+        ("transfers_by_account_and_date_range", {"start_date": FIRST_DATE, "end_date": day, "from_account_number": _account_number(some)}),
+        ("transfers_summary_to_specific_account", {"to_account_number": _account_number(some), "start_date": FIRST_DATE, "end_date": day}),
+        ("get_top_counterparties", {"account_number": _account_number(some), "start_date": FIRST_DATE, "end_date": day, "limit": 10}),
+        ("get_net_flow_by_client", {"start_date": FIRST_DATE, "end_date": day, "limit": 50}),
+        ("get_transfer_clusters", {"start_date": FIRST_DATE, "end_date": day, "min_size": 2, "limit": 50}),
+        ("get_round_trip_transfers", {"start_date": FIRST_DATE, "end_date": day, "max_length": 4, "limit": 100}),
+        ("get_employee_details_by_name", {"employee_name": _employee_name(1)}),
+        ("get_employees_loans_summary_by_name", {"employee_name": _employee_name(1)}),
+        ("get_loans_above_amount", {"min_amount": 90000.0}),
+        ("withdrawals_summary_by_client", {"client_full_name": _client_name(some), "start_date": FIRST_DATE, "end_date": day}),
+        ("get_client_accounts_summary", {"client_full_name": _client_name(some)}),
+        ("get_changes", {"tables": list(changefeed.FEED_TABLES), "since": None, "limit": 500, "wait": 0}),
+        ("create_clients_bulk", {"clients": [ClientCreate(
+            name="Plan", last_name="Client", address="Street 1", phone_number="555", email="plan@example.com",
+            identification_type="CC", identification_number="PLAN1")]}),
+        ("create_employees_bulk", {"employees": [EmployeeCreate(name="PlanEmployee", position="Advisor", hire_date=FIRST_DATE)]}),
+        ("create_accounts_bulk", {"accounts": [AccountCreate(
+            account_number="PLAN00000001", balance=1000, client_full_name=_client_name(some))]}),
+        ("create_withdrawals_bulk", {"response": Response(), "withdrawals": [WithdrawalCreate(
+            account_number=_account_number(some), amount=1, withdrawal_date=day, withdrawal_method="atm")]}),
+        ("create_transfers_bulk", {"response": Response(), "transfers": [TransferCreate(
+            from_account_number=_account_number(some), to_account_number=_account_number(some + 1),
+            amount=Decimal("1.00"), transfer_date=day, transfer_method="online")]}),
+        ("create_loans_bulk", {"response": Response(), "loans": [LoanCreate(
+            client_full_name=_client_name(some), employee_full_name=_employee_name(1), amount=Decimal("1000.00"),
+            interest_rate=Decimal("12.50"), disbursement_date=FIRST_DATE, due_date=day, balance=Decimal("1000.00"))]}),
+    ]
+
+
+def _connect(database):
+    return mysql.connector.connect(**{**DB_CONFIG, "database": database})
+
+
+def load_dataset(database, scale):
+    source = DB_CONFIG["database"]
+    if source == database:
+        raise SystemExit("The scratch database must not be DB_NAME")
+    connection = mysql.connector.connect(**{**DB_CONFIG, "database": None})
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{database}`")
+    cursor.execute(f"USE `{database}`")
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+    for table in BASE_TABLES:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{table}` LIKE `{source}`.`{table}`")
+    ledger.create_ledger_tables(cursor)
+    changefeed.create_outbox_table(cursor)
+    for table in BASE_TABLES + ["ledger_entries", "balance_snapshots", "change_outbox"]:
+        cursor.execute(f"TRUNCATE TABLE `{table}`")
+
+    rng = random.Random(42)
+    employees = max(10, scale // 100)
+    cursor.executemany(
+        "INSERT INTO employees (name, position, hire_date) VALUES (%s, %s, %s)",
+        [(_employee_name(i), "Advisor", FIRST_DATE) for i in range(1, employees + 1)]
+    )
+    cursor.executemany(
+        """INSERT INTO clients (name, last_name, address, phone_number, email, identification_type, identification_number)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+        [(f"Name{i}", f"Last{i}", f"Street {i}", f"555{i:07d}", f"client{i}@example.com", "CC", f"{i:010d}")
+         for i in range(1, scale + 1)]
+    )
+    cursor.executemany(
+        "INSERT INTO accounts (id_client, account_number, balance) VALUES (%s, %s, %s)",
+        [(i, _account_number(i), Decimal(rng.randint(0, 1000000)) / 100) for i in range(1, scale + 1)]
+    )
+    cursor.executemany(
+        """INSERT INTO withdrawals (account_id, amount, withdrawal_date, withdrawal_method)
+        VALUES (%s, %s, %s, %s)""",
+        [(rng.randint(1, scale), Decimal(rng.randint(100, 50000)) / 100, FIRST_DATE + timedelta(days=rng.randint(0, 365)),
+          rng.choice(["atm", "branch"])) for _ in range(scale * 5)]
+    )
+    cursor.executemany(
+        """INSERT INTO transfers (from_account_id, to_account_id, amount, transfer_date, transfer_method, status)
+        VALUES (%s, %s, %s, %s, %s, %s)""",
+        [(rng.randint(1, scale), rng.randint(1, scale), Decimal(rng.randint(100, 50000)) / 100,
+          FIRST_DATE + timedelta(days=rng.randint(0, 365)), "online", "completed") for _ in range(scale * 5)]
+    )
+    cursor.executemany(
+        """INSERT INTO loans (ID_client, employee_id, amount, interest_rate, disbursement_date, due_date, balance, status)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+        [(rng.randint(1, scale), rng.randint(1, employees), Decimal(rng.randint(100000, 10000000)) / 100, Decimal("12.50"),
+          FIRST_DATE, FIRST_DATE + timedelta(days=365), Decimal(rng.randint(0, 10000000)) / 100, "active")
+         for _ in range(scale)]
+    )
+    ledger.seed_snapshots(cursor)
+    cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+    connection.commit()
+    for table in BASE_TABLES + ["ledger_entries", "balance_snapshots", "change_outbox"]:
+        cursor.execute(f"ANALYZE TABLE `{table}`")
+        cursor.fetchall()
+    cursor.close()
+    connection.close()
+
+
+class _RecordingCursor:
+    def __init__(self, cursor, statements):
+        self._cursor = cursor
+        self._statements = statements
+
+    def execute(self, operation, params=None):
+        self._statements.append((operation, params))
+        return self._cursor.execute(operation, params)
+
+    def executemany(self, operation, seq_params):
+        seq_params = list(seq_params)
+        if seq_params:
+            self._statements.append((operation, seq_params[0]))
+        return self._cursor.executemany(operation, seq_params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _RecordingConnection:
+    def __init__(self, connection, statements):
+        self._connection = connection
+        self._statements = statements
+
+    def cursor(self, *args, **kwargs):
+        return _RecordingCursor(self._connection.cursor(*args, **kwargs), self._statements)
+
+    def commit(self):
+        # The POST scenarios must leave the dataset, and so the plans, unchanged.
+        pass
+
+    def close(self):
+        self._connection.rollback()
+        self._connection.close()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def record_statements(database, scale):
+    recorded = {}
+    original = routes.get_db_connection
+    try:
+        for name, kwargs in scenarios(scale):
+            statements = []
+            routes.get_db_connection = lambda: _RecordingConnection(_connect(database), statements)
+            try:
+                result = asyncio.run(getattr(routes, name)(**kwargs))
+                if isinstance(result, JSONArrayResponse):
+                    result.collect()
+            except HTTPException:
+                pass
+            for operation, params in statements:
+                recorded.setdefault(name, []).append((operation, params))
+    finally:
+        routes.get_db_connection = original
+    return recorded
+
+
+def _normalize(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _explainable(sql):
+    return re.match(r"\s*(SELECT|INSERT|UPDATE|DELETE)\b", sql, re.IGNORECASE) and "LAST_INSERT_ID" not in sql
+
+
+def _walk(node, tables, flags):
+    if isinstance(node, dict):
+        if "table_name" in node:
+            tables.append({
+                "table": node["table_name"],
+                "access_type": node.get("access_type"),
+                "key": node.get("key"),
+                "rows": int(node.get("rows_examined_per_scan", 0)),
+            })
+        for flag in ("using_temporary_table", "using_filesort"):
+            if node.get(flag):
+                flags.add(flag)
+        for value in node.values():
+            _walk(value, tables, flags)
+    elif isinstance(node, list):
+        for value in node:
+            _walk(value, tables, flags)
+
+
+def explain(cursor, sql, params):
+    cursor.execute("EXPLAIN FORMAT=JSON " + sql, params)
+    plan = json.loads(cursor.fetchone()[0])
+    tables = []
+    flags = set()
+    _walk(plan, tables, flags)
+    return {
+        "sql": _normalize(sql),
+        "tables": tables,
+        "temporary_table": "using_temporary_table" in flags,
+        "filesort": "using_filesort" in flags,
+    }
+
+
+def explain_analyze(cursor, sql, params):
+    if not re.match(r"\s*SELECT\b", sql, re.IGNORECASE):
+        return None
+    try:
+        cursor.execute("EXPLAIN ANALYZE " + sql, params)
+        return cursor.fetchone()[0]
+    except mysql.connector.Error:
+        return None
+
+
+def current_plans(database, scale):
+    plans = {}
+    raw = {}
+    connection = _connect(database)
+    cursor = connection.cursor()
+    try:
+        for name, statements in record_statements(database, scale).items():
+            explainable = [(sql, params) for sql, params in statements if _explainable(sql)]
+            for i, (sql, params) in enumerate(explainable):
+                key = f"{name}#{i}"
+                plans[key] = explain(cursor, sql, params)
+                raw[key] = (sql, params)
+        connection.rollback()
+    finally:
+        cursor.close()
+        connection.close()
+    return plans, raw
+
+
+def compare(expected, actual):
+    problems = []
+    for key in sorted(set(expected) | set(actual)):
+        if key not in actual:
+            problems.append(f"{key}: statement no longer executed")
+            continue
+        if key not in expected:
+            problems.append(f"{key}: new statement without expectation\n    {actual[key]['sql'][:200]}")
+            continue
+        old, new = expected[key], actual[key]
+        lines = []
+        if old["sql"] != new["sql"]:
+            lines.append(f"    - sql: {old['sql'][:200]}\n    + sql: {new['sql'][:200]}")
+        old_tables = {(t["table"], i): t for i, t in enumerate(old["tables"])}
+        new_tables = {(t["table"], i): t for i, t in enumerate(new["tables"])}
+        for table_key in sorted(set(old_tables) | set(new_tables), key=lambda k: k[1]):
+            before, after = old_tables.get(table_key), new_tables.get(table_key)
+            if before is None or after is None:
+                lines.append(f"    - {table_key[0]}: {before}\n    + {table_key[0]}: {after}")
+                continue
+            if before["key"] != after["key"] or (after["access_type"] == "ALL" and before["access_type"] != "ALL"):
+                lines.append(f"    - {before['table']}: {before['access_type']} using {before['key']}\n"
+                             f"    + {after['table']}: {after['access_type']} using {after['key']}")
+            if after["rows"] > before["rows"] * ROWS_TOLERANCE + ROWS_SLACK:
+                lines.append(f"    - {before['table']}: ~{before['rows']} rows\n    + {after['table']}: ~{after['rows']} rows")
+        for flag in ("temporary_table", "filesort"):
+            if new[flag] and not old[flag]:
+                lines.append(f"    + uses {flag.replace('_', ' ')}")
+        if lines:
+            problems.append(f"{key}:\n" + "\n".join(lines))
+    return problems
+
+
+def uncovered_handlers(scale):
+    covered = {name for name, _ in scenarios(scale)}
+    handlers = {route.endpoint.__name__ for route in routes.router.routes if isinstance(route, APIRoute)}
+    return sorted(handlers - covered - set(NOT_COVERED))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query-plan regression check")
+    parser.add_argument("--database", required=True, help="scratch database for the synthetic dataset")
+    parser.add_argument("--scale", type=int, default=10000, help="number of synthetic clients and accounts")
+    parser.add_argument("--load", action="store_true", help="(re)create the synthetic dataset first")
+    parser.add_argument("--update", action="store_true", help="store the current plans as the expectations")
+    parser.add_argument("--analyze", action="store_true", help="print EXPLAIN ANALYZE of regressed statements")
+    args = parser.parse_args()
+    if sharding.SHARDING_ENABLED:
+        raise SystemExit("Unset DB_SHARDS: the plans are checked against a single scratch database")
+
+    uncovered = uncovered_handlers(args.scale)
+    if uncovered:
+        print("Handlers without a scenario: " + ", ".join(uncovered))
+        return 1
+    if args.load:
+        load_dataset(args.database, args.scale)
+
+    actual, raw = current_plans(args.database, args.scale)
+    if args.update:
+        with open(EXPECTATIONS_FILE, "w") as expectations_file:
+            json.dump(actual, expectations_file, indent=2, sort_keys=True)
+        print(f"Stored {len(actual)} plans in {EXPECTATIONS_FILE}")
+        return 0
+
+    if not os.path.exists(EXPECTATIONS_FILE):
+        print(f"{EXPECTATIONS_FILE} does not exist: record it with --load --update on a MySQL server "
+              "with the production schema and version, and commit it")
+        return 1
+    with open(EXPECTATIONS_FILE) as expectations_file:
+        expected = json.load(expectations_file)
+
+    problems = compare(expected, actual)
+    if not problems:
+        print(f"{len(actual)} plans match the expectations")
+        return 0
+    print(f"{len(problems)} plan regressions:\n")
+    for problem in problems:
+        print(problem)
+        key = problem.split(":", 1)[0]
+        if args.analyze and key in raw:
+            connection = _connect(args.database)
+            cursor = connection.cursor()
+            analyzed = explain_analyze(cursor, *raw[key])
+            connection.rollback()
+            cursor.close()
+            connection.close()
+            if analyzed:
+                print("\n".join("      " + line for line in analyzed.splitlines()))
+        print()
+    return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,307 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Response
 from typing import List
 from conexion import get_db_connection
-from models import ClientCreate, ClientResponse, AccountCreate, AccountResponse, WithdrawalCreate, WithdrawalResponse, TransferCreate, TransferResponse,EmployeeCreate, EmployeeResponse, LoanCreate, LoanResponse
+import ledger
+import archive
+import changefeed
+import batch
+import preflight
+import sharding
+import query_guard
+import threadpool
+import prepared_statements
+import analytics_mirror
+import streaming
+from balance_index import balance_index
+from client_search import client_search
+from transfer_graph import transfer_graphs
+from warmup import readiness
+from money import Money, to_cents
+from streaming import JSONArrayResponse
+from models import ClientCreate, ClientResponse, AccountCreate, AccountResponse, WithdrawalCreate, WithdrawalResponse, TransferCreate, TransferResponse,EmployeeCreate, EmployeeResponse, LoanCreate, LoanResponse, BatchRequest, BatchResponse
 from mysql.connector import Error
-from decimal import Decimal
-from datetime import date
+from datetime import date, datetime, timezone
+import itertools
+import math
+import time
 
 router = APIRouter()
 
+MULTI_GET_CHUNK_SIZE = 500
+
+def _chunks(values, size=MULTI_GET_CHUNK_SIZE):
+    values = list(dict.fromkeys(values))
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def _placeholders(values):
+    return ", ".join(["%s"] * len(values))
+
+def _accepted_rows(checked, partial, response):
+    accepted = checked.accepted()
+    if checked.errors and (not partial or not accepted):
+        raise HTTPException(status_code=422, detail=sorted(checked.errors, key=lambda error: error["index"]))
+    if checked.errors:
+        response.headers["X-Rejected-Rows"] = ",".join(str(index) for index in sorted(checked.rejected))
+    return accepted
+
+def _check_min_balance(min_balance):
+    # float query parameters accept nan and inf.
+    if not math.isfinite(min_balance):
+        raise HTTPException(status_code=422, detail="min_balance must be a finite number")
+
+def _fetch_all(cursor, query, params=()):
+    if sharding.SHARDING_ENABLED:
+        return sharding.gather(query, params)
+    cursor.execute(query, params)
+    return cursor.fetchall()
+
+def _row_batches(cursor, query, params=()):
+    # Like _fetch_all, for the endpoints that stream their rows.
+    if sharding.SHARDING_ENABLED:
+        return [sharding.gather(query, params)]
+    cursor.execute(query, params)
+    return streaming.cursor_batches(cursor)
+
+def _sum_rows(rows, columns):
+    # Adds up the aggregate row of each shard; a column with no value anywhere stays None.
+    totals = {}
+    for column in columns:
+        values = [row[column] for row in rows if row[column] is not None]
+        totals[column] = sum(values) if values else None
+    return totals
+
+def _first_client_rows(rows):
+    return [row for row in rows if row["id_client"] == rows[0]["id_client"]]
+
+def _mirror_rows(response, query, params):
+    # None when MySQL has to answer: no mirror configured, locked or too stale.
+    mirrored = analytics_mirror.fetch_all(query, params)
+    if mirrored is None:
+        return None
+    rows, synced_at = mirrored
+    if response is not None:
+        response.headers["X-Analytics-Backend"] = "duckdb"
+        response.headers["X-Data-As-Of"] = datetime.fromtimestamp(synced_at, timezone.utc).isoformat()
+        response.headers["X-Staleness-Seconds"] = f"{time.time() - synced_at:.1f}"
+    return rows
+
+def _connection_for_account(account_number):
+    if sharding.SHARDING_ENABLED:
+        return sharding.connection_for_account(account_number)
+    return get_db_connection()
+
+def _shard_connections():
+    if not sharding.SHARDING_ENABLED:
+        connection = get_db_connection()
+        return [connection] if connection else None
+    try:
+        return sharding.shard_connections()
+    except Error:
+        return None
+
+def _with_to_account_numbers(transfers):
+    to_account_numbers = sharding.account_numbers([transfer["to_account_id"] for transfer in transfers])
+    for transfer in transfers:
+        transfer["to_account_number"] = to_account_numbers.get(transfer["to_account_id"])
+    return transfers
+
+def _insert_accounts_sharded(insert_query, account_data):
+    groups = sharding.group_by_shard(range(len(account_data)), lambda i: sharding.shard_for_account_number(account_data[i][1]))
+    account_ids = [None] * len(account_data)
+    with sharding.transaction(groups) as cursors:
+        for shard, indexes in groups.items():
+            cursors[shard].executemany(insert_query, [account_data[i] for i in indexes])
+            for i, account_id in zip(indexes, sharding.inserted_ids(cursors[shard], len(indexes))):
+                account_ids[i] = account_id
+            ledger.open_accounts(cursors[shard], [(account_ids[i], account_data[i][2]) for i in indexes])
+    return account_ids
+
+def _lock_debited_accounts(cursors, account_ids, starting_balances):
+    # The preflight read the balances on other connections: lock the debited
+    # accounts in the write transaction and make sure none of them lost money since.
+    groups = sharding.group_by_shard(sorted(set(account_ids)), sharding.shard_for_id)
+    for shard in sorted(groups):
+        ledger.lock_accounts(cursors[shard], groups[shard])
+        balances = ledger.current_balances(cursors[shard], groups[shard])
+        if any(balances.get(account_id, 0) < starting_balances.get(account_id, 0) for account_id in groups[shard]):
+            raise HTTPException(status_code=409, detail="Balances changed while the batch was checked, retry it")
+
+def _insert_withdrawals_sharded(insert_query, withdrawal_data, starting_balances):
+    groups = sharding.group_by_shard(range(len(withdrawal_data)), lambda i: sharding.shard_for_id(withdrawal_data[i][0]))
+    withdrawal_ids = [None] * len(withdrawal_data)
+    with sharding.transaction(groups) as cursors:
+        _lock_debited_accounts(cursors, [data[0] for data in withdrawal_data], starting_balances)
+        for shard, indexes in groups.items():
+            cursors[shard].executemany(insert_query, [withdrawal_data[i] for i in indexes])
+            for i, withdrawal_id in zip(indexes, sharding.inserted_ids(cursors[shard], len(indexes))):
+                withdrawal_ids[i] = withdrawal_id
+            ledger.append_withdrawal_entries(cursors[shard], [(withdrawal_ids[i], *withdrawal_data[i][:3]) for i in indexes])
+            changefeed.record_changes(cursors[shard], "withdrawals", [withdrawal_ids[i] for i in indexes])
+    return withdrawal_ids
+
+def _insert_transfers_sharded(insert_query, transfer_data, starting_balances):
+    # The transfer row goes to the sender's shard and each ledger entry to the shard of its account.
+    groups = sharding.group_by_shard(range(len(transfer_data)), lambda i: sharding.shard_for_id(transfer_data[i][0]))
+    receiving_shards = {sharding.shard_for_id(data[1]) for data in transfer_data}
+    transfer_ids = [None] * len(transfer_data)
+    with sharding.transaction(set(groups) | receiving_shards) as cursors:
+        _lock_debited_accounts(cursors, [data[0] for data in transfer_data], starting_balances)
+        for shard, indexes in groups.items():
+            cursors[shard].executemany(insert_query, [transfer_data[i] for i in indexes])
+            for i, transfer_id in zip(indexes, sharding.inserted_ids(cursors[shard], len(indexes))):
+                transfer_ids[i] = transfer_id
+            changefeed.record_changes(cursors[shard], "transfers", [transfer_ids[i] for i in indexes])
+        entries = ledger.transfer_entries([
+            (transfer_id, data[0], data[1], data[2], data[3])
+            for transfer_id, data in zip(transfer_ids, transfer_data)
+        ])
+        for shard, shard_entries in sharding.group_by_shard(entries, lambda entry: sharding.shard_for_id(entry[0])).items():
+            ledger.append_entries(cursors[shard], shard_entries)
+    return transfer_ids
+
+def _account_numbers(cursor, account_ids):
+    if sharding.SHARDING_ENABLED:
+        return sharding.account_numbers(account_ids)
+    account_numbers = {}
+    for chunk in _chunks(account_ids):
+        cursor.execute(f"SELECT account_id, account_number FROM accounts WHERE account_id IN ({_placeholders(chunk)})", tuple(chunk))
+        account_numbers.update((row["account_id"], row["account_number"]) for row in cursor.fetchall())
+    return account_numbers
+
+def _accounts_by_number(cursor, account_numbers):
+    accounts = []
+    for chunk in _chunks(account_numbers):
+        cursor.execute(f"""
+        SELECT a.account_id, a.id_client, a.account_number, a.balance, c.name, c.last_name
+        FROM accounts a
+        JOIN clients c ON a.id_client = c.id_client
+        WHERE a.account_number IN ({_placeholders(chunk)})
+        """, tuple(chunk))
+        rows = cursor.fetchall()
+        balances = ledger.current_balances(cursor, [row["account_id"] for row in rows])
+        accounts.extend(
+            {
+                "account_id": account["account_id"],
+                "id_client": account["id_client"],
+                "account_number": account["account_number"],
+                "balance": Money(balances[account["account_id"]]) if account["account_id"] in balances else account["balance"],
+                "client_full_name": f"{account['name']} {account['last_name']}"
+            }
+            for account in rows
+        )
+    return accounts
+
+def _account_id(cursor, account_number):
+    if sharding.SHARDING_ENABLED:
+        return sharding.resolve_accounts([account_number]).get(account_number)
+    cursor.execute("SELECT account_id FROM accounts WHERE account_number = %s", (account_number,))
+    account = cursor.fetchone()
+    return account["account_id"] if account else None
+
+def _archived_transfers(cursor, account_column, account_number, start_date, end_date):
+    if not archive.covers("transfers", start_date, end_date):
+        return []
+    account_id = _account_id(cursor, account_number)
+    if account_id is None:
+        return []
+    
+    transfers = archive.read_rows("transfers", start_date, end_date, account_column, {account_id})
+    account_numbers = _account_numbers(cursor, [transfer["to_account_id"] for transfer in transfers])
+    for transfer in transfers:
+        transfer["to_account_number"] = account_numbers.get(transfer["to_account_id"])
+    return transfers
+
+def _with_account_numbers(cursor, withdrawals):
+    account_numbers = _account_numbers(cursor, [withdrawal["account_id"] for withdrawal in withdrawals])
+    for withdrawal in withdrawals:
+        withdrawal["account_number"] = account_numbers.get(withdrawal["account_id"])
+    return withdrawals
+
+def _with_transfer_account_numbers(cursor, transfers):
+    account_numbers = _account_numbers(cursor, [
+        account_id for transfer in transfers for account_id in (transfer["from_account_id"], transfer["to_account_id"])
+    ])
+    for transfer in transfers:
+        transfer["from_account_number"] = account_numbers.get(transfer["from_account_id"])
+        transfer["to_account_number"] = account_numbers.get(transfer["to_account_id"])
+    return transfers
+
+def _archived_batches(cursor, table, add_account_numbers):
+    # The archived months follow the rows still in MySQL, in chunks of the stream's size.
+    for rows in archive.month_batches(table):
+        for i in range(0, len(rows), streaming.STREAM_BATCH_SIZE):
+            yield add_account_numbers(cursor, rows[i:i + streaming.STREAM_BATCH_SIZE])
+
+def _archived_client_withdrawals(cursor, client_full_name, start_date, end_date):
+    if not archive.covers("withdrawals", start_date, end_date):
+        return None, []
+    accounts = _fetch_all(cursor, """
+    SELECT c.id_client, c.name, c.last_name, a.account_id
+    FROM clients c
+    INNER JOIN accounts a ON c.id_client = a.id_client
+    WHERE CONCAT(c.name, ' ', c.last_name) = %s
+    """, (client_full_name,))
+    if not accounts:
+        return None, []
+    
+    account_ids = {account["account_id"] for account in accounts}
+    return accounts[0], archive.read_rows("withdrawals", start_date, end_date, "account_id", account_ids)
+
+def _client_loan_status_sharded(cursor, client_full_name):
+    # The rows of the loans_status_by_client join: loans are on shard 0 and
+    # the accounts of the client on any shard, so they are joined here.
+    cursor.execute("""
+    SELECT c.id_client, c.name AS client_name, c.last_name AS client_last_name,
+        l.loan_id, l.amount AS loan_amount, l.status AS loan_status
+    FROM clients c
+    LEFT JOIN loans l ON c.id_client = l.ID_client
+    WHERE CONCAT(c.name, ' ', c.last_name) = %s
+    """, (client_full_name,))
+    loans = cursor.fetchall()
+    accounts = {}
+    for account in sharding.gather("""
+    SELECT a.id_client, a.account_id, a.account_number, a.balance
+    FROM clients c
+    JOIN accounts a ON c.id_client = a.id_client
+    WHERE CONCAT(c.name, ' ', c.last_name) = %s
+    """, (client_full_name,)):
+        accounts.setdefault(account["id_client"], []).append(account)
+
+    no_account = {"account_id": None, "account_number": None, "balance": None}
+    no_loan = {"loan_id": None, "loan_amount": None, "loan_status": None}
+    results = []
+    for id_client in dict.fromkeys(loan["id_client"] for loan in loans):
+        client_loans = [loan for loan in loans if loan["id_client"] == id_client]
+        if id_client not in accounts:
+            # Without an account the loans are not joined either.
+            results.append(dict(client_loans[0], **no_account, **no_loan))
+            continue
+        for account in accounts[id_client]:
+            results.extend(dict(loan, **account) for loan in client_loans)
+    return results
+
+def _account_counts_by_client():
+    counts = {}
+    for row in sharding.gather("SELECT id_client, COUNT(*) AS account_count FROM accounts GROUP BY id_client"):
+        counts[row["id_client"]] = counts.get(row["id_client"], 0) + row["account_count"]
+    return counts
+
+def _rows_per_account(batches, account_counts, filtered):
+    # Repeats each client and loan row once per account of the client, as the
+    # join through accounts does on a single database.
+    without_accounts = set()
+    for rows in batches:
+        expanded = []
+        for row in rows:
+            count = account_counts.get(row["id_client"], 0)
+            if count:
+                expanded.extend([row] * count)
+            elif not filtered and row["id_client"] not in without_accounts:
+                without_accounts.add(row["id_client"])
+                expanded.append(dict(row, employee_id=None, employee_name=None, position=None))
+        yield expanded
+
 @router.post("/clients", response_model=List[ClientResponse], tags=["clients"])
 async def create_clients_bulk(clients: List[ClientCreate]):
     connection = get_db_connection()
@@ -22,12 +316,23 @@ async def create_clients_bulk(clients: List[ClientCreate]):
         client_data = [(client.name, client.last_name, client.address, client.phone_number, 
                         client.email, client.identification_type, client.identification_number) 
                     for client in clients]
-        cursor.executemany(insert_query, client_data)
-        connection.commit()
+        if sharding.SHARDING_ENABLED:
+            client_ids = sharding.broadcast_insert("clients", (
+                "name", "last_name", "address", "phone_number", "email", "identification_type", "identification_number"
+            ), "id_client", client_data)
+        else:
+            cursor.executemany(insert_query, client_data)
+            connection.commit()
 
-        cursor.execute("SELECT LAST_INSERT_ID()")
-        last_id = cursor.fetchone()[0]
-        return [ClientResponse(id_client=last_id+i, **client.dict()) for i, client in enumerate(clients)]
+            cursor.execute("SELECT LAST_INSERT_ID()")
+            last_id = cursor.fetchone()[0]
+            client_ids = [last_id + i for i in range(len(clients))]
+        if client_search.loaded:
+            client_search.add_clients([
+                (client_id, client.name, client.last_name, client.email, client.identification_number)
+                for client_id, client in zip(client_ids, clients)
+            ])
+        return [ClientResponse(id_client=client_id, **client.dict()) for client_id, client in zip(client_ids, clients)]
     except Error as e:
         connection.rollback()
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -56,6 +361,64 @@ async def list_clients():
         cursor.close()
         connection.close()
 
+@router.get("/clients/search", response_model=List[dict], tags=["clients"])
+async def search_clients(q: str, limit: int = Query(10, ge=1, le=100)):
+    if client_search.loaded:
+        return await threadpool.run_in_threadpool(client_search.search, q, limit)
+    
+    terms = q.split()
+    if not terms:
+        return []
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    cursor = connection.cursor(dictionary=True)
+    try:
+        # Without the index only prefixes of whole columns match, unranked.
+        select_query = """
+        SELECT id_client, name, last_name, email, identification_number
+        FROM clients
+        WHERE {conditions}
+        LIMIT %s
+        """.format(conditions=" AND ".join(
+            ["(name LIKE %s OR last_name LIKE %s OR email LIKE %s OR identification_number LIKE %s)"] * len(terms)
+        ))
+        params = [f"{term}%" for term in terms for _ in range(4)]
+        cursor.execute(select_query, (*params, limit))
+        return cursor.fetchall()
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
+@router.get("/clients/search/stats", response_model=dict, tags=["clients"])
+async def get_client_search_stats():
+    return client_search.stats()
+
+@router.get("/clients/multi", response_model=List[ClientResponse], tags=["clients"])
+async def get_clients_multi(client_ids: List[int] = Query(...)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    cursor = connection.cursor(dictionary=True)
+    try:
+        clients = []
+        for chunk in _chunks(client_ids):
+            cursor.execute(f"""
+            SELECT id_client, name, last_name, address, phone_number, 
+                email, identification_type, identification_number 
+            FROM clients
+            WHERE id_client IN ({_placeholders(chunk)})
+            """, tuple(chunk))
+            clients.extend(cursor.fetchall())
+        return [ClientResponse(**client) for client in clients]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
 @router.post("/employees", response_model=List[EmployeeResponse], tags=["employees"])
 async def create_employees_bulk(employees: List[EmployeeCreate]):
     connection = get_db_connection()
@@ -69,6 +432,11 @@ async def create_employees_bulk(employees: List[EmployeeCreate]):
         VALUES (%s, %s, %s)
         """
         employee_data = [(employee.name, employee.position, employee.hire_date) for employee in employees]
+        if sharding.SHARDING_ENABLED:
+            employee_ids = sharding.broadcast_insert("employees", ("name", "position", "hire_date"), "employee_id", employee_data)
+            return [
+                EmployeeResponse(employee_id=employee_id, **employee.dict()) for employee_id, employee in zip(employee_ids, employees)
+            ]
         
         cursor.executemany(insert_query, employee_data)
         connection.commit()
@@ -106,6 +474,29 @@ async def list_employees():
         cursor.close()
         connection.close()
 
+@router.get("/employees/multi", response_model=List[EmployeeResponse], tags=["employees"])
+async def get_employees_multi(employee_ids: List[int] = Query(...)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        employees = []
+        for chunk in _chunks(employee_ids):
+            cursor.execute(f"""
+            SELECT employee_id, name, position, hire_date 
+            FROM employees
+            WHERE employee_id IN ({_placeholders(chunk)})
+            """, tuple(chunk))
+            employees.extend(cursor.fetchall())
+        return [EmployeeResponse(**employee) for employee in employees]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
 @router.post("/accounts/bulk", response_model=List[AccountResponse], tags=["accounts"])
 async def create_accounts_bulk(accounts: List[AccountCreate]):
     connection = get_db_connection()
@@ -128,12 +519,21 @@ async def create_accounts_bulk(accounts: List[AccountCreate]):
                 raise HTTPException(status_code=404, detail=f"Client '{account.client_full_name}' not found")
             
             id_client = client["id_client"]
-            account_data.append((id_client, account.account_number, account.balance))
-        cursor.executemany(insert_query, account_data)
-        connection.commit()
+            account_data.append((id_client, account.account_number, account.balance.to_decimal()))
+        if sharding.SHARDING_ENABLED:
+            account_ids = _insert_accounts_sharded(insert_query, account_data)
+        else:
+            cursor.executemany(insert_query, account_data)
+            last_id = cursor.lastrowid
+            account_ids = [last_id + i for i in range(len(accounts))]
+            ledger.open_accounts(cursor, [(account_ids[i], data[2]) for i, data in enumerate(account_data)])
+            connection.commit()
+        balance_index.add_accounts([
+            (account_ids[i], account.account_number, account_data[i][0], account.client_full_name, account.balance.cents)
+            for i, account in enumerate(accounts)
+        ])
         
-        last_id = cursor.lastrowid
-        return [AccountResponse(account_id=last_id + i, id_client=id_client, **account.dict())
+        return [AccountResponse(account_id=account_ids[i], id_client=id_client, **account.dict())
             for i, account in enumerate(accounts)]
     except Error as e:
         connection.rollback()
@@ -150,13 +550,12 @@ async def list_accounts():
     
     cursor = connection.cursor(dictionary=True)
     try:
-        select_query = """
+        select_query = f"""
         SELECT a.account_id, a.id_client, a.account_number, a.balance, c.name, c.last_name
-        FROM accounts a
+        FROM ({ledger.ACCOUNT_BALANCES_QUERY}) a
         JOIN clients c ON a.id_client = c.id_client
         """
-        cursor.execute(select_query)
-        accounts = cursor.fetchall()
+        accounts = _fetch_all(cursor, select_query)
         return [
             {
                 "account_id": account["account_id"],
@@ -173,57 +572,111 @@ async def list_accounts():
         cursor.close()
         connection.close()
 
-@router.post("/withdrawals/bulk", response_model=List[WithdrawalResponse], tags=["withdrawals"])
-async def create_withdrawals_bulk(withdrawals: List[WithdrawalCreate]):
+@router.get("/accounts/multi", response_model=List[AccountResponse], tags=["accounts"])
+async def get_accounts_multi(account_numbers: List[str] = Query(...)):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
     cursor = connection.cursor(dictionary=True)
     try:
-        withdrawal_data = []
-        account_ids = {}
+        if sharding.SHARDING_ENABLED:
+            groups = sharding.group_by_shard(dict.fromkeys(account_numbers), sharding.shard_for_account_number)
+            results = sharding.on_shards({
+                shard: lambda shard_cursor, numbers=numbers: _accounts_by_number(shard_cursor, numbers)
+                for shard, numbers in groups.items()
+            })
+            return [account for shard in sorted(results) for account in results[shard]]
+        return _accounts_by_number(cursor, account_numbers)
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
 
-        for withdrawal in withdrawals:
-            cursor.execute("SELECT account_id, balance FROM accounts WHERE account_number = %s", (withdrawal.account_number,))
-            account = cursor.fetchone()
-            
-            if not account:
-                raise HTTPException(status_code=404, detail=f"Account '{withdrawal.account_number}' not found")
-            
-            account_balance = Decimal(account["balance"])
-            withdrawal_amount = Decimal(withdrawal.amount)
-            
-            if account_balance < withdrawal_amount:
-                raise HTTPException(status_code=400, detail="Insufficient balance")
-            
-            withdrawal_data.append((account["account_id"], withdrawal_amount, withdrawal.withdrawal_date, withdrawal.withdrawal_method))
-            account_ids[account["account_id"]] = account_balance - withdrawal_amount
+@router.get("/accounts/balance_as_of", response_model=dict, tags=["accounts"])
+async def get_account_balance_as_of(account_number: str, as_of_date: date = None):
+    connection = _connection_for_account(account_number)
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT account_id FROM accounts WHERE account_number = %s", (account_number,))
+        account = cursor.fetchone()
+        
+        if not account:
+            raise HTTPException(status_code=404, detail=f"Account '{account_number}' not found")
+        
+        if as_of_date is None:
+            balance = ledger.current_balances(cursor, [account["account_id"]]).get(account["account_id"])
+        else:
+            balance = ledger.balance_as_of(cursor, account["account_id"], as_of_date)
+        
+        if balance is None:
+            raise HTTPException(status_code=404, detail="Account has no ledger balance for this date")
+        
+        return {
+            "account_id": account["account_id"],
+            "account_number": account_number,
+            "as_of_date": as_of_date if as_of_date is not None else date.today(),
+            "balance": Money(balance)
+        }
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
 
-        for account_id, new_balance in account_ids.items():
-            cursor.execute("UPDATE accounts SET balance = %s WHERE account_id = %s", (new_balance, account_id))
+@router.post("/withdrawals/bulk", response_model=List[WithdrawalResponse], tags=["withdrawals"])
+async def create_withdrawals_bulk(withdrawals: List[WithdrawalCreate], response: Response, partial: bool = False):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        checked = preflight.check_withdrawals(cursor, withdrawals)
+        accepted = _accepted_rows(checked, partial, response)
+        withdrawal_data = [
+            (checked.account_ids[withdrawals[i].account_number], withdrawals[i].amount.to_decimal(),
+             withdrawals[i].withdrawal_date, withdrawals[i].withdrawal_method)
+            for i in accepted
+        ]
 
         insert_query = """
         INSERT INTO withdrawals (account_id, amount, withdrawal_date, withdrawal_method)
         VALUES (%s, %s, %s, %s)
         """
-        cursor.executemany(insert_query, withdrawal_data)
-        connection.commit()
-        
-        withdrawal_ids = []
-        for i in range(len(withdrawal_data)):
-            withdrawal_ids.append(cursor.lastrowid - len(withdrawal_data) + 1 + i)
+        if sharding.SHARDING_ENABLED:
+            withdrawal_ids = _insert_withdrawals_sharded(insert_query, withdrawal_data, checked.starting_balances)
+        else:
+            cursor.executemany(insert_query, withdrawal_data)
+            
+            withdrawal_ids = []
+            for i in range(len(withdrawal_data)):
+                withdrawal_ids.append(cursor.lastrowid + i)
+
+            ledger.append_withdrawal_entries(cursor, [
+                (withdrawal_id, data[0], data[1], data[2])
+                for data, withdrawal_id in zip(withdrawal_data, withdrawal_ids)
+            ])
+            changefeed.record_changes(cursor, "withdrawals", withdrawal_ids)
+            connection.commit()
+        balance_index.update_balances(checked.balances)
+        checked.velocity.commit()
+        changefeed.notify()
 
         return [
             WithdrawalResponse(
                 withdrawal_id=withdrawal_id,
                 account_id=data[0],
                 account_number=withdrawals[i].account_number,
-                amount=float(data[1]),
+                amount=withdrawals[i].amount,
                 withdrawal_date=data[2],
                 withdrawal_method=data[3]
             )
-            for i, (data, withdrawal_id) in enumerate(zip(withdrawal_data, withdrawal_ids))
+            for i, data, withdrawal_id in zip(accepted, withdrawal_data, withdrawal_ids)
         ]
     
     except Error as e:
@@ -243,87 +696,79 @@ async def list_withdrawals():
     try:
         select_query = """
         SELECT w.withdrawal_id, w.account_id, w.amount, w.withdrawal_date, w.withdrawal_method,
-            a.account_number, c.name, c.last_name
+            a.account_number
         FROM withdrawals w
         JOIN accounts a ON w.account_id = a.account_id
         JOIN clients c ON a.id_client = c.id_client
         """
-        cursor.execute(select_query)
-        withdrawals = cursor.fetchall()
-        return [
-            {
-                "withdrawal_id": withdrawal["withdrawal_id"],
-                "account_id": withdrawal["account_id"],
-                "amount": withdrawal["amount"],
-                "withdrawal_date": withdrawal["withdrawal_date"],
-                "withdrawal_method": withdrawal["withdrawal_method"],
-                "account_number": withdrawal["account_number"],
-                "client_full_name": f"{withdrawal['name']} {withdrawal['last_name']}"
-            }
-            for withdrawal in withdrawals
-        ]
+        batches = itertools.chain(
+            _row_batches(cursor, select_query),
+            _archived_batches(cursor, "withdrawals", _with_account_numbers)
+        )
     except Error as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    finally:
         cursor.close()
         connection.close()
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    # The rows are read while the response is sent; it closes the cursor and connection.
+    return JSONArrayResponse(batches, lambda withdrawal: {
+        "withdrawal_id": withdrawal["withdrawal_id"],
+        "account_id": withdrawal["account_id"],
+        "amount": withdrawal["amount"],
+        "withdrawal_date": withdrawal["withdrawal_date"],
+        "withdrawal_method": withdrawal["withdrawal_method"],
+        "account_number": withdrawal["account_number"]
+    }, cursor, connection)
 
 @router.post("/transfers/bulk", response_model=List[TransferResponse], tags=["transfers"])
-async def create_transfers_bulk(transfers: List[TransferCreate]):
+async def create_transfers_bulk(transfers: List[TransferCreate], response: Response, partial: bool = False):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
     cursor = connection.cursor(dictionary=True)
     try:
-        transfer_data = []
-        account_balances = {}
-
-        for transfer in transfers:
-            cursor.execute("SELECT account_id, balance FROM accounts WHERE account_number = %s", (transfer.from_account_number,))
-            from_account = cursor.fetchone()
-            
-            if not from_account:
-                raise HTTPException(status_code=404, detail=f"From account '{transfer.from_account_number}' not found")
-            
-            cursor.execute("SELECT account_id FROM accounts WHERE account_number = %s", (transfer.to_account_number,))
-            to_account = cursor.fetchone()
-            
-            if not to_account:
-                raise HTTPException(status_code=404, detail=f"To account '{transfer.to_account_number}' not found")
-            
-            if from_account["balance"] < transfer.amount:
-                raise HTTPException(status_code=400, detail="Insufficient balance in the from account")
-            
-            transfer_data.append((from_account["account_id"], to_account["account_id"], transfer.amount, transfer.transfer_date, transfer.transfer_method, transfer.status))
-            account_balances[from_account["account_id"]] = from_account["balance"] - transfer.amount  
-            account_balances[to_account["account_id"]] = account_balances.get(to_account["account_id"], 0) + transfer.amount  
-
-        for account_id, new_balance in account_balances.items():
-            cursor.execute("UPDATE accounts SET balance = %s WHERE account_id = %s", (new_balance, account_id))
+        checked = preflight.check_transfers(cursor, transfers)
+        accepted = _accepted_rows(checked, partial, response)
+        transfer_data = [
+            (checked.account_ids[transfers[i].from_account_number], checked.account_ids[transfers[i].to_account_number],
+             transfers[i].amount.to_decimal(), transfers[i].transfer_date, transfers[i].transfer_method, transfers[i].status)
+            for i in accepted
+        ]
         
         insert_query = """
         INSERT INTO transfers (from_account_id, to_account_id, amount, transfer_date, transfer_method, status)
         VALUES (%s, %s, %s, %s, %s, %s)
         """
-        cursor.executemany(insert_query, transfer_data)
-        connection.commit()
-        
-        transfer_ids = []
-        for i in range(len(transfer_data)):
-            transfer_ids.append(cursor.lastrowid - len(transfer_data) + 1 + i)
+        if sharding.SHARDING_ENABLED:
+            transfer_ids = _insert_transfers_sharded(insert_query, transfer_data, checked.starting_balances)
+        else:
+            cursor.executemany(insert_query, transfer_data)
+            
+            transfer_ids = []
+            for i in range(len(transfer_data)):
+                transfer_ids.append(cursor.lastrowid + i)
+
+            ledger.append_transfer_entries(cursor, [
+                (transfer_id, data[0], data[1], data[2], data[3])
+                for data, transfer_id in zip(transfer_data, transfer_ids)
+            ])
+            changefeed.record_changes(cursor, "transfers", transfer_ids)
+            connection.commit()
+        balance_index.update_balances(checked.balances)
+        transfer_graphs.add_transfers([(data[0], data[1], data[2], data[3]) for data in transfer_data])
+        changefeed.notify()
 
         return [
             TransferResponse(
                 transfer_id=transfer_id,
                 from_account_number=transfers[i].from_account_number,
                 to_account_number=transfers[i].to_account_number,
-                amount=transfer_data[i][2], 
-                transfer_date=transfer_data[i][3],  
-                transfer_method=transfer_data[i][4],  
-                status=transfer_data[i][5]  
+                amount=transfers[i].amount,
+                transfer_date=data[3],  
+                transfer_method=data[4],  
+                status=data[5]  
             )
-            for i, transfer_id in enumerate(transfer_ids)
+            for i, data, transfer_id in zip(accepted, transfer_data, transfer_ids)
         ]
     except Error as e:
         connection.rollback()
@@ -333,6 +778,7 @@ async def create_transfers_bulk(transfers: List[TransferCreate]):
         connection.close()
 
 @router.get("/transfers", response_model=List[TransferResponse], tags=["transfers"])
+@query_guard.off_event_loop
 async def list_transfers():
     connection = get_db_connection()
     if not connection:
@@ -347,69 +793,63 @@ async def list_transfers():
         JOIN accounts fa ON t.from_account_id = fa.account_id
         JOIN accounts ta ON t.to_account_id = ta.account_id
         """
-        cursor.execute(select_query)
-        transfers = cursor.fetchall()
-        
-        return [
-            {
-                "transfer_id": transfer["transfer_id"],
-                "from_account_number": transfer["from_account_number"],
-                "to_account_number": transfer["to_account_number"],
-                "amount": transfer["amount"],
-                "transfer_date": transfer["transfer_date"],
-                "transfer_method": transfer["transfer_method"],
-                "status": transfer["status"]
-            }
-            for transfer in transfers
-        ]
+        if sharding.SHARDING_ENABLED:
+            # The receiving account may live on another shard than the transfer.
+            batches = [_with_to_account_numbers(sharding.gather("""
+            SELECT t.transfer_id, t.amount, t.transfer_date, t.transfer_method, t.status, t.to_account_id,
+                fa.account_number AS from_account_number
+            FROM transfers t
+            JOIN accounts fa ON t.from_account_id = fa.account_id
+            """))]
+        else:
+            cursor.execute(select_query)
+            batches = streaming.cursor_batches(cursor)
+        batches = itertools.chain(batches, _archived_batches(cursor, "transfers", _with_transfer_account_numbers))
     except Error as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    finally:
         cursor.close()
         connection.close()
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    return JSONArrayResponse(batches, lambda transfer: {
+        "transfer_id": transfer["transfer_id"],
+        "from_account_number": transfer["from_account_number"],
+        "to_account_number": transfer["to_account_number"],
+        "amount": transfer["amount"],
+        "transfer_date": transfer["transfer_date"],
+        "transfer_method": transfer["transfer_method"],
+        "status": transfer["status"]
+    }, cursor, connection)
 
 @router.post("/loans/bulk", response_model=List[LoanResponse], tags=["loans"])
-async def create_loans_bulk(loans: List[LoanCreate]):
+async def create_loans_bulk(loans: List[LoanCreate], response: Response, partial: bool = False):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
     cursor = connection.cursor(dictionary=True)
     try:
-        loan_data = []
-        client_ids = {}
-        employee_ids = {}
-
-        for loan in loans:
-            cursor.execute("SELECT id_client FROM clients WHERE CONCAT(name, ' ', last_name) = %s", (loan.client_full_name,))
-            client = cursor.fetchone()
-            
-            if not client:
-                raise HTTPException(status_code=404, detail=f"Client '{loan.client_full_name}' not found")
-            client_ids[loan.client_full_name] = client["id_client"]
-
-            cursor.execute("SELECT employee_id FROM employees WHERE name = %s", (loan.employee_full_name,))
-            employee = cursor.fetchone()
-            
-            if not employee:
-                raise HTTPException(status_code=404, detail=f"Employee '{loan.employee_full_name}' not found")
-            employee_ids[loan.employee_full_name] = employee["employee_id"]
-
-            loan_data.append((client_ids[loan.client_full_name], employee_ids[loan.employee_full_name], loan.amount, loan.interest_rate, loan.disbursement_date, loan.due_date, loan.balance, loan.status))
+        checked = preflight.check_loans(cursor, loans)
+        accepted = _accepted_rows(checked, partial, response)
+        loan_data = [
+            (checked.client_ids[loans[i].client_full_name], checked.employee_ids[loans[i].employee_full_name], loans[i].amount.to_decimal(),
+             loans[i].interest_rate, loans[i].disbursement_date, loans[i].due_date, loans[i].balance.to_decimal(), loans[i].status)
+            for i in accepted
+        ]
 
         insert_query = """
         INSERT INTO loans (ID_client, employee_id, amount, interest_rate, disbursement_date, due_date, balance, status)
         VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
         """
         cursor.executemany(insert_query, loan_data)
-        connection.commit()
         
         loan_ids = []
         for i in range(len(loan_data)):
-            loan_ids.append(cursor.lastrowid - len(loan_data) + 1 + i)
+            loan_ids.append(cursor.lastrowid + i)
+        changefeed.record_changes(cursor, "loans", loan_ids)
+        connection.commit()
+        changefeed.notify()
         return [
-            LoanResponse(loan_id=loan_id, **loan.dict())
-            for i, loan_id in enumerate(loan_ids)
+            LoanResponse(loan_id=loan_id, **loans[i].dict())
+            for i, loan_id in zip(accepted, loan_ids)
         ]
     except Error as e:
         connection.rollback()
@@ -436,31 +876,25 @@ async def list_loans():
         JOIN employees e ON l.employee_id = e.employee_id
         """
         cursor.execute(select_query)
-        loans = cursor.fetchall()
-        
-        return [
-            {
-                "loan_id": loan["loan_id"],
-                "client_full_name": f"{loan['client_name']} {loan['client_last_name']}",
-                "employee_full_name": f"{loan['employee_name']}",
-                "amount": loan["amount"],
-                "interest_rate": loan["interest_rate"],
-                "disbursement_date": loan["disbursement_date"],
-                "due_date": loan["due_date"],
-                "balance": loan["balance"],
-                "status": loan["status"]
-            }
-            for loan in loans
-        ]
     except Error as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    finally:
         cursor.close()
         connection.close()
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    return JSONArrayResponse(streaming.cursor_batches(cursor), lambda loan: {
+        "loan_id": loan["loan_id"],
+        "client_full_name": f"{loan['client_name']} {loan['client_last_name']}",
+        "employee_full_name": f"{loan['employee_name']}",
+        "amount": loan["amount"],
+        "interest_rate": loan["interest_rate"],
+        "disbursement_date": loan["disbursement_date"],
+        "due_date": loan["due_date"],
+        "balance": loan["balance"],
+        "status": loan["status"]
+    }, cursor, connection)
 
 
 @router.get("/loans/summary_by_client_amount_count_loans", response_model=dict, tags=["loans"])
-async def get_loans_summary_by_client(client_full_name: str):
+async def get_loans_summary_by_client(client_full_name: str, response: Response = None):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -474,10 +908,13 @@ async def get_loans_summary_by_client(client_full_name: str):
         FROM clients c
         LEFT JOIN loans l ON c.id_client = l.ID_client
         WHERE CONCAT(c.name, ' ', c.last_name) = %s
-        GROUP BY c.id_client
+        GROUP BY c.id_client, c.name, c.last_name
         """
-        cursor.execute(select_query, (client_full_name,))
-        summary = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (client_full_name,))
+        if rows is None:
+            cursor.execute(select_query, (client_full_name,))
+            rows = cursor.fetchall()
+        summary = rows[0] if rows else None
         
         if not summary:
             raise HTTPException(status_code=404, detail="Client not found or has no loans")
@@ -495,7 +932,7 @@ async def get_loans_summary_by_client(client_full_name: str):
         connection.close()
 
 @router.get("/loans/summary_by_employee_amount_count_loans", response_model=dict, tags=["loans"])
-async def get_loans_summary_by_employee(employee_full_name: str):
+async def get_loans_summary_by_employee(employee_full_name: str, response: Response = None):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -509,10 +946,13 @@ async def get_loans_summary_by_employee(employee_full_name: str):
         FROM employees e
         LEFT JOIN loans l ON e.employee_id = l.employee_id
         WHERE e.name = %s
-        GROUP BY e.employee_id
+        GROUP BY e.employee_id, e.name
         """
-        cursor.execute(select_query, (employee_full_name,))
-        summary = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (employee_full_name,))
+        if rows is None:
+            cursor.execute(select_query, (employee_full_name,))
+            rows = cursor.fetchall()
+        summary = rows[0] if rows else None
         
         if not summary:
             raise HTTPException(status_code=404, detail="Employee not found or has no loans")
@@ -530,7 +970,7 @@ async def get_loans_summary_by_employee(employee_full_name: str):
         connection.close()
 
 @router.get("/withdrawals/withdrawals_average_by_client", response_model=dict, tags=["withdrawals"])
-async def get_average_withdrawals_by_client(client_full_name: str):
+async def get_average_withdrawals_by_client(client_full_name: str, response: Response = None):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -544,10 +984,30 @@ async def get_average_withdrawals_by_client(client_full_name: str):
         INNER JOIN accounts a ON c.id_client = a.id_client
         INNER JOIN withdrawals w ON a.account_id = w.account_id
         WHERE CONCAT(c.name, ' ', c.last_name) = %s
-        GROUP BY c.id_client
+        GROUP BY c.id_client, c.name, c.last_name
         """
-        cursor.execute(select_query, (client_full_name,))
-        average = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (client_full_name,))
+        if rows is not None:
+            # The mirror already holds the archived months.
+            average = rows[0] if rows else None
+        else:
+            # An average of averages is wrong, so each shard and the archive give their sum and count.
+            rows = _fetch_all(cursor, """
+            SELECT c.id_client, c.name, c.last_name,
+                SUM(w.amount) AS total_amount, COUNT(w.withdrawal_id) AS withdrawal_count
+            FROM clients c
+            INNER JOIN accounts a ON c.id_client = a.id_client
+            INNER JOIN withdrawals w ON a.account_id = w.account_id
+            WHERE CONCAT(c.name, ' ', c.last_name) = %s
+            GROUP BY c.id_client, c.name, c.last_name
+            """, (client_full_name,))
+            client, archived = _archived_client_withdrawals(cursor, client_full_name, date.min, date.max)
+            average = None
+            if rows or archived:
+                rows = _first_client_rows(rows) if rows else []
+                total_amount = sum(row["total_amount"] for row in rows) + sum(withdrawal["amount"] for withdrawal in archived)
+                withdrawal_count = sum(row["withdrawal_count"] for row in rows) + len(archived)
+                average = dict(rows[0] if rows else client, average_withdrawal=total_amount / withdrawal_count)
         
         if not average:
             raise HTTPException(status_code=404, detail="Client not found or has no withdrawals")
@@ -565,7 +1025,7 @@ async def get_average_withdrawals_by_client(client_full_name: str):
 
 
 @router.get("/withdrawals/count_and_amounts_by_client_and_date", response_model=dict, tags=["withdrawals"])
-async def get_count_and_amounts_withdrawals_by_client_and_date(client_full_name: str, withdrawal_date: date):
+async def get_count_and_amounts_withdrawals_by_client_and_date(client_full_name: str, withdrawal_date: date, response: Response = None):
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -581,19 +1041,39 @@ async def get_count_and_amounts_withdrawals_by_client_and_date(client_full_name:
         INNER JOIN withdrawals w ON a.account_id = w.account_id
         WHERE CONCAT(c.name, ' ', c.last_name) = %s
         AND w.withdrawal_date = %s
-        GROUP BY c.id_client
+        GROUP BY c.id_client, c.name, c.last_name
         """
-        cursor.execute(select_query, (client_full_name, withdrawal_date))
-        result = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (client_full_name, withdrawal_date))
+        if rows is not None:
+            # The mirror already holds the archived months.
+            result, client, archived = rows[0] if rows else None, None, []
+        else:
+            if sharding.SHARDING_ENABLED:
+                rows = sharding.gather(select_query, (client_full_name, withdrawal_date))
+                result = None
+                if rows:
+                    rows = _first_client_rows(rows)
+                    result = dict(rows[0],
+                                  withdrawal_count=sum(row["withdrawal_count"] for row in rows),
+                                  withdrawal_amounts=",".join(row["withdrawal_amounts"] for row in rows if row["withdrawal_amounts"]))
+            else:
+                cursor.execute(select_query, (client_full_name, withdrawal_date))
+                result = cursor.fetchone()
+            client, archived = _archived_client_withdrawals(cursor, client_full_name, withdrawal_date, withdrawal_date)
         
-        if not result:
+        if not result and not archived:
             raise HTTPException(status_code=404, detail="Client not found or has no withdrawals on this date")
         
+        if not result:
+            result = {"id_client": client["id_client"], "name": client["name"], "last_name": client["last_name"],
+                      "withdrawal_count": 0, "withdrawal_amounts": None}
+        
         return {
             "client_id": result["id_client"],
             "client_full_name": f"{result['name']} {result['last_name']}",
-            "withdrawal_count": result["withdrawal_count"] if result["withdrawal_count"] is not None else 0,
-            "withdrawal_amounts": result["withdrawal_amounts"].split(',') if result["withdrawal_amounts"] else []
+            "withdrawal_count": (result["withdrawal_count"] if result["withdrawal_count"] is not None else 0) + len(archived),
+            "withdrawal_amounts": (result["withdrawal_amounts"].split(',') if result["withdrawal_amounts"] else [])
+                + [str(withdrawal["amount"]) for withdrawal in archived]
         }
     except Error as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -602,6 +1082,7 @@ async def get_count_and_amounts_withdrawals_by_client_and_date(client_full_name:
         connection.close()
 
 @router.get("/clients_by_employee", response_model=List[dict], tags=["clients"])
+@query_guard.off_event_loop
 async def get_clients_with_employees(employee_name: str = None):  
     connection = get_db_connection()
     if not connection:
@@ -618,29 +1099,37 @@ async def get_clients_with_employees(employee_name: str = None):
         RIGHT JOIN clients c ON a.id_client = c.id_client
         """
         
+        params = ()
+        if sharding.SHARDING_ENABLED:
+            # Accounts are spread over the shards: the clients and their loans
+            # come from shard 0 and are repeated once per account.
+            account_counts = _account_counts_by_client()
+            select_query = """
+            SELECT e.employee_id, e.name AS employee_name, e.position, 
+                c.id_client, c.name AS client_name, c.last_name AS client_last_name
+            FROM clients c
+            LEFT JOIN loans l ON c.id_client = l.ID_client
+            LEFT JOIN employees e ON e.employee_id = l.employee_id
+            """
+        
         if employee_name is not None:  
             select_query += " WHERE e.name = %s"
-            cursor.execute(select_query, (employee_name,))
-        else:
-            cursor.execute(select_query)
-        
-        results = cursor.fetchall()
-        
-        return [
-            {
-                "employee_id": result["employee_id"],
-                "employee_name": result["employee_name"] if result["employee_name"] else "No assigned employee",
-                "position": result["position"] if result["position"] else "No position",
-                "client_id": result["id_client"],
-                "client_full_name": f"{result['client_name']} {result['client_last_name']}" if result["client_name"] else "No client name"
-            }
-            for result in results
-        ]
+            params = (employee_name,)
+        cursor.execute(select_query, params)
+        batches = streaming.cursor_batches(cursor)
+        if sharding.SHARDING_ENABLED:
+            batches = _rows_per_account(batches, account_counts, employee_name is not None)
     except Error as e:
-        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
-    finally:
         cursor.close()
         connection.close()
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    return JSONArrayResponse(batches, lambda result: {
+        "employee_id": result["employee_id"],
+        "employee_name": result["employee_name"] if result["employee_name"] else "No assigned employee",
+        "position": result["position"] if result["position"] else "No position",
+        "client_id": result["id_client"],
+        "client_full_name": f"{result['client_name']} {result['client_last_name']}" if result["client_name"] else "No client name"
+    }, cursor, connection)
 
 @router.get("/loans_status_by_client", response_model=List[dict], tags=["clients"])
 async def get_clients_loan_status(client_full_name: str):  
@@ -659,11 +1148,19 @@ async def get_clients_loan_status(client_full_name: str):
         LEFT JOIN loans l ON a.id_client = l.ID_client
         WHERE CONCAT(c.name, ' ', c.last_name) = %s
         """
-        cursor.execute(select_query, (client_full_name,))
-        results = cursor.fetchall()
+        if sharding.SHARDING_ENABLED:
+            results = _client_loan_status_sharded(cursor, client_full_name)
+        else:
+            cursor.execute(select_query, (client_full_name,))
+            results = cursor.fetchall()
         
         if not results:
             raise HTTPException(status_code=404, detail="Client not found")
+        account_ids = {result["account_id"] for result in results if result["account_id"] is not None}
+        if sharding.SHARDING_ENABLED:
+            balances = sharding.current_balances(account_ids)
+        else:
+            balances = ledger.current_balances(cursor, account_ids)
         
         return [
             {
@@ -671,7 +1168,7 @@ async def get_clients_loan_status(client_full_name: str):
                 "client_full_name": f"{result['client_name']} {result['client_last_name']}",
                 "account_id": result["account_id"],
                 "account_number": result["account_number"],
-                "balance": result["balance"],
+                "balance": Money(balances[result["account_id"]]) if result["account_id"] in balances else result["balance"],
                 "loan_id": result["loan_id"],
                 "loan_amount": result["loan_amount"] if result["loan_amount"] is not None else 0.0,
                 "loan_status": result["loan_status"] if result["loan_status"] else "No loan"
@@ -685,22 +1182,29 @@ async def get_clients_loan_status(client_full_name: str):
         connection.close()
 
 @router.get("/accounts_above_min_balance", response_model=List[dict], tags=["accounts"])
-async def get_accounts_above_balance(min_balance: float):  
+async def get_accounts_above_balance(min_balance: float, limit: int = Query(None, ge=1)):
+    _check_min_balance(min_balance)
+    if balance_index.loaded:
+        return balance_index.accounts_above(min_balance, limit)
+    
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
     cursor = connection.cursor(dictionary=True)
     try:
-        select_query = """
+        select_query = f"""
         SELECT a.account_id, a.account_number, a.balance,
             c.id_client, c.name AS client_name, c.last_name AS client_last_name
-        FROM accounts a
+        FROM ({ledger.ACCOUNT_BALANCES_QUERY}) a
         LEFT JOIN clients c ON a.id_client = c.id_client
         WHERE a.balance > %s
         """
-        cursor.execute(select_query, (min_balance,))
-        results = cursor.fetchall()
+        if limit is not None:
+            select_query += " LIMIT %s"
+            results = _fetch_all(cursor, select_query, (min_balance, limit))[:limit]
+        else:
+            results = _fetch_all(cursor, select_query, (min_balance,))
         
         return [
             {
@@ -720,19 +1224,25 @@ async def get_accounts_above_balance(min_balance: float):
 
 @router.get("/count_accounts_above_min_balance", response_model=dict, tags=["accounts"])
 async def count_accounts_above_balance(min_balance: float):  # Parámetro para el saldo mínimo
+    _check_min_balance(min_balance)
+    if balance_index.loaded:
+        return {
+            "min_balance": min_balance,
+            "account_count": balance_index.count_above(min_balance)
+        }
+    
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
     cursor = connection.cursor(dictionary=True)
     try:
-        select_query = """
+        select_query = f"""
         SELECT COUNT(*) AS account_count
-        FROM accounts
-        WHERE balance > %s
+        FROM ({ledger.ACCOUNT_BALANCES_QUERY}) a
+        WHERE a.balance > %s
         """
-        cursor.execute(select_query, (min_balance,))
-        result = cursor.fetchone()
+        result = _sum_rows(_fetch_all(cursor, select_query, (min_balance,)), ("account_count",))
         return {
             "min_balance": min_balance,
             "account_count": result["account_count"]
@@ -743,9 +1253,26 @@ async def count_accounts_above_balance(min_balance: float):  # Parámetro para e
         cursor.close()
         connection.close()
 
+@router.get("/accounts/balance_index/consistency", response_model=dict, tags=["accounts"])
+async def check_balance_index_consistency(repair: bool = False):
+    if not balance_index.loaded:
+        raise HTTPException(status_code=503, detail="Balance index is not loaded")
+    
+    connections = _shard_connections()
+    if not connections:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    try:
+        return balance_index.check_consistency(*connections, repair=repair)
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        for connection in connections:
+            connection.close()
+
 @router.get("/transfers_by_account_and_date_range", response_model=List[dict], tags=["transfers"])
-async def transfers_by_account_and_date_range(start_date: date, end_date: date, from_account_number: str):  
-    connection = get_db_connection()
+async def transfers_by_account_and_date_range(start_date: date, end_date: date, from_account_number: str, response: Response = None):  
+    connection = _connection_for_account(from_account_number)
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
     
@@ -759,8 +1286,24 @@ async def transfers_by_account_and_date_range(start_date: date, end_date: date,
         JOIN accounts ta ON t.to_account_id = ta.account_id
         WHERE fa.account_number = %s AND t.transfer_date BETWEEN %s AND %s
         """
-        cursor.execute(select_query, (from_account_number, start_date, end_date))
-        results = cursor.fetchall()
+        results = _mirror_rows(response, select_query, (from_account_number, start_date, end_date))
+        mirrored = results is not None
+        if mirrored:
+            # The mirror already holds the archived months.
+            pass
+        elif sharding.SHARDING_ENABLED:
+            cursor.execute("""
+            SELECT t.transfer_id, t.amount, t.transfer_date, t.transfer_method, t.status, t.to_account_id
+            FROM transfers t
+            JOIN accounts fa ON t.from_account_id = fa.account_id
+            WHERE fa.account_number = %s AND t.transfer_date BETWEEN %s AND %s
+            """, (from_account_number, start_date, end_date))
+            results = _with_to_account_numbers(cursor.fetchall())
+        else:
+            cursor.execute(select_query, (from_account_number, start_date, end_date))
+            results = cursor.fetchall()
+        if not mirrored:
+            results += _archived_transfers(cursor, "from_account_id", from_account_number, start_date, end_date)
         
         if not results:
             raise HTTPException(status_code=404, detail="No transfers found for the specified account and date range.")
@@ -783,7 +1326,7 @@ async def transfers_by_account_and_date_range(start_date: date, end_date: date,
         connection.close()
 
 @router.get("/transfers_count_total_amount_by_toaccount_and_date_range", response_model=dict, tags=["transfers"])
-async def transfers_summary_to_specific_account(to_account_number: str, start_date: date, end_date: date):  
+async def transfers_summary_to_specific_account(to_account_number: str, start_date: date, end_date: date, response: Response = None):  
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -796,15 +1339,34 @@ async def transfers_summary_to_specific_account(to_account_number: str, start_da
         JOIN accounts ta ON t.to_account_id = ta.account_id
         WHERE ta.account_number = %s AND t.transfer_date BETWEEN %s AND %s
         """
-        cursor.execute(select_query, (to_account_number, start_date, end_date))
-        result = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (to_account_number, start_date, end_date))
+        archived = []
+        if rows is not None:
+            # The mirror already holds the archived months.
+            result = rows[0]
+        elif sharding.SHARDING_ENABLED:
+            # Transfers live on the sender's shard, so every shard may hold some.
+            to_account_id = sharding.resolve_accounts([to_account_number]).get(to_account_number)
+            result = _sum_rows(sharding.gather("""
+            SELECT COUNT(*) AS transfer_count, SUM(amount) AS total_amount
+            FROM transfers
+            WHERE to_account_id = %s AND transfer_date BETWEEN %s AND %s
+            """, (to_account_id, start_date, end_date)), ("transfer_count", "total_amount"))
+        else:
+            cursor.execute(select_query, (to_account_number, start_date, end_date))
+            result = cursor.fetchone()
+        if rows is None:
+            archived = _archived_transfers(cursor, "to_account_id", to_account_number, start_date, end_date)
+        total_amount = result["total_amount"] if result["total_amount"] is not None else 0.0
+        if archived:
+            total_amount = Money(to_cents(total_amount) + sum(to_cents(transfer["amount"]) for transfer in archived))
         
         return {
             "to_account_number": to_account_number,
             "start_date": start_date,
             "end_date": end_date,
-            "transfer_count": result["transfer_count"],
-            "total_amount": result["total_amount"] if result["total_amount"] is not None else 0.0
+            "transfer_count": result["transfer_count"] + len(archived),
+            "total_amount": total_amount
         }
     except Error as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -812,6 +1374,124 @@ async def transfers_summary_to_specific_account(to_account_number: str, start_da
         cursor.close()
         connection.close()
 
+@router.get("/transfers/analytics/top_counterparties", response_model=List[dict], tags=["transfers"])
+async def get_top_counterparties(account_number: str, start_date: date, end_date: date, limit: int = Query(10, ge=1, le=1000)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        account_id = _account_id(cursor, account_number)
+        
+        if account_id is None:
+            raise HTTPException(status_code=404, detail=f"Account '{account_number}' not found")
+        
+        graph = transfer_graphs.get(cursor, start_date, end_date)
+        counterparties = graph.top_counterparties(account_id, limit)
+        account_numbers = _account_numbers(cursor, [counterparty["account_id"] for counterparty in counterparties])
+        return [
+            {
+                "account_number": account_numbers.get(counterparty["account_id"]),
+                "sent": Money(counterparty["sent"]),
+                "received": Money(counterparty["received"]),
+                "transfer_count": counterparty["transfer_count"]
+            }
+            for counterparty in counterparties
+        ]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
+@router.get("/transfers/analytics/net_flow_by_client", response_model=List[dict], tags=["transfers"])
+async def get_net_flow_by_client(start_date: date, end_date: date, limit: int = Query(50, ge=1, le=1000)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        net_flow_by_account = transfer_graphs.get(cursor, start_date, end_date).net_flow_by_account()
+        account_ids = [account_id for account_id, amount in net_flow_by_account.items() if amount]
+        accounts_query = """
+        SELECT a.account_id, c.id_client, c.name, c.last_name
+        FROM accounts a
+        JOIN clients c ON a.id_client = c.id_client
+        WHERE a.account_id IN ({placeholders})
+        """
+        if sharding.SHARDING_ENABLED:
+            rows = sharding.lookup_by_account_id(account_ids, accounts_query)
+        else:
+            rows = []
+            for chunk in _chunks(account_ids):
+                cursor.execute(accounts_query.format(placeholders=_placeholders(chunk)), tuple(chunk))
+                rows.extend(cursor.fetchall())
+        clients = {}
+        for row in rows:
+            client = clients.setdefault(row["id_client"], {
+                "client_id": row["id_client"],
+                "client_full_name": f"{row['name']} {row['last_name']}",
+                "net_flow": 0
+            })
+            client["net_flow"] += net_flow_by_account[row["account_id"]]
+        ranked = sorted(clients.values(), key=lambda client: abs(client["net_flow"]), reverse=True)[:limit]
+        return [dict(client, net_flow=Money(client["net_flow"])) for client in ranked]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
+@router.get("/transfers/analytics/clusters", response_model=List[dict], tags=["transfers"])
+async def get_transfer_clusters(start_date: date, end_date: date, min_size: int = Query(2, ge=2, le=100000), limit: int = Query(50, ge=1, le=1000)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        graph = transfer_graphs.get(cursor, start_date, end_date)
+        components = (await threadpool.run_in_threadpool(graph.strongly_connected_components, max(min_size, 2)))[:limit]
+        account_numbers = _account_numbers(cursor, [account_id for component in components for account_id in component])
+        return [
+            {
+                "size": len(component),
+                "account_numbers": [account_numbers.get(account_id) for account_id in component]
+            }
+            for component in components
+        ]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
+@router.get("/transfers/analytics/round_trips", response_model=List[dict], tags=["transfers"])
+async def get_round_trip_transfers(start_date: date, end_date: date, max_length: int = Query(4, ge=2, le=8), limit: int = Query(100, ge=1, le=1000)):
+    connection = get_db_connection()
+    if not connection:
+        raise HTTPException(status_code=500, detail="Database connection failed")
+    
+    cursor = connection.cursor(dictionary=True)
+    try:
+        graph = transfer_graphs.get(cursor, start_date, end_date)
+        cycles = await threadpool.run_in_threadpool(graph.round_trips, max_length, limit)
+        account_numbers = _account_numbers(cursor, [account_id for cycle in cycles for account_id in cycle["accounts"]])
+        return [
+            {
+                "account_numbers": [account_numbers.get(account_id) for account_id in cycle["accounts"]],
+                "round_trip_amount": Money(cycle["round_trip_amount"])
+            }
+            for cycle in cycles
+        ]
+    except Error as e:
+        raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    finally:
+        cursor.close()
+        connection.close()
+
 @router.get("/employee_details_by_name", response_model=dict, tags=["employees"])
 async def get_employee_details_by_name(employee_name: str): 
     connection = get_db_connection()
@@ -844,7 +1524,7 @@ async def get_employee_details_by_name(employee_name: str):
         connection.close()
 
 @router.get("/loans_summary_by_name_employee", response_model=dict, tags=["employees"])
-async def get_employees_loans_summary_by_name(employee_name: str):  
+async def get_employees_loans_summary_by_name(employee_name: str, response: Response = None):  
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -856,10 +1536,13 @@ async def get_employees_loans_summary_by_name(employee_name: str):
         FROM employees e
         LEFT JOIN loans l ON e.employee_id = l.employee_id
         WHERE e.name = %s
-        GROUP BY e.employee_id
+        GROUP BY e.employee_id, e.name, e.position
         """
-        cursor.execute(select_query, (employee_name,))
-        result = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (employee_name,))
+        if rows is None:
+            cursor.execute(select_query, (employee_name,))
+            rows = cursor.fetchall()
+        result = rows[0] if rows else None
         
         if not result:
             raise HTTPException(status_code=404, detail="Employee not found or has no loans")
@@ -918,7 +1601,7 @@ async def get_loans_above_amount(min_amount: float):
         connection.close()
 
 @router.get("/withdrawals_sum_count_by_date_range_and_client", response_model=dict, tags=["withdrawals"])
-async def withdrawals_summary_by_client(client_full_name: str, start_date: date, end_date: date):  
+async def withdrawals_summary_by_client(client_full_name: str, start_date: date, end_date: date, response: Response = None):  
     connection = get_db_connection()
     if not connection:
         raise HTTPException(status_code=500, detail="Database connection failed")
@@ -932,18 +1615,29 @@ async def withdrawals_summary_by_client(client_full_name: str, start_date: date,
         JOIN clients c ON a.id_client = c.id_client
         WHERE CONCAT(c.name, ' ', c.last_name) = %s AND w.withdrawal_date BETWEEN %s AND %s
         """
-        cursor.execute(select_query, (client_full_name, start_date, end_date))
-        result = cursor.fetchone()
+        rows = _mirror_rows(response, select_query, (client_full_name, start_date, end_date))
+        mirrored = rows is not None
+        if not mirrored:
+            rows = _fetch_all(cursor, select_query, (client_full_name, start_date, end_date))
+        result = _sum_rows(rows, ("total_withdrawals", "total_amount"))
         
         if not result:
             raise HTTPException(status_code=404, detail="No withdrawals found for the specified client in the given date range.")
         
+        archived = []
+        if not mirrored:
+            # The mirror already holds the archived months.
+            _, archived = _archived_client_withdrawals(cursor, client_full_name, start_date, end_date)
+        total_amount = result["total_amount"] if result["total_amount"] is not None else 0.0
+        if archived:
+            total_amount = Money(to_cents(total_amount) + sum(to_cents(withdrawal["amount"]) for withdrawal in archived))
+        
         return {
             "client_full_name": client_full_name,
             "start_date": start_date,
             "end_date": end_date,
-            "total_withdrawals": result["total_withdrawals"],
-            "total_amount": result["total_amount"] if result["total_amount"] is not None else 0.0
+            "total_withdrawals": result["total_withdrawals"] + len(archived),
+            "total_amount": total_amount
         }
     except Error as e:
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
@@ -968,8 +1662,16 @@ async def get_client_accounts_summary(client_full_name: str):
         WHERE CONCAT(c.name, ' ', c.last_name) = %s
         GROUP BY c.id_client
         """
-        cursor.execute(select_query, (client_full_name,))
-        result = cursor.fetchone()
+        if sharding.SHARDING_ENABLED:
+            rows = sharding.gather(select_query, (client_full_name,))
+            result = None
+            if rows:
+                rows = _first_client_rows(rows)
+                result = dict(rows[0], account_count=sum(row["account_count"] for row in rows),
+                              account_numbers=",".join(row["account_numbers"] for row in rows if row["account_numbers"]))
+        else:
+            cursor.execute(select_query, (client_full_name,))
+            result = cursor.fetchone()
         
         if not result:
             raise HTTPException(status_code=404, detail="Client not found or has no accounts")
@@ -984,4 +1686,75 @@ async def get_client_accounts_summary(client_full_name: str):
         raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
     finally:
         cursor.close()
-        connection.close()
\ No newline at end of file
+        connection.close()
+
+@router.get("/metrics/queries", response_model=dict, tags=["metrics"])
+async def get_query_metrics():
+    return query_guard.metrics.snapshot()
+
+@router.get("/metrics/statements", response_model=dict, tags=["metrics"])
+async def get_statement_metrics():
+    return prepared_statements.metrics.snapshot()
+
+@router.get("/health/live", response_model=dict, tags=["health"])
+async def health_live():
+    return {"status": "alive"}
+
+@router.get("/health/ready", response_model=dict, tags=["health"])
+async def health_ready(response: Response):
+    state = readiness.snapshot()
+    if not state["ready"]:
+        response.status_code = 503
+    return state
+
+@router.get("/changes", response_model=dict, tags=["changes"])
+async def get_changes(tables: List[str] = Query(list(changefeed.FEED_TABLES)), since: str = None, limit: int = 500, wait: float = 0):
+    unknown_tables = [table for table in tables if table not in changefeed.FEED_TABLES]
+    if unknown_tables:
+        raise HTTPException(status_code=400, detail=f"Unknown tables: {', '.join(unknown_tables)}")
+    try:
+        after_event_ids = changefeed.decode_watermark(since, sharding.SHARD_COUNT)
+    except changefeed.InvalidWatermark as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit = max(1, min(limit, 5000))
+    deadline = time.monotonic() + max(0, min(wait, 30))
+    
+    while True:
+        # One outbox per shard.
+        connections = _shard_connections()
+        if not connections:
+            raise HTTPException(status_code=500, detail="Database connection failed")
+        
+        try:
+            changes, watermarks, has_more = changefeed.fetch_changes(connections, tables, after_event_ids, limit)
+        except Error as e:
+            raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+        finally:
+            for connection in connections:
+                connection.close()
+        
+        after_event_ids = watermarks
+        remaining = deadline - time.monotonic()
+        if changes or has_more or remaining <= 0:
+            break
+        await changefeed.wait_for_events(remaining)
+    
+    if sharding.SHARDING_ENABLED:
+        transfers = [change["row"] for change in changes
+                     if change["table"] == "transfers" and change["row"] and change["row"]["to_account_number"] is None]
+        try:
+            _with_to_account_numbers(transfers)
+        except Error as e:
+            raise HTTPException(status_code=500, detail=f"An error occurred: {str(e)}")
+    
+    return {
+        "changes": changes,
+        "watermark": changefeed.encode_watermark(watermarks),
+        "has_more": has_more
+    }
+
+@router.post("/batch", response_model=List[BatchResponse], tags=["batch"])
+async def run_batch(requests: List[BatchRequest]):
+    if len(requests) > batch.MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"A batch accepts at most {batch.MAX_BATCH_SIZE} requests")
+    return await batch.execute(router.routes, requests)
@@ -0,0 +1,307 @@
+"""End-to-end check of ``sharding.py migrate`` on empty local MySQL instances.
+
+    docker compose -f docker-compose.shards.yml up -d
+    export DB_HOST=127.0.0.1 DB_USER=root DB_PASSWORD=financial DB_NAME=financial_db
+    export DB_SHARDS='[{"port": 3306}, {"port": 3307}, {"port": 3308}]'
+    python shard_migration_check.py --accounts 5000
+
+Fills shard 0 the way the unsharded app did (consecutive ids, ledger entries,
+snapshots and change feed events), runs ``init`` and ``migrate`` and checks
+that every account ended on the shard of its number with its rows, that the
+balances, withdrawals and transfers are the same per account number, that a
+second ``migrate`` has nothing left to do and that the ids handed out
+afterwards are new ones of their shard. Exits 1 when a check fails.
+"""
+import argparse
+import random
+import sys
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import changefeed
+import ledger
+import sharding
+from conexion import get_db_connection
+
+BASE_TABLE_QUERIES = [
+    """
+    CREATE TABLE IF NOT EXISTS clients (
+        ID_Client INT AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(255), last_name VARCHAR(255), Address VARCHAR(255), Phone_number VARCHAR(255),
+        Email VARCHAR(255), Identification_Type VARCHAR(50), Identification_Number VARCHAR(255)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS employees (
+        employee_id INT AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(100), position VARCHAR(50), hire_date DATE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS accounts (
+        account_id INT AUTO_INCREMENT PRIMARY KEY,
+        ID_client INT, account_number VARCHAR(50) UNIQUE, balance DECIMAL(20, 2),
+        FOREIGN KEY (ID_client) REFERENCES clients (ID_Client)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        withdrawal_id INT AUTO_INCREMENT PRIMARY KEY,
+        account_id INT, amount DECIMAL(10, 2), withdrawal_date DATETIME, withdrawal_method VARCHAR(50),
+        FOREIGN KEY (account_id) REFERENCES accounts (account_id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS transfers (
+        transfer_id INT AUTO_INCREMENT PRIMARY KEY,
+        from_account_id INT, to_account_id INT, amount DECIMAL(10, 2), transfer_date DATETIME,
+        transfer_method VARCHAR(50), status VARCHAR(20),
+        FOREIGN KEY (from_account_id) REFERENCES accounts (account_id),
+        FOREIGN KEY (to_account_id) REFERENCES accounts (account_id)
+    )
+    """,
+]
+
+COUNTED_TABLES = ["accounts", "withdrawals", "transfers", "ledger_entries", "balance_snapshots", "change_outbox"]
+
+# Rows whose account, withdrawal or transfer is not on the same shard.
+ORPHAN_QUERIES = {
+    "withdrawals": """
+    SELECT COUNT(*) AS orphans FROM withdrawals w
+    LEFT JOIN accounts a ON a.account_id = w.account_id WHERE a.account_id IS NULL
+    """,
+    "transfers": """
+    SELECT COUNT(*) AS orphans FROM transfers t
+    LEFT JOIN accounts a ON a.account_id = t.from_account_id WHERE a.account_id IS NULL
+    """,
+    "ledger_entries": """
+    SELECT COUNT(*) AS orphans FROM ledger_entries e
+    LEFT JOIN accounts a ON a.account_id = e.account_id
+    LEFT JOIN withdrawals w ON e.account_id IS NULL AND w.withdrawal_id = e.reference_id
+    WHERE a.account_id IS NULL AND w.withdrawal_id IS NULL
+    """,
+    "balance_snapshots": """
+    SELECT COUNT(*) AS orphans FROM balance_snapshots s
+    LEFT JOIN accounts a ON a.account_id = s.account_id WHERE a.account_id IS NULL
+    """,
+    "change_outbox": """
+    SELECT COUNT(*) AS orphans FROM change_outbox o
+    LEFT JOIN withdrawals w ON o.table_name = 'withdrawals' AND w.withdrawal_id = o.row_id
+    LEFT JOIN transfers t ON o.table_name = 'transfers' AND t.transfer_id = o.row_id
+    WHERE w.withdrawal_id IS NULL AND t.transfer_id IS NULL
+    """,
+}
+
+ACCOUNT_TOTALS_QUERY = """
+SELECT a.account_id, a.account_number,
+    (SELECT COUNT(*) FROM withdrawals w WHERE w.account_id = a.account_id) AS withdrawals,
+    (SELECT COALESCE(SUM(w.amount), 0) FROM withdrawals w WHERE w.account_id = a.account_id) AS withdrawn
+FROM accounts a
+"""
+
+TRANSFERS_QUERY = """
+SELECT t.transfer_id, fa.account_number AS from_account_number, t.to_account_id, t.amount
+FROM transfers t
+JOIN accounts fa ON fa.account_id = t.from_account_id
+"""
+
+
+def _ids(cursor, count):
+    # Without sharding a multi-row insert assigns consecutive ids.
+    return [cursor.lastrowid + i for i in range(count)]
+
+
+def seed(accounts, seed_value):
+    """Fill shard 0 like the unsharded app did; False when it already has accounts."""
+    generator = random.Random(seed_value)
+    connection = get_db_connection()
+    if not connection:
+        raise SystemExit("Database connection failed")
+    cursor = connection.cursor()
+    try:
+        for query in BASE_TABLE_QUERIES:
+            cursor.execute(query)
+        ledger.create_ledger_tables(cursor)
+        changefeed.create_outbox_table(cursor)
+        cursor.execute("SELECT COUNT(*) FROM accounts")
+        if cursor.fetchone()[0]:
+            return False
+
+        cursor.executemany("INSERT INTO employees (name, position, hire_date) VALUES (%s, %s, %s)", [
+            (f"Employee {i}", "teller", datetime(2020, 1, 1).date()) for i in range(3)
+        ])
+        client_count = max(accounts // 2, 1)
+        cursor.executemany("""
+        INSERT INTO clients (name, last_name, address, phone_number, email, identification_type, identification_number)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, [
+            (f"Name{i}", f"Last{i}", "Street 1", "555-0000", f"client{i}@example.com", "DNI", f"{i:08d}")
+            for i in range(client_count)
+        ])
+        client_ids = _ids(cursor, client_count)
+        cursor.executemany("INSERT INTO accounts (ID_client, account_number, balance) VALUES (%s, %s, %s)", [
+            (client_ids[i % client_count], f"{i:010d}", Decimal("1000.00")) for i in range(accounts)
+        ])
+        account_ids = _ids(cursor, accounts)
+        ledger.seed_snapshots(cursor)
+
+        started = datetime(2024, 1, 1)
+        withdrawal_rows = [
+            (account_id, Decimal(generator.randint(1, 5000)) / 100, started + timedelta(hours=generator.randint(0, 8760)), "atm")
+            for account_id in account_ids for _ in range(2)
+        ]
+        cursor.executemany("""
+        INSERT INTO withdrawals (account_id, amount, withdrawal_date, withdrawal_method) VALUES (%s, %s, %s, %s)
+        """, withdrawal_rows)
+        withdrawal_ids = _ids(cursor, len(withdrawal_rows))
+        ledger.append_withdrawal_entries(cursor, [
+            (withdrawal_id, account_id, amount, withdrawal_date.date())
+            for withdrawal_id, (account_id, amount, withdrawal_date, _) in zip(withdrawal_ids, withdrawal_rows)
+        ])
+        changefeed.record_changes(cursor, "withdrawals", withdrawal_ids)
+
+        transfer_rows = [
+            (account_id, generator.choice(account_ids), Decimal(generator.randint(1, 5000)) / 100,
+             started + timedelta(hours=generator.randint(0, 8760)), "online", "completed")
+            for account_id in account_ids
+        ]
+        cursor.executemany("""
+        INSERT INTO transfers (from_account_id, to_account_id, amount, transfer_date, transfer_method, status)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        """, transfer_rows)
+        transfer_ids = _ids(cursor, len(transfer_rows))
+        ledger.append_transfer_entries(cursor, [
+            (transfer_id, from_account_id, to_account_id, amount, transfer_date.date())
+            for transfer_id, (from_account_id, to_account_id, amount, transfer_date, _, _) in zip(transfer_ids, transfer_rows)
+        ])
+        changefeed.record_changes(cursor, "transfers", transfer_ids)
+        connection.commit()
+        return True
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def _fetch(query):
+    def work(cursor):
+        cursor.execute(query)
+        return cursor.fetchall()
+    return work
+
+
+def _counts():
+    return {
+        table: sum(row["row_count"] for row in sharding.gather(f"SELECT COUNT(*) AS row_count FROM {table}"))
+        for table in COUNTED_TABLES
+    }
+
+
+def snapshot():
+    """Everything that has to survive the migration, by account number."""
+    results = sharding.on_shards({
+        shard: lambda cursor: (
+            _fetch(ACCOUNT_TOTALS_QUERY)(cursor), ledger.current_balances(cursor), _fetch(TRANSFERS_QUERY)(cursor)
+        )
+        for shard in range(sharding.SHARD_COUNT)
+    })
+    accounts = {}
+    numbers = {}
+    transfers = {}
+    for shard, (account_rows, balances, transfer_rows) in results.items():
+        for row in account_rows:
+            numbers[row["account_id"]] = row["account_number"]
+            accounts[row["account_number"]] = (row["withdrawals"], row["withdrawn"], balances.get(row["account_id"]))
+        transfers.update({row["transfer_id"]: row for row in transfer_rows})
+    # The receiver of a transfer can be on another shard than its sender.
+    numbers.update(sharding.account_numbers([row["to_account_id"] for row in transfers.values()]))
+    return {
+        "accounts": accounts,
+        "transfers": {
+            transfer_id: (row["from_account_number"], numbers.get(row["to_account_id"]), row["amount"])
+            for transfer_id, row in transfers.items()
+        },
+        "counts": _counts(),
+    }
+
+
+def _next_ids():
+    # Ids an insert on each shard would get, rolled back afterwards.
+    next_ids = {}
+    for shard in range(sharding.SHARD_COUNT):
+        connection = sharding.get_shard_connection(shard)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(
+                "INSERT INTO accounts (ID_client, account_number, balance) SELECT MIN(ID_client), %s, 0 FROM accounts",
+                (f"check-{shard}",)
+            )
+            next_ids[shard] = cursor.lastrowid
+            connection.rollback()
+        finally:
+            cursor.close()
+            connection.close()
+    return next_ids
+
+
+def check(before):
+    failures = []
+
+    def expect(name, passed, detail=""):
+        print(f"{'ok  ' if passed else 'FAIL'} {name}{': ' + str(detail) if detail and not passed else ''}")
+        if not passed:
+            failures.append(name)
+
+    misplaced = sharding.misplaced_accounts()
+    expect("no misplaced account found by the startup check", not misplaced, misplaced)
+    accounts = sharding.on_shards({
+        shard: _fetch("SELECT account_id, account_number FROM accounts") for shard in range(sharding.SHARD_COUNT)
+    })
+    misplaced = [
+        row["account_number"] for shard, rows in accounts.items() for row in rows
+        if sharding.shard_for_account_number(row["account_number"]) != shard
+        or sharding.shard_for_id(row["account_id"]) != shard
+    ]
+    expect("every account on the shard of its number and id", not misplaced, misplaced[:10])
+    after = snapshot()
+    expect("row counts", after["counts"] == before["counts"], (before["counts"], after["counts"]))
+    changed = [number for number, totals in before["accounts"].items() if after["accounts"].get(number) != totals]
+    expect("withdrawals and ledger balance per account number", not changed, changed[:10])
+    changed = [transfer_id for transfer_id, row in before["transfers"].items() if after["transfers"].get(transfer_id) != row]
+    expect("sender, receiver and amount per transfer", not changed, changed[:10])
+    orphans = {
+        table: sum(row["orphans"] for row in sharding.gather(query))
+        for table, query in ORPHAN_QUERIES.items()
+    }
+    expect("rows on the shard of their account", not any(orphans.values()), orphans)
+
+    summary = sharding.migrate()
+    expect("second migrate moves nothing", not summary["moved"] and not summary["renumbered"], summary)
+    max_id = max(row["max_id"] for row in sharding.gather("SELECT MAX(account_id) AS max_id FROM accounts"))
+    next_ids = _next_ids()
+    expect("new account ids are unused ids of their shard", all(
+        account_id > max_id and sharding.shard_for_id(account_id) == shard
+        for shard, account_id in next_ids.items()
+    ), next_ids)
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check sharding.py migrate against empty MySQL instances")
+    parser.add_argument("--accounts", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if not sharding.SHARDING_ENABLED:
+        raise SystemExit("DB_SHARDS lists less than two shards")
+
+    if not seed(args.accounts, args.seed):
+        raise SystemExit("Shard 0 already has accounts, run the check on empty databases")
+    print(f"Shard 0 filled with {args.accounts} accounts")
+    sharding.init()
+    before = snapshot()
+    print(sharding.migrate())
+    failures = check(before)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,687 @@
+"""Hash sharding of the accounts across several MySQL instances.
+
+Sharding is off unless ``DB_SHARDS`` lists the instances as JSON, each entry
+overriding the ``DB_*`` settings of ``DB_CONFIG``::
+
+    DB_SHARDS=[{"host": "127.0.0.1", "port": 3306}, {"host": "127.0.0.1", "port": 3307}]
+
+An account lives on shard ``crc32(account_number) % SHARD_COUNT`` together with
+its withdrawals, its ledger entries and snapshots, and the transfers it sends.
+The credit entry of a transfer to an account of another shard is written on
+the receiver's shard, in the same XA transaction as the transfer. Clients and
+employees are reference data copied to every shard with the same ids, so the
+account queries still join them locally; loans stay on shard 0, which must be
+the ``DB_*`` database itself.
+
+Every shard connection sets ``auto_increment_increment = SHARD_COUNT`` and
+``auto_increment_offset = shard + 1``, so ids are unique across shards, the
+shard of an account id is ``(account_id - 1) % SHARD_COUNT`` and a multi-row
+insert assigns ``first_id + i * SHARD_COUNT``.
+
+    python sharding.py init      # ledger, outbox and XA log tables, drops the transfers.to_account_id foreign key
+    python sharding.py migrate   # moves the accounts of the unsharded database to their shard
+    python sharding.py recover   # resolves the XA transactions a crash left prepared
+
+``init`` also creates the tables of shard 0 missing on the other shards.
+Accounts created before sharding are all on shard 0 with consecutive ids, so
+``migrate`` moves each one with its rows to the shard of its number and gives
+it a new id of that shard when its id belongs to another one (the old and new
+ids are kept in ``shard_migration_ids``). The workers refuse to start while an
+account is on the wrong shard.
+
+Bulk writes that touch one shard commit normally. Writes over several shards
+log their xid on shard 0, run ``XA PREPARE`` on every shard, mark the xid as
+committed and only then run ``XA COMMIT``; ``recover`` commits the prepared
+branches of a committed xid and rolls back the others (presumed abort).
+"""
+import argparse
+import contextvars
+import json
+import os
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from mysql.connector import Error
+
+import archive
+import changefeed
+import ledger
+from conexion import DB_CONFIG, DB_POOL_SIZE, get_db_connection, open_connection
+
+SHARDS = [dict(DB_CONFIG, **shard) for shard in json.loads(os.getenv("DB_SHARDS") or "[]")]
+SHARD_COUNT = max(len(SHARDS), 1)
+SHARDING_ENABLED = len(SHARDS) > 1
+
+
+def _database(config):
+    return config.get("host"), int(config.get("port", 3306)), config.get("database")
+
+
+# Loans, the XA log and whatever else is read through get_db_connection() are
+# on the DB_* database, which has to be shard 0 for them to be there.
+if SHARDING_ENABLED and _database(SHARDS[0]) != _database(DB_CONFIG):
+    raise RuntimeError("The first entry of DB_SHARDS must be the DB_HOST/DB_NAME database")
+
+XID_PREFIX = "financial-"
+XA_RECOVERY_GRACE_SECONDS = 300
+
+CREATE_XA_LOG_QUERY = """
+CREATE TABLE IF NOT EXISTS xa_log (
+    xid VARCHAR(64) PRIMARY KEY,
+    state VARCHAR(10) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+)
+"""
+
+# Tables of the unsharded schema, in foreign key order. ``init`` creates the
+# missing ones on the other shards with the definitions of shard 0.
+BASE_TABLES = ["clients", "employees", "accounts", "withdrawals", "transfers"]
+
+# Reference tables ``migrate`` copies to every shard, by id column.
+REFERENCE_TABLES = {"clients": "id_client", "employees": "employee_id"}
+
+# The rows that live on the shard of an account, by the column holding its id.
+ACCOUNT_ROWS = [
+    ("accounts", "account_id"),
+    ("withdrawals", "account_id"),
+    ("transfers", "from_account_id"),
+    ("ledger_entries", "account_id"),
+    ("balance_snapshots", "account_id"),
+]
+ACCOUNT_ID_COLUMNS = ACCOUNT_ROWS + [("transfers", "to_account_id")]
+
+ID_COLUMNS = {
+    "accounts": "account_id",
+    "withdrawals": "withdrawal_id",
+    "transfers": "transfer_id",
+    "ledger_entries": "entry_id",
+    "balance_snapshots": "snapshot_id",
+    "change_outbox": "event_id",
+}
+
+MIGRATION_BATCH_SIZE = 500
+
+CREATE_MIGRATION_IDS_QUERY = """
+CREATE TABLE IF NOT EXISTS shard_migration_ids (
+    old_account_id INT PRIMARY KEY,
+    new_account_id INT NOT NULL
+)
+"""
+
+# MySQL's CRC32() is zlib's crc32 of the same utf8 bytes, as in shard_for_account_number.
+MISPLACED_CONDITION = "(MOD(CRC32(account_number), %s) <> %s OR MOD(account_id - 1, %s) <> %s)"
+
+COUNT_MISPLACED_QUERY = f"SELECT COUNT(*) AS misplaced FROM accounts WHERE {MISPLACED_CONDITION}"
+
+MISPLACED_ACCOUNTS_QUERY = f"""
+SELECT account_id, account_number
+FROM accounts
+WHERE account_id > %s AND {MISPLACED_CONDITION}
+ORDER BY account_id
+LIMIT %s
+"""
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def shard_for_account_number(account_number):
+    return zlib.crc32(str(account_number).encode()) % SHARD_COUNT
+
+
+def shard_for_id(row_id):
+    return (row_id - 1) % SHARD_COUNT
+
+
+def inserted_ids(cursor, count):
+    # For a multi-row insert lastrowid is the id of the first row.
+    return [cursor.lastrowid + i * SHARD_COUNT for i in range(count)]
+
+
+def group_by_shard(values, shard_of):
+    groups = {}
+    for value in values:
+        groups.setdefault(shard_of(value), []).append(value)
+    return groups
+
+
+def get_shard_connection(shard):
+    if not SHARDING_ENABLED:
+        return get_db_connection()
+    connection = open_connection(f"financial_shard{shard}", SHARDS[shard])
+    if not connection:
+        return None
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "SET SESSION auto_increment_increment = %s, auto_increment_offset = %s",
+            (SHARD_COUNT, shard + 1)
+        )
+    except Error as e:
+        print(f"Error conectando a MySQL: {e}")
+        connection.close()
+        return None
+    finally:
+        cursor.close()
+    return connection
+
+
+def connection_for_account(account_number):
+    return get_shard_connection(shard_for_account_number(account_number))
+
+
+def _require_connection(shard):
+    connection = get_shard_connection(shard)
+    if not connection:
+        raise Error(msg=f"Database connection failed for shard {shard}")
+    return connection
+
+
+def shard_connections():
+    """One connection per shard, or the single database connection when sharding is off."""
+    connections = []
+    try:
+        for shard in range(SHARD_COUNT):
+            connections.append(_require_connection(shard))
+    except Error:
+        for connection in connections:
+            connection.close()
+        raise
+    return connections
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SHARD_COUNT * DB_POOL_SIZE, thread_name_prefix="shard")
+        return _executor
+
+
+def _run_on_shard(shard, work):
+    connection = _require_connection(shard)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        return work(cursor)
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def on_shards(work):
+    """Run ``work[shard](cursor)`` on every listed shard in parallel and return ``{shard: result}``."""
+    if len(work) == 1:
+        (shard, shard_work), = work.items()
+        return {shard: _run_on_shard(shard, shard_work)}
+    # Each worker runs in a copy of the request context, so the shard queries
+    # are profiled and guarded like the request's own.
+    futures = {
+        shard: _get_executor().submit(contextvars.copy_context().run, _run_on_shard, shard, shard_work)
+        for shard, shard_work in work.items()
+    }
+    return {shard: future.result() for shard, future in futures.items()}
+
+
+def _fetch_all(query, params):
+    def work(cursor):
+        cursor.execute(query, params)
+        return cursor.fetchall()
+    return work
+
+
+def gather(query, params=()):
+    """Rows of ``query`` from every shard, shard by shard."""
+    results = on_shards({shard: _fetch_all(query, params) for shard in range(SHARD_COUNT)})
+    return [row for shard in sorted(results) for row in results[shard]]
+
+
+def _lookup_by_shard(groups, query):
+    def lookup(values):
+        def work(cursor):
+            rows = []
+            for i in range(0, len(values), 1000):
+                chunk = values[i:i + 1000]
+                cursor.execute(query.format(placeholders=", ".join(["%s"] * len(chunk))), tuple(chunk))
+                rows.extend(cursor.fetchall())
+            return rows
+        return work
+    results = on_shards({shard: lookup(values) for shard, values in groups.items()})
+    return [row for rows in results.values() for row in rows]
+
+
+def lookup_by_account_id(account_ids, query):
+    """Rows of ``query``, filtered with ``IN ({placeholders})`` on account ids, each id on its own shard."""
+    groups = group_by_shard(dict.fromkeys(account_ids), shard_for_id)
+    if not groups:
+        return []
+    return _lookup_by_shard(groups, query)
+
+
+def resolve_accounts(account_numbers):
+    """``{account_number: account_id}``, each number looked up on its own shard."""
+    groups = group_by_shard(dict.fromkeys(account_numbers), shard_for_account_number)
+    if not groups:
+        return {}
+    rows = _lookup_by_shard(groups, "SELECT account_number, account_id FROM accounts WHERE account_number IN ({placeholders})")
+    return {row["account_number"]: row["account_id"] for row in rows}
+
+
+def account_numbers(account_ids):
+    rows = lookup_by_account_id(account_ids, "SELECT account_id, account_number FROM accounts WHERE account_id IN ({placeholders})")
+    return {row["account_id"]: row["account_number"] for row in rows}
+
+
+def current_balances(account_ids):
+    groups = group_by_shard(dict.fromkeys(account_ids), shard_for_id)
+    balances = {}
+    for shard_balances in on_shards({
+        shard: lambda cursor, ids=ids: ledger.current_balances(cursor, ids)
+        for shard, ids in groups.items()
+    }).values():
+        balances.update(shard_balances)
+    return balances
+
+
+def _log_xa(xid, state):
+    connection = _require_connection(0)
+    cursor = connection.cursor()
+    try:
+        if state == "started":
+            cursor.execute("INSERT INTO xa_log (xid, state) VALUES (%s, %s)", (xid, state))
+        elif state is None:
+            cursor.execute("DELETE FROM xa_log WHERE xid = %s", (xid,))
+        else:
+            cursor.execute("UPDATE xa_log SET state = %s WHERE xid = %s", (state, xid))
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def _xa_rollback(cursor, xid):
+    for statement in (f"XA END '{xid}'", f"XA ROLLBACK '{xid}'"):
+        try:
+            cursor.execute(statement)
+        except Error:
+            pass
+
+
+@contextmanager
+def transaction(shards):
+    """Dictionary cursors of ``shards`` whose writes commit atomically.
+
+    One shard commits normally; several shards use an XA two-phase commit.
+    """
+    shards = sorted(set(shards))
+    connections = {}
+    cursors = {}
+    try:
+        for shard in shards:
+            connections[shard] = _require_connection(shard)
+            connections[shard].rollback()
+            cursors[shard] = connections[shard].cursor(dictionary=True)
+
+        if not shards:
+            yield cursors
+            return
+
+        if len(shards) == 1:
+            connection = connections[shards[0]]
+            try:
+                yield cursors
+                connection.commit()
+            except BaseException:
+                connection.rollback()
+                raise
+            return
+
+        xid = f"{XID_PREFIX}{uuid.uuid4().hex}"
+        _log_xa(xid, "started")
+        started = []
+        try:
+            for shard in shards:
+                cursors[shard].execute(f"XA START '{xid}'")
+                started.append(shard)
+            yield cursors
+            for shard in shards:
+                cursors[shard].execute(f"XA END '{xid}'")
+                cursors[shard].execute(f"XA PREPARE '{xid}'")
+            _log_xa(xid, "commit")
+        except BaseException:
+            for shard in started:
+                _xa_rollback(cursors[shard], xid)
+            raise
+
+        # The decision is durable: a branch that fails to commit now is
+        # committed by ``recover`` instead of failing the request.
+        committed = True
+        for shard in shards:
+            try:
+                cursors[shard].execute(f"XA COMMIT '{xid}'")
+            except Error as e:
+                committed = False
+                print(f"XA {xid} not committed on shard {shard}, run sharding.py recover: {e}")
+        if committed:
+            _log_xa(xid, None)
+    finally:
+        for cursor in cursors.values():
+            cursor.close()
+        for connection in connections.values():
+            connection.close()
+
+
+def broadcast_insert(table, columns, id_column, rows):
+    """Insert reference rows on every shard with the ids assigned by shard 0."""
+    insert_query = "INSERT INTO {table} ({columns}) VALUES ({values})"
+    with transaction(range(SHARD_COUNT)) as cursors:
+        cursors[0].executemany(
+            insert_query.format(table=table, columns=", ".join(columns), values=", ".join(["%s"] * len(columns))),
+            rows
+        )
+        ids = inserted_ids(cursors[0], len(rows))
+        for shard in range(1, SHARD_COUNT):
+            cursors[shard].executemany(
+                insert_query.format(table=table, columns=", ".join((id_column, *columns)),
+                                    values=", ".join(["%s"] * (len(columns) + 1))),
+                [(row_id, *row) for row_id, row in zip(ids, rows)]
+            )
+    return ids
+
+
+def _create_base_tables(source, cursor):
+    for table in BASE_TABLES:
+        cursor.execute("""
+        SELECT COUNT(*) FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (table,))
+        if cursor.fetchone()[0]:
+            continue
+        source.execute(f"SHOW CREATE TABLE `{table}`")
+        cursor.execute(source.fetchone()[1])
+        print(f"Created {table}")
+
+
+def init():
+    source_connection = _require_connection(0)
+    source = source_connection.cursor()
+    try:
+        for shard in range(SHARD_COUNT):
+            _init_shard(shard, source)
+    finally:
+        source.close()
+        source_connection.close()
+
+
+def _init_shard(shard, source):
+    connection = _require_connection(shard)
+    cursor = connection.cursor()
+    try:
+        if shard == 0:
+            cursor.execute(CREATE_XA_LOG_QUERY)
+            cursor.execute(CREATE_MIGRATION_IDS_QUERY)
+        else:
+            _create_base_tables(source, cursor)
+        ledger.create_ledger_tables(cursor)
+        changefeed.create_outbox_table(cursor)
+        cursor.execute("""
+        SELECT CONSTRAINT_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'transfers'
+            AND COLUMN_NAME = 'to_account_id' AND REFERENCED_TABLE_NAME IS NOT NULL
+        """)
+        for (constraint_name,) in cursor.fetchall():
+            cursor.execute(f"ALTER TABLE transfers DROP FOREIGN KEY `{constraint_name}`")
+        connection.commit()
+        print(f"Shard {shard} ready")
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def misplaced_accounts():
+    """``{shard: count}`` of the accounts whose number or id belongs to another shard."""
+    def count(shard):
+        def work(cursor):
+            cursor.execute(COUNT_MISPLACED_QUERY, (SHARD_COUNT, shard, SHARD_COUNT, shard))
+            return cursor.fetchone()["misplaced"]
+        return work
+    counts = on_shards({shard: count(shard) for shard in range(SHARD_COUNT)})
+    return {shard: misplaced for shard, misplaced in sorted(counts.items()) if misplaced}
+
+
+def _max_id(table, id_column):
+    return max(row["max_id"] for row in gather(f"SELECT COALESCE(MAX({id_column}), 0) AS max_id FROM {table}"))
+
+
+def _raise_auto_increments():
+    # Moved rows keep their ids, so no shard may hand out an id in use on another one.
+    for table, id_column in ID_COLUMNS.items():
+        next_id = _max_id(table, id_column) + 1
+        for shard in range(SHARD_COUNT):
+            connection = _require_connection(shard)
+            cursor = connection.cursor()
+            try:
+                cursor.execute(f"ALTER TABLE {table} AUTO_INCREMENT = {next_id}")
+            finally:
+                cursor.close()
+                connection.close()
+
+
+def _copy_reference_rows(batch_size):
+    copied = {}
+    for table, id_column in REFERENCE_TABLES.items():
+        copied[table] = 0
+        connection = _require_connection(0)
+        cursor = connection.cursor()
+        try:
+            last_id = 0
+            while True:
+                cursor.execute(f"SELECT * FROM {table} WHERE {id_column} > %s ORDER BY {id_column} LIMIT %s",
+                               (last_id, batch_size))
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                columns = [column.lower() for column in cursor.column_names]
+                insert_query = "INSERT IGNORE INTO {table} ({columns}) VALUES ({values})".format(
+                    table=table, columns=", ".join(columns), values=", ".join(["%s"] * len(columns))
+                )
+                for shard in range(1, SHARD_COUNT):
+                    with transaction([shard]) as cursors:
+                        cursors[shard].executemany(insert_query, rows)
+                copied[table] += len(rows)
+                last_id = rows[-1][columns.index(id_column)]
+        finally:
+            cursor.close()
+            connection.close()
+    return copied
+
+
+def _move_rows(source, target, table, condition, values, params=()):
+    """Move the rows of ``table`` matching ``condition`` for ``values`` from one shard to another."""
+    moved = []
+    for i in range(0, len(values), 1000):
+        chunk = tuple(values[i:i + 1000])
+        where = condition.format(placeholders=", ".join(["%s"] * len(chunk)))
+        source.execute(f"SELECT * FROM {table} WHERE {where} FOR UPDATE", params + chunk)
+        rows = source.fetchall()
+        if not rows:
+            continue
+        columns = list(rows[0])
+        target.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+            [tuple(row[column] for column in columns) for row in rows]
+        )
+        source.execute(f"DELETE FROM {table} WHERE {where}", params + chunk)
+        moved.extend(rows)
+    return moved
+
+
+def _replace_account_ids(cursor, new_ids):
+    old_ids = list(new_ids)
+    for i in range(0, len(old_ids), 1000):
+        chunk = old_ids[i:i + 1000]
+        cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+        placeholders = ", ".join(["%s"] * len(chunk))
+        params = tuple(value for old_id in chunk for value in (old_id, new_ids[old_id])) + tuple(chunk)
+        for table, column in ACCOUNT_ID_COLUMNS:
+            cursor.execute(
+                f"UPDATE {table} SET {column} = CASE {column} {cases} END WHERE {column} IN ({placeholders})",
+                params
+            )
+
+
+def _move_accounts(shard, accounts, next_ids):
+    """Move ``accounts`` (``(account_id, account_number)`` of ``shard``) to their shard, in one transaction.
+
+    An account whose id does not belong to its shard gets the next free id of
+    the shard, in every table that refers to it; returns ``{old_id: new_id}``.
+    """
+    targets = {}
+    new_ids = {}
+    for account_id, account_number in accounts:
+        target = shard_for_account_number(account_number)
+        targets[account_id] = target
+        if shard_for_id(account_id) != target:
+            new_ids[account_id] = next_ids[target]
+            next_ids[target] += SHARD_COUNT
+    # The transfers received by a renumbered account can be on any shard.
+    shards = range(SHARD_COUNT) if new_ids else {shard, *targets.values()}
+    with transaction(shards) as cursors:
+        for cursor in cursors.values():
+            cursor.execute("SET FOREIGN_KEY_CHECKS = 0")
+        try:
+            for target, account_ids in group_by_shard(targets, targets.get).items():
+                if target == shard:
+                    continue
+                moved_ids = {}
+                for table, column in ACCOUNT_ROWS:
+                    rows = _move_rows(cursors[shard], cursors[target], table, f"{column} IN ({{placeholders}})", account_ids)
+                    moved_ids[table] = [row[ID_COLUMNS[table]] for row in rows]
+                # The cash side of a withdrawal has no account, it goes with the withdrawal.
+                _move_rows(cursors[shard], cursors[target], "ledger_entries",
+                           "account_id IS NULL AND entry_type = %s AND reference_id IN ({placeholders})",
+                           moved_ids["withdrawals"], ("withdrawal",))
+                # Their events follow them, so the outbox of the shard serves their rows.
+                for table in ("withdrawals", "transfers"):
+                    _move_rows(cursors[shard], cursors[target], "change_outbox",
+                               "table_name = %s AND row_id IN ({placeholders})", moved_ids[table], (table,))
+            if new_ids:
+                for cursor in cursors.values():
+                    _replace_account_ids(cursor, new_ids)
+                cursors[0].executemany(
+                    "INSERT INTO shard_migration_ids (old_account_id, new_account_id) VALUES (%s, %s)",
+                    list(new_ids.items())
+                )
+        finally:
+            for cursor in cursors.values():
+                cursor.execute("SET FOREIGN_KEY_CHECKS = 1")
+    return new_ids
+
+
+def _misplaced_batch(shard, after_id, batch_size):
+    def work(cursor):
+        cursor.execute(MISPLACED_ACCOUNTS_QUERY, (after_id, SHARD_COUNT, shard, SHARD_COUNT, shard, batch_size))
+        return [(row["account_id"], row["account_number"]) for row in cursor.fetchall()]
+    return _run_on_shard(shard, work)
+
+
+def migrate(batch_size=MIGRATION_BATCH_SIZE):
+    """Move every account on the wrong shard, with its rows, to the shard of its number.
+
+    Meant for the switch from one database to several, with the app stopped:
+    all the accounts are on shard 0 then, numbered 1, 2, 3... Each batch of
+    accounts moves in one XA transaction, so an interrupted run is resumed by
+    running it again. Archived months get the new account ids too.
+    """
+    summary = {"copied": _copy_reference_rows(batch_size), "moved": 0, "renumbered": 0}
+    _raise_auto_increments()
+    next_id = _max_id("accounts", "account_id") + 1
+    next_ids = {shard: next_id + (shard - shard_for_id(next_id)) % SHARD_COUNT for shard in range(SHARD_COUNT)}
+    for shard in range(SHARD_COUNT):
+        after_id = 0
+        while True:
+            accounts = _misplaced_batch(shard, after_id, batch_size)
+            if not accounts:
+                break
+            new_ids = _move_accounts(shard, accounts, next_ids)
+            summary["moved"] += sum(1 for _, number in accounts if shard_for_account_number(number) != shard)
+            summary["renumbered"] += len(new_ids)
+            after_id = accounts[-1][0]
+            print(f"Shard {shard}: {summary['moved']} accounts moved, {summary['renumbered']} renumbered")
+    _raise_auto_increments()
+
+    new_ids = {
+        row["old_account_id"]: row["new_account_id"]
+        for row in _run_on_shard(0, _fetch_all("SELECT old_account_id, new_account_id FROM shard_migration_ids", ()))
+    }
+    summary["archive_files"] = len(archive.replace_values("withdrawals", ["account_id"], new_ids))
+    summary["archive_files"] += len(archive.replace_values("transfers", ["from_account_id", "to_account_id"], new_ids))
+    return summary
+
+
+def recover(grace_seconds=XA_RECOVERY_GRACE_SECONDS):
+    connection = _require_connection(0)
+    cursor = connection.cursor(dictionary=True)
+    try:
+        cursor.execute("SELECT xid, state, TIMESTAMPDIFF(SECOND, created_at, NOW()) AS age FROM xa_log")
+        log = {row["xid"]: row for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        connection.close()
+
+    resolved = {"committed": 0, "rolled_back": 0}
+    for shard in range(SHARD_COUNT):
+        connection = _require_connection(shard)
+        cursor = connection.cursor(dictionary=True)
+        try:
+            cursor.execute("XA RECOVER")
+            for row in cursor.fetchall():
+                xid = row["data"].decode() if isinstance(row["data"], (bytes, bytearray)) else row["data"]
+                if not xid.startswith(XID_PREFIX):
+                    continue
+                entry = log.get(xid)
+                if entry and entry["state"] == "commit":
+                    cursor.execute(f"XA COMMIT '{xid}'")
+                    resolved["committed"] += 1
+                elif entry is None or entry["age"] > grace_seconds:
+                    cursor.execute(f"XA ROLLBACK '{xid}'")
+                    resolved["rolled_back"] += 1
+        finally:
+            cursor.close()
+            connection.close()
+
+    # Every shard answered, so the old log rows have nothing left to resolve.
+    connection = _require_connection(0)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("DELETE FROM xa_log WHERE created_at < NOW() - INTERVAL %s SECOND", (grace_seconds,))
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+    return resolved
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Account sharding maintenance")
+    parser.add_argument("command", choices=["init", "migrate", "recover"])
+    parser.add_argument("--batch-size", type=int, default=MIGRATION_BATCH_SIZE,
+                        help="accounts moved per transaction by migrate")
+    parser.add_argument("--grace-seconds", type=int, default=XA_RECOVERY_GRACE_SECONDS,
+                        help="age after which an undecided XA transaction is rolled back")
+    args = parser.parse_args()
+    if not SHARDING_ENABLED:
+        raise SystemExit("DB_SHARDS lists less than two shards")
+    if args.command == "init":
+        init()
+    elif args.command == "migrate":
+        print(migrate(args.batch_size))
+    else:
+        print(recover(args.grace_seconds))
+
+
+if __name__ == "__main__":
+    main()
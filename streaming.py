@@ -0,0 +1,122 @@
+"""JSON arrays streamed to the client while the rows are read.
+
+The list endpoints return whole tables. ``JSONArrayResponse`` sends their
+array in pieces instead of rendering one document: the rows are read from the
+open cursor ``STREAM_BATCH_SIZE`` at a time on a worker thread, turned into
+items, encoded and sent, so the first bytes leave as soon as the query returns
+its first rows. Every middleware of the app passes the chunks straight on, so
+the next batch is only read once the server took the previous one; a client
+that reads slowly holds the worker to about one batch, not the whole array.
+Profiled requests (see ``profiling``) are the exception: they are buffered
+whole.
+
+The response owns the cursor and the connection and gives them back after the
+last row, when the client goes away, or when it is never sent at all. Once the
+first chunk is out the status is sent, so a database error while streaming
+aborts the response instead of answering 500.
+"""
+import json
+import os
+import threading
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from mysql.connector import Error
+from starlette.concurrency import run_in_threadpool
+
+import threadpool
+
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+
+def cursor_batches(cursor):
+    while True:
+        rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+        if not rows:
+            return
+        yield rows
+
+
+def _encode(items):
+    # Rendered like JSONResponse does.
+    return json.dumps(jsonable_encoder(items), ensure_ascii=False, allow_nan=False, separators=(",", ":"))
+
+
+def _discard_unread(cursor, connection):
+    # A client that went away leaves rows unread, and the connection can not
+    # run anything else until they are.
+    if not connection.unread_result:
+        return
+    try:
+        for _ in cursor_batches(cursor):
+            pass
+    except Error as e:
+        print(f"Discarding the unsent rows failed: {e}")
+        # The query guard refuses to read for a cancelled request; after its
+        # KILL QUERY only the rows already on the wire and the error are left.
+        if connection.unread_result:
+            try:
+                connection.consume_results()
+            except Error:
+                pass
+
+
+def _chunks(batches, to_item):
+    prefix = "["
+    for rows in batches:
+        if rows:
+            yield (prefix + _encode([to_item(row) for row in rows])[1:-1]).encode("utf-8")
+            prefix = ","
+    yield b"[]" if prefix == "[" else b"]"
+
+
+class JSONArrayResponse(StreamingResponse):
+    media_type = "application/json"
+
+    def __init__(self, batches, to_item, cursor, connection, **kwargs):
+        self._cursor = cursor
+        self._connection = connection
+        # Held while a chunk is read, so close() never runs beside a fetch.
+        self._lock = threading.Lock()
+        self._closed = False
+        self._chunks = _chunks(batches, to_item)
+        super().__init__(self._stream(), **kwargs)
+
+    def _next_chunk(self):
+        with self._lock:
+            if self._closed:
+                return None
+            return next(self._chunks, None)
+
+    async def _stream(self):
+        while True:
+            chunk = await threadpool.run_in_threadpool(self._next_chunk)
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        """Give the cursor and the connection back, whether the array was sent in full or not."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._chunks.close()
+            _discard_unread(self._cursor, self._connection)
+            try:
+                self._cursor.close()
+            finally:
+                self._connection.close()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await run_in_threadpool(self.close)
+
+    def collect(self):
+        """The whole array, for callers that run the endpoint outside of a request."""
+        try:
+            return b"".join(iter(self._next_chunk, None))
+        finally:
+            self.close()
@@ -0,0 +1,14 @@
+"""Blocking work handed from the event loop to the worker threads.
+
+``run_in_threadpool`` is ``starlette.concurrency.run_in_threadpool`` for the
+work of a request: the call runs in a copy of the request context, so its
+queries are guarded like the request's own, and it is profiled with the
+request when the request is (see ``profiling.in_worker_thread``).
+"""
+from starlette import concurrency
+
+import profiling
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    return await concurrency.run_in_threadpool(profiling.in_worker_thread(func), *args, **kwargs)
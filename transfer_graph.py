@@ -0,0 +1,262 @@
+"""Transfer network analytics over a date window.
+
+A ``TransferGraph`` is a sparse adjacency map ``from_account_id -> {to_account_id:
+[cents, count]}`` (plus the reverse map) of the transfers dated inside its
+window, loaded with one aggregated query (on every shard) plus the archived
+months. Graphs are cached per window and the transfer bulk handler adds its
+new transfers to every cached graph of its worker whose window contains them,
+so repeated analytics calls do not go back to the database. A cached graph
+is loaded again once it is ``TRANSFER_GRAPH_TTL_SECONDS`` old, which brings
+in the transfers of the other workers.
+
+``round_trips`` enumerates simple cycles, which can be exponential in the
+size of a cluster: it stops after ``MAX_ROUND_TRIP_PATHS`` explored paths.
+
+``python transfer_graph.py --bench 10000000`` builds a graph from that many
+synthetic transfers, without a database, and prints its estimated memory and
+the time taken by the load and by each analytics query.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import archive
+import sharding
+from money import to_cents
+
+CACHED_WINDOWS = 4
+TRANSFER_GRAPH_TTL_SECONDS = float(os.getenv("TRANSFER_GRAPH_TTL_SECONDS", "60"))
+MAX_ROUND_TRIP_PATHS = 1000000
+
+EDGES_QUERY = """
+SELECT from_account_id, to_account_id, SUM(amount) AS amount, COUNT(*) AS transfer_count
+FROM transfers
+WHERE transfer_date BETWEEN %s AND %s
+GROUP BY from_account_id, to_account_id
+"""
+
+
+class TransferGraph:
+    def __init__(self, start_date, end_date):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.outgoing = defaultdict(dict)
+        self.incoming = defaultdict(dict)
+        self.lock = threading.Lock()
+        self.loaded_at = time.monotonic()
+
+    def _add_edge(self, from_id, to_id, amount, count):
+        edge = self.outgoing[from_id].get(to_id)
+        if edge is None:
+            edge = [0, 0]
+            self.outgoing[from_id][to_id] = edge
+            self.incoming[to_id][from_id] = edge
+        edge[0] += to_cents(amount)
+        edge[1] += count
+
+    def load(self, cursor):
+        if sharding.SHARDING_ENABLED:
+            # A transfer is on its sender's shard, so every edge is on one shard.
+            rows = sharding.gather(EDGES_QUERY, (self.start_date, self.end_date))
+        else:
+            cursor.execute(EDGES_QUERY, (self.start_date, self.end_date))
+            rows = cursor.fetchall()
+        with self.lock:
+            for row in rows:
+                self._add_edge(row["from_account_id"], row["to_account_id"], row["amount"], row["transfer_count"])
+            for row in archive.read_rows("transfers", self.start_date, self.end_date):
+                self._add_edge(row["from_account_id"], row["to_account_id"], row["amount"], 1)
+
+    def add_transfers(self, transfers):
+        with self.lock:
+            for from_id, to_id, amount, transfer_date in transfers:
+                if self.start_date <= transfer_date <= self.end_date:
+                    self._add_edge(from_id, to_id, amount, 1)
+
+    def memory_bytes(self):
+        """Estimated memory footprint of the graph, in bytes; each edge is shared by both maps."""
+        with self.lock:
+            total = sys.getsizeof(self.outgoing) + sys.getsizeof(self.incoming)
+            for edges in self.outgoing.values():
+                total += sys.getsizeof(edges) + sum(
+                    sys.getsizeof(edge) + sys.getsizeof(edge[0]) + sys.getsizeof(edge[1]) for edge in edges.values()
+                )
+            total += sum(sys.getsizeof(edges) for edges in self.incoming.values())
+            return total
+
+    def top_counterparties(self, account_id, limit):
+        with self.lock:
+            counterparties = defaultdict(lambda: {"sent": 0, "received": 0, "transfer_count": 0})
+            for to_id, (amount, count) in self.outgoing.get(account_id, {}).items():
+                counterparties[to_id]["sent"] += amount
+                counterparties[to_id]["transfer_count"] += count
+            for from_id, (amount, count) in self.incoming.get(account_id, {}).items():
+                counterparties[from_id]["received"] += amount
+                counterparties[from_id]["transfer_count"] += count
+        ranked = sorted(counterparties.items(), key=lambda item: item[1]["sent"] + item[1]["received"], reverse=True)
+        return [dict(account_id=counterparty_id, **totals) for counterparty_id, totals in ranked[:limit]]
+
+    def net_flow_by_account(self):
+        net_flow = defaultdict(int)
+        with self.lock:
+            for from_id, edges in self.outgoing.items():
+                for to_id, (amount, _) in edges.items():
+                    net_flow[from_id] -= amount
+                    net_flow[to_id] += amount
+        return net_flow
+
+    def strongly_connected_components(self, min_size=2):
+        # Iterative Tarjan, so deep transfer chains do not hit the recursion limit.
+        with self.lock:
+            nodes = set(self.outgoing) | set(self.incoming)
+            successors = {node: list(edges) for node, edges in self.outgoing.items()}
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        counter = 0
+        for root in nodes:
+            if root in index:
+                continue
+            index[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(successors.get(root, ())))]
+            while work:
+                node, children = work[-1]
+                for child in children:
+                    if child not in index:
+                        index[child] = low[child] = counter
+                        counter += 1
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(successors.get(child, ()))))
+                        break
+                    if child in on_stack:
+                        low[node] = min(low[node], index[child])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        low[parent] = min(low[parent], low[node])
+                    if low[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) >= min_size:
+                            components.append(sorted(component))
+        return sorted(components, key=len, reverse=True)
+
+    def round_trips(self, max_length, limit):
+        """Simple cycles of up to ``max_length`` accounts, each found once from its smallest account id."""
+        cycles = []
+        explored = 0
+        for component in self.strongly_connected_components():
+            members = set(component)
+            with self.lock:
+                successors = {
+                    node: [to_id for to_id in self.outgoing.get(node, {}) if to_id in members]
+                    for node in component
+                }
+                amounts = {
+                    (node, to_id): self.outgoing[node][to_id][0]
+                    for node in component for to_id in successors[node]
+                }
+            for start in component:
+                paths = [[start]]
+                while paths:
+                    path = paths.pop()
+                    explored += 1
+                    if explored > MAX_ROUND_TRIP_PATHS:
+                        return cycles
+                    for child in successors[path[-1]]:
+                        if child == start:
+                            cycle = path + [start]
+                            flow = min(amounts[(a, b)] for a, b in zip(cycle, cycle[1:]))
+                            cycles.append({"accounts": path, "round_trip_amount": flow})
+                            if len(cycles) >= limit:
+                                return cycles
+                        elif child > start and child not in path and len(path) < max_length:
+                            paths.append(path + [child])
+        return cycles
+
+
+class TransferGraphCache:
+    def __init__(self, size=CACHED_WINDOWS, ttl_seconds=TRANSFER_GRAPH_TTL_SECONDS):
+        self.size = size
+        self.ttl_seconds = ttl_seconds
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, cursor, start_date, end_date):
+        key = (start_date, end_date)
+        with self._lock:
+            graph = self._graphs.get(key)
+            if graph is not None and time.monotonic() - graph.loaded_at < self.ttl_seconds:
+                self._graphs.move_to_end(key)
+                return graph
+        graph = TransferGraph(start_date, end_date)
+        graph.load(cursor)
+        with self._lock:
+            self._graphs[key] = graph
+            while len(self._graphs) > self.size:
+                self._graphs.popitem(last=False)
+        return graph
+
+    def add_transfers(self, transfers):
+        with self._lock:
+            graphs = list(self._graphs.values())
+        for graph in graphs:
+            graph.add_transfers(transfers)
+
+
+transfer_graphs = TransferGraphCache()
+
+
+def _timed(name, work):
+    started = time.perf_counter()
+    result = work()
+    print(f"{name}: {(time.perf_counter() - started) * 1000:.1f} ms")
+    return result
+
+
+def bench(transfers, accounts, seed=1):
+    generator = random.Random(seed)
+    graph = TransferGraph(None, None)
+    started = time.perf_counter()
+    with graph.lock:
+        for _ in range(transfers):
+            graph._add_edge(generator.randint(1, accounts), generator.randint(1, accounts), generator.randint(1, 5000), 1)
+    edges = sum(len(edges) for edges in graph.outgoing.values())
+    print(f"load: {transfers} transfers between {accounts} accounts ({edges} edges) in {time.perf_counter() - started:.2f}s")
+    print(f"memory: ~{graph.memory_bytes() / 2 ** 20:.0f} MiB estimated")
+
+    busiest = max(graph.outgoing, key=lambda account_id: len(graph.outgoing[account_id]))
+    _timed("top_counterparties of the busiest account", lambda: graph.top_counterparties(busiest, 10))
+    _timed("net_flow_by_account", graph.net_flow_by_account)
+    components = _timed("clusters", graph.strongly_connected_components)
+    print(f"  {len(components)} clusters, the largest of {len(components[0]) if components else 0} accounts")
+    cycles = _timed("round_trips max_length 4 limit 100", lambda: graph.round_trips(4, 100))
+    print(f"  {len(cycles)} round trips found")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfer graph benchmark on synthetic transfers")
+    parser.add_argument("--bench", type=int, required=True, metavar="TRANSFERS", help="synthetic transfers to load")
+    parser.add_argument("--accounts", type=int, help="accounts they are spread over (default: a tenth of the transfers)")
+    args = parser.parse_args()
+    bench(args.bench, args.accounts or max(args.bench // 10, 2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Per-account withdrawal velocity limits kept in memory.
+
+Limits are configured per ``withdrawal_method`` in ``WITHDRAWAL_VELOCITY_LIMITS``
+as JSON, with ``"*"`` applying to the methods not listed::
+
+    {"atm": {"hourly": 500, "daily": 2000}, "*": {"daily": 10000}}
+
+``hourly`` caps the amount withdrawn with a method in the last 60 minutes of
+arrival time (one-minute buckets per account and method) and ``daily`` caps
+the amount per day of arrival on the server: the ``withdrawal_date`` sent by
+the client plays no part, so back- or post-dating a withdrawal does not open a
+fresh daily allowance. Both totals are kept up to date, so a check is a couple
+of dictionary lookups per withdrawal, and the windows of the accounts that
+stopped withdrawing are dropped once a minute. Both are warmed at startup from
+the ``created_at`` of the withdrawal entries of the ledger, the time each
+withdrawal arrived on the server, for the current day and hour.
+
+The counters live in each worker process, so with several workers a limit is
+enforced per worker.
+"""
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import date, datetime
+
+from money import Money, to_cents
+
+WINDOW_MINUTES = 60
+
+# Withdrawals per account, method and minute of arrival, from the account side of their ledger entries.
+WARM_QUERY = """
+SELECT w.account_id, w.withdrawal_method, FLOOR(UNIX_TIMESTAMP(e.created_at) / 60) AS arrival_minute, SUM(w.amount)
+FROM ledger_entries e
+JOIN withdrawals w ON w.withdrawal_id = e.reference_id
+WHERE e.created_at >= FROM_UNIXTIME(%s) AND e.entry_type = 'withdrawal' AND e.account_id IS NOT NULL
+GROUP BY w.account_id, w.withdrawal_method, arrival_minute
+ORDER BY arrival_minute
+"""
+
+
+def _parse_limits(raw):
+    return {
+        method: {window: to_cents(amount) for window, amount in windows.items()}
+        for method, windows in json.loads(raw or "{}").items()
+    }
+
+
+def _current_minute():
+    return int(time.time() // 60)
+
+
+class VelocityLimits:
+    def __init__(self, limits):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._hourly = {}
+        self._daily = defaultdict(int)
+        self._pruned_on = None
+        self._pruned_minute = None
+
+    def limits_for(self, method):
+        return self.limits.get(method) or self.limits.get("*")
+
+    def _hourly_total(self, key, minute):
+        window = self._hourly.get(key)
+        if window is None:
+            return 0
+        buckets = window[0]
+        while buckets and buckets[0][0] <= minute - WINDOW_MINUTES:
+            window[1] -= buckets.popleft()[1]
+        return window[1]
+
+    def _add_hourly(self, key, minute, amount):
+        window = self._hourly.setdefault(key, [deque(), 0])
+        if window[0] and window[0][-1][0] == minute:
+            window[0][-1][1] += amount
+        else:
+            window[0].append([minute, amount])
+        window[1] += amount
+
+    def _prune(self):
+        minute = _current_minute()
+        if self._pruned_minute != minute:
+            for key in list(self._hourly):
+                self._hourly_total(key, minute)
+                if not self._hourly[key][0]:
+                    del self._hourly[key]
+            self._pruned_minute = minute
+        today = date.today()
+        if self._pruned_on == today:
+            return
+        for key in [key for key in self._daily if key[2] < today]:
+            del self._daily[key]
+        self._pruned_on = today
+
+    def warm(self, *connections):
+        if not self.limits:
+            return
+        today = date.today()
+        minute = _current_minute()
+        since = min(datetime.combine(today, datetime.min.time()).timestamp(), (minute - WINDOW_MINUTES + 1) * 60)
+        rows = []
+        for connection in connections:
+            cursor = connection.cursor()
+            try:
+                cursor.execute(WARM_QUERY, (since,))
+                rows.extend(cursor.fetchall())
+            finally:
+                cursor.close()
+        rows.sort(key=lambda row: row[2])
+        with self._lock:
+            self._hourly.clear()
+            self._daily.clear()
+            for account_id, method, arrival_minute, total in rows:
+                arrival_minute = int(arrival_minute)
+                if arrival_minute > minute - WINDOW_MINUTES:
+                    self._add_hourly((account_id, method), arrival_minute, to_cents(total))
+                if date.fromtimestamp(arrival_minute * 60) == today:
+                    self._daily[(account_id, method, today)] += to_cents(total)
+            self._pruned_on = today
+            self._pruned_minute = minute
+
+    def batch(self):
+        return VelocityBatch(self)
+
+    def _record(self, hourly, daily, minute):
+        with self._lock:
+            for key, amount in hourly.items():
+                self._add_hourly(key, minute, amount)
+            for key, amount in daily.items():
+                self._daily[key] += amount
+            self._prune()
+
+
+class VelocityBatch:
+    """Tentative totals of one bulk request, recorded once it commits."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.minute = _current_minute()
+        self.day = date.today()
+        self.hourly = defaultdict(int)
+        self.daily = defaultdict(int)
+
+    def try_add(self, account_id, method, amount):
+        """Add ``amount`` cents, or return why it exceeds a limit."""
+        limits = self.engine.limits_for(method)
+        if not limits:
+            return None
+        hourly_key = (account_id, method)
+        daily_key = (account_id, method, self.day)
+        with self.engine._lock:
+            if "hourly" in limits:
+                total = self.engine._hourly_total(hourly_key, self.minute) + self.hourly[hourly_key] + amount
+                if total > limits["hourly"]:
+                    return f"Hourly {method} withdrawal limit of {Money(limits['hourly'])} exceeded"
+            if "daily" in limits:
+                total = self.engine._daily.get(daily_key, 0) + self.daily[daily_key] + amount
+                if total > limits["daily"]:
+                    return f"Daily {method} withdrawal limit of {Money(limits['daily'])} exceeded"
+        self.hourly[hourly_key] += amount
+        self.daily[daily_key] += amount
+        return None
+
+    def commit(self):
+        if self.hourly or self.daily:
+            self.engine._record(self.hourly, self.daily, self.minute)
+
+
+velocity_limits = VelocityLimits(_parse_limits(os.getenv("WITHDRAWAL_VELOCITY_LIMITS")))
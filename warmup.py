@@ -0,0 +1,257 @@
+"""Startup warm-up of a worker and the readiness state behind ``/health/ready``.
+
+``warm_up`` runs at startup, before the worker takes requests, and times each
+step:
+
+- pool: opens the connection pool of the database and of every shard
+  (``DB_POOL_SIZE`` connections each) and checks all of them out at once.
+- statements: runs the hot parameterized lookups of the bulk handlers and the
+  ledger on each of those connections with values that match nothing, so every
+  pooled connection has them prepared (see ``prepared_statements``).
+- shard_placement: with sharding on, counts the accounts whose number or id
+  belongs to another shard and stops the worker when there are any (run
+  ``python sharding.py migrate``), since they would be looked up elsewhere.
+- balance_index, client_search, velocity_limits: loads the in-memory indexes,
+  the account and client maps among them.
+
+The worker is ready once the pool and shard_placement steps succeed; a later
+step that fails leaves its endpoints on their SQL fallback, as before. When the database can
+not be reached at startup the warm-up is retried every
+``WARMUP_RETRY_SECONDS`` on a background thread, and ``/health/ready``
+answers 503 until it goes through.
+
+Once loaded, the balance index and the client search index are refreshed
+every ``INDEX_REFRESH_SECONDS`` on another background thread with what the
+other workers committed.
+
+``FirstRequestTimer`` records how long the first request to each path took,
+so the cost left for cold requests can be compared with the later ones.
+Time to ready counts from the import of this module, which ``main.py`` does
+first.
+"""
+import os
+import threading
+import time
+from datetime import date
+
+from mysql.connector import Error
+
+import ledger
+import preflight
+import sharding
+from balance_index import balance_index
+from client_search import client_search
+from conexion import DB_POOL_SIZE, get_db_connection
+from velocity import velocity_limits
+
+STARTED_AT = time.perf_counter()
+
+WARMUP_RETRY_SECONDS = float(os.getenv("WARMUP_RETRY_SECONDS", "5"))
+INDEX_REFRESH_SECONDS = float(os.getenv("INDEX_REFRESH_SECONDS", "5"))
+
+# Distinct paths whose first request is timed.
+FIRST_REQUEST_PATHS = 50
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3)
+
+
+class Readiness:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.ready = False
+        self.time_to_ready = None
+        self.attempts = 0
+        self._steps = {}
+        self._first_requests = {}
+
+    def run_step(self, name, step):
+        """Run and time one warm-up step; False when it failed."""
+        started = time.perf_counter()
+        try:
+            step()
+        except Error as e:
+            print(f"Warm-up step {name} failed: {e}")
+            with self._lock:
+                self._steps[name] = {"ms": _ms(time.perf_counter() - started), "error": str(e)}
+            return False
+        with self._lock:
+            self._steps[name] = {"ms": _ms(time.perf_counter() - started)}
+        return True
+
+    def mark_ready(self):
+        with self._lock:
+            self.ready = True
+            self.time_to_ready = time.perf_counter() - STARTED_AT
+        print(f"Worker ready in {_ms(self.time_to_ready)} ms")
+
+    def wants_first_request(self, path):
+        return path not in self._first_requests and len(self._first_requests) < FIRST_REQUEST_PATHS
+
+    def record_first_request(self, path, status_code, seconds):
+        with self._lock:
+            if self.wants_first_request(path):
+                self._first_requests[path] = {"status_code": status_code, "ms": _ms(seconds)}
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "time_to_ready_ms": _ms(self.time_to_ready) if self.time_to_ready is not None else None,
+                "attempts": self.attempts,
+                "steps": {name: dict(step) for name, step in self._steps.items()},
+                "first_requests": {path: dict(request) for path, request in self._first_requests.items()}
+            }
+
+
+readiness = Readiness()
+
+
+def _pool_openers():
+    yield "the database", get_db_connection
+    if sharding.SHARDING_ENABLED:
+        for shard in range(sharding.SHARD_COUNT):
+            yield f"shard {shard}", lambda shard=shard: sharding.get_shard_connection(shard)
+
+
+def _open_pools():
+    connections = []
+    try:
+        for name, open_connection in _pool_openers():
+            for _ in range(DB_POOL_SIZE):
+                connection = open_connection()
+                if not connection:
+                    raise Error(msg=f"Database connection failed for {name}")
+                connections.append(connection)
+    except Error:
+        for connection in connections:
+            connection.close()
+        raise
+    return connections
+
+
+def _prepare_statements(connections):
+    for connection in connections:
+        cursor = connection.cursor(dictionary=True)
+        try:
+            preflight.warm_statements(cursor)
+            ledger.current_balances(cursor, [0])
+            ledger.balance_as_of(cursor, 0, date.today())
+        finally:
+            cursor.close()
+
+
+def _with_shard_connections(load):
+    connections = sharding.shard_connections()
+    try:
+        load(*connections)
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def _load_balance_index():
+    _with_shard_connections(balance_index.load)
+
+
+def _with_first_shard(load):
+    # Clients are copied to every shard, so the first one has them all.
+    connection = sharding.get_shard_connection(0)
+    if not connection:
+        raise Error(msg="Database connection failed for shard 0")
+    try:
+        load(connection)
+    finally:
+        connection.close()
+
+
+def _load_client_search():
+    _with_first_shard(client_search.load)
+
+
+def _warm_velocity_limits():
+    if velocity_limits.limits:
+        _with_shard_connections(velocity_limits.warm)
+
+
+def _check_shard_placement():
+    misplaced = sharding.misplaced_accounts()
+    if misplaced:
+        raise RuntimeError(
+            f"Accounts on the wrong shard (count per shard: {misplaced}), run python sharding.py migrate"
+        )
+
+
+def warm_up():
+    """Run the warm-up steps; False when the database could not be reached."""
+    readiness.attempts += 1
+    connections = []
+    if not readiness.run_step("pool", lambda: connections.extend(_open_pools())):
+        return False
+    try:
+        readiness.run_step("statements", lambda: _prepare_statements(connections))
+    finally:
+        # Back to the pool, with their statements prepared.
+        for connection in connections:
+            connection.close()
+
+    if sharding.SHARDING_ENABLED and not readiness.run_step("shard_placement", _check_shard_placement):
+        return False
+    readiness.run_step("balance_index", _load_balance_index)
+    readiness.run_step("client_search", _load_client_search)
+    readiness.run_step("velocity_limits", _warm_velocity_limits)
+    readiness.mark_ready()
+    return True
+
+
+def _retry_warm_up():
+    while True:
+        time.sleep(WARMUP_RETRY_SECONDS)
+        if warm_up():
+            return
+
+
+def _refresh_indexes():
+    while True:
+        time.sleep(INDEX_REFRESH_SECONDS)
+        try:
+            if balance_index.loaded:
+                _with_shard_connections(balance_index.refresh)
+            if client_search.loaded:
+                _with_first_shard(client_search.refresh)
+        except Error as e:
+            print(f"Refreshing the in-memory indexes failed: {e}")
+
+
+def start():
+    if not warm_up():
+        threading.Thread(target=_retry_warm_up, name="warm-up", daemon=True).start()
+    if INDEX_REFRESH_SECONDS > 0:
+        threading.Thread(target=_refresh_indexes, name="index-refresh", daemon=True).start()
+
+
+class FirstRequestTimer:
+    """Times the first request to each path, up to the end of its response body."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or path.startswith("/health/") or not readiness.wants_first_request(path):
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = None
+
+        async def timed_send(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                readiness.record_first_request(path, status_code, time.perf_counter() - started)
+
+        await self.app(scope, receive, timed_send)